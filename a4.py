@@ -11,13 +11,14 @@ Student ID: 27012171
 """
 
 import sys
+import queue
 import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog
 import time
 import socket
 import sv_ttk
-from ds_messenger import DirectMessenger, DirectMessage
-from profile_class import Profile, Path
+from ds_messenger import DirectMessenger, DirectMessage, Outbox
+from profile_class import Profile, ProfileWriter, Path, open_profile
 
 
 class Body(tk.Frame):
@@ -371,7 +372,11 @@ class MainApp(tk.Frame):
         self.server = ''
         self.recipient = ''
         self.direct_messenger = None
+        self.listener = None
+        self.incoming = queue.Queue()
+        self.outbox = None
         self.profile = None
+        self.profile_writer = None
         self.filepath = None
         self._draw()
         self.body.insert_contact("studentexw23")
@@ -409,13 +414,6 @@ class MainApp(tk.Frame):
                 "No recipient selected. Please choose a contact."
                 )
             return
-        if not self.is_server_running():
-            tk.messagebox.showerror(
-                "Server Error",
-                "Unable to connect. Server not running."
-                )
-            return
-
         message = self.body.get_text_entry()
 
         if not message:
@@ -425,7 +423,18 @@ class MainApp(tk.Frame):
                 )
             return
         try:
-            self.publish(message)
+            if self.is_server_running() and self.publish(message):
+                print('Message sent')
+            elif self.outbox is not None:
+                # Delivered by check_new once the server is back.
+                self.outbox.enqueue(message, self.recipient)
+                print('Server unreachable, message queued')
+            else:
+                tk.messagebox.showerror(
+                    "Server Error",
+                    "Unable to connect. Server not running."
+                    )
+                return
             self.body.insert_user_message(f"{message}")
             self.body.set_text_entry("")
 
@@ -437,7 +446,7 @@ class MainApp(tk.Frame):
                     'timestamp': time.time()
                 }
             )
-            self.profile.save_profile(self.filepath)
+            self.save_profile()
         except AttributeError as e:
             tk.messagebox.showerror(
                 "Attribute Error",
@@ -496,7 +505,31 @@ class MainApp(tk.Frame):
 
         self.body.insert_contact(contact)
         self.profile.add_friend(contact)
-        self.profile.save_profile(self.filepath)
+        self.save_profile()
+
+    def save_profile(self):
+        """Save the profile's changes to its file.
+
+        With a profile writer the changes are saved in the background
+        shortly after, so the UI never waits for the disk.
+        """
+        if self.profile_writer is not None:
+            self.profile_writer.mark_dirty()
+        elif self.filepath:
+            self.profile.save_profile(self.filepath)
+
+    def start_profile_writer(self):
+        """Save the current profile to the current file in the background,
+        after saving what the previous writer had pending."""
+        self.stop_profile_writer()
+        if self.profile is not None and self.filepath:
+            self.profile_writer = ProfileWriter(self.profile, self.filepath)
+
+    def stop_profile_writer(self):
+        """Save pending changes and stop the profile writer."""
+        if self.profile_writer is not None:
+            self.profile_writer.close()
+            self.profile_writer = None
 
     def retrive_contacts(self):
         """Retrieve and display all contacts."""
@@ -560,17 +593,23 @@ class MainApp(tk.Frame):
                     "Unable to connect. The server is not running.")
                 return
 
+            self.stop_listening()
             self.direct_messenger = DirectMessenger(
                 self.server, self.username, self.password
                 )
             if self.direct_messenger:
                 print('DirectMessenger Initialized')
+            if self.filepath:
+                self.outbox = Outbox.for_profile(self.filepath)
+            self.start_listening()
             print(f"Connected to server: {self.server}")
 
             print('Creating Profile')
+            self.stop_profile_writer()
             self.profile = Profile(
                 self.server, self.username, self.password
                 )
+            self.start_profile_writer()
 
             self.body.reset_ui()
 
@@ -604,10 +643,13 @@ class MainApp(tk.Frame):
 
         Args:
             message: The message to publish.
+
+        Returns:
+            True if the server accepted the message, False otherwise.
         """
         try:
             if self.direct_messenger and self.recipient:
-                self.direct_messenger.send(message, self.recipient)
+                return self.direct_messenger.send(message, self.recipient)
             else:
                 tk.messagebox.showerror(
                     "Publish Error",
@@ -643,12 +685,61 @@ class MainApp(tk.Frame):
                 "Publish Error",
                 f"Network/socket error: {e}"
                 )
+        return False
+
+    def start_listening(self):
+        """Subscribe to messages pushed by the server.
+
+        Pushed messages are queued by the listening thread and shown by
+        check_new on the Tk thread.
+        """
+        self.listener = self.direct_messenger.start_listening(
+            self.incoming.put
+            )
+
+    def stop_listening(self):
+        """End the subscription of the current DirectMessenger
+        and close its connection."""
+        if self.direct_messenger:
+            self.direct_messenger.stop_listening()
+            self.direct_messenger.close()
+        self.listener = None
+        self.incoming = queue.Queue()
+
+    def is_listening(self) -> bool:
+        """Check whether pushed messages are being received.
+
+        Returns:
+            True if the subscription is active, False otherwise.
+        """
+        return self.listener is not None and self.listener.is_alive()
 
     def check_new(self):
-        """Check for new messages from the server."""
+        """Check for new messages from the server and deliver the
+        messages queued while it was unreachable.
+
+        While subscribed, this only shows the messages queued by the
+        listening thread. Otherwise, for example when the server does not
+        support subscriptions, it polls the server.
+        """
         if self.direct_messenger:
             try:
-                messages = self.direct_messenger.retrieve_new()
+                if self.outbox is not None:
+                    if len(self.outbox):
+                        self.outbox.flush(self.direct_messenger)
+                    rejected = self.outbox.rejected()
+                    if rejected:
+                        tk.messagebox.showerror(
+                            "Send Error",
+                            f"{len(rejected)} queued messages "
+                            "were refused by the server."
+                            )
+                        self.outbox.clear_rejected()
+                messages = []
+                while not self.incoming.empty():
+                    messages.append(self.incoming.get_nowait())
+                if not self.is_listening():
+                    messages += self.direct_messenger.retrieve_new()
                 if not isinstance(messages, list):
                     raise TypeError("Expected a list of messages.")
                 for msg in messages:
@@ -661,7 +752,8 @@ class MainApp(tk.Frame):
                             'timestamp': time.time()
                         }
                     )
-                    self.profile.save_profile(self.filepath)
+                if messages:
+                    self.save_profile()
             except AttributeError as e:
                 tk.messagebox.showerror(
                     "Check Error",
@@ -698,7 +790,10 @@ class MainApp(tk.Frame):
                     f"Failed to save messages: {e}"
                     )
 
-        self.root.after(2000, self.check_new)
+        if self.is_listening():
+            self.root.after(200, self.check_new)
+        else:
+            self.root.after(2000, self.check_new)
 
     def create_file(self):
         """Create a new profile file."""
@@ -763,25 +858,30 @@ class MainApp(tk.Frame):
 
         self.body.reset_ui()
         self.filepath = Path(filepath)
+        self.outbox = Outbox.for_profile(self.filepath)
 
         try:
-            self.profile = Profile()
-            self.profile.load_profile(self.filepath)
+            self.stop_profile_writer()
+            # Conversations are read when their contact is selected.
+            self.profile = open_profile(self.filepath, lazy=True)
         except (ValueError, KeyError) as e:
             tk.messagebox.showerror(
                 "Profile Error",
                 f"Error: {e}"
                 )
             return
+        self.start_profile_writer()
 
         self.username = self.profile.username
         self.password = self.profile.password
         self.server = self.profile.dsuserver
 
         try:
+            self.stop_listening()
             self.direct_messenger = DirectMessenger(
                 self.server, self.username, self.password
                 )
+            self.start_listening()
         except ConnectionError:
             tk.messagebox.showerror(
                 "Server Connection Error",
@@ -807,6 +907,8 @@ class MainApp(tk.Frame):
 
     def close_program(self):
         """Close the program."""
+        self.stop_listening()
+        self.stop_profile_writer()
         sys.exit()
 
     def _draw(self):
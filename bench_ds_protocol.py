@@ -0,0 +1,199 @@
+"""
+bench_ds_protocol.py
+
+This module benchmarks the protocol functions that run on every request,
+on both the client and the server: format_join_msg, format_direct_msg,
+format_msg_request, extract_json and extract_direct_message.
+
+Every case is run over realistic payloads, from a tiny message up to an
+"all" response holding 100,000 messages. For each case the throughput
+(operations per second) and the peak memory allocated by one call are
+reported. With --save the results become the baseline; later runs are
+compared with it and exit with status 1 when a case is slower or
+allocates more than the allowed threshold.
+
+Usage:
+    python bench_ds_protocol.py --save
+    python bench_ds_protocol.py
+    python bench_ds_protocol.py --codec binary --baseline binary.json
+
+"""
+
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+from ds_protocol import CODECS, get_codec
+from ds_protocol import format_join_msg, format_direct_msg, format_msg_request
+from ds_protocol import extract_json, extract_direct_message
+
+BASELINE = 'bench_ds_protocol.json'
+TOKEN = '07da3ddc-6b9a-4734-b3ca-f0aa7ff22360'
+
+# Message bodies: a short chat line, a paragraph and a pasted document.
+ENTRIES = {
+    'tiny': 'hi',
+    '1KiB': 'x' * 1024,
+    '64KiB': 'x' * 64 * 1024,
+}
+
+# Number of messages in a "new" or "all" response.
+RESPONSE_SIZES = (0, 1, 100, 10000, 100000)
+
+
+def _response(count: int) -> dict:
+    """
+    A message response as the server sends it, holding count messages.
+    """
+    return {'response': {'type': 'ok', 'messages': [
+        {'message': f'message {i}', 'from': f'user{i % 50}',
+         'timestamp': str(1700000000.0 + i)}
+        for i in range(count)
+    ]}}
+
+
+def build_cases(codec=None) -> dict:
+    """
+    Builds the benchmark cases.
+
+    Args:
+        codec (Codec, optional): The codec to format and extract with.
+          Defaults to None, the JSON strings sent on line connections.
+
+    Returns:
+        dict: Case names mapped to functions taking no arguments.
+    """
+    encode = get_codec().dumps if codec is None else codec.encode
+    cases = {
+        'format_join_msg': lambda: format_join_msg(
+            'test1', 'password', codec=codec),
+        'format_msg_request': lambda: format_msg_request(
+            TOKEN, 'all', codec=codec),
+    }
+    for size, entry in ENTRIES.items():
+        cases[f'format_direct_msg[{size}]'] = (
+            lambda entry=entry: format_direct_msg(
+                TOKEN, entry, 'test2', '1700000000.0', codec=codec))
+
+    join_response = encode({'response': {
+        'type': 'ok', 'message': 'Welcome back, test1', 'token': TOKEN}})
+    cases['extract_json'] = lambda: extract_json(join_response, codec)
+    for count in RESPONSE_SIZES:
+        response = encode(_response(count))
+        cases[f'extract_direct_message[{count}]'] = (
+            lambda response=response: extract_direct_message(response, codec))
+    return cases
+
+
+def measure(func, repeat: int = 5) -> dict:
+    """
+    Measures one case.
+
+    Args:
+        func (callable): The case, called without arguments.
+        repeat (int, optional): How many timing runs to take the best of.
+          Defaults to 5.
+
+    Returns:
+        dict: 'ops' per second and the peak 'bytes' allocated by one call.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'ops': number / best, 'bytes': peak}
+
+
+def compare(results: dict, baseline: dict,
+            max_slowdown: float, max_growth: float) -> list:
+    """
+    Compares results with a baseline.
+
+    Args:
+        results (dict): The results of this run, by case.
+        baseline (dict): The saved results, by case.
+        max_slowdown (float): The allowed drop in ops per second,
+          as a fraction of the baseline.
+        max_growth (float): The allowed growth of the allocated bytes,
+          as a fraction of the baseline.
+
+    Returns:
+        list: A message for every regression, empty if there are none.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result['ops'] < old['ops'] * (1 - max_slowdown):
+            regressions.append(
+                f"{name}: {result['ops']:,.0f} ops/s, "
+                f"baseline {old['ops']:,.0f} ops/s")
+        # A few bytes of slack, so tiny cases don't fail on noise.
+        if result['bytes'] > old['bytes'] * (1 + max_growth) + 256:
+            regressions.append(
+                f"{name}: {result['bytes']:,} bytes allocated, "
+                f"baseline {old['bytes']:,} bytes")
+    return regressions
+
+
+def main() -> None:
+    """
+    Parses the arguments, runs the benchmark and compares or saves it.
+    """
+    parser = argparse.ArgumentParser(description='DSU protocol benchmark')
+    parser.add_argument('--codec', choices=sorted(CODECS),
+                        help='codec to format and extract with '
+                             '(default: JSON strings)')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help=f'baseline file (default: {BASELINE})')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--max-slowdown', type=float, default=0.25,
+                        help='allowed drop in ops/sec (default: 0.25)')
+    parser.add_argument('--max-growth', type=float, default=0.10,
+                        help='allowed growth of allocations (default: 0.10)')
+    parser.add_argument('-k', dest='match', default='',
+                        help='only run cases whose name contains this')
+    args = parser.parse_args()
+
+    codec = get_codec(args.codec) if args.codec else None
+    results = {}
+    for name, func in build_cases(codec).items():
+        if args.match not in name:
+            continue
+        results[name] = measure(func)
+        print(f"{name:>32}: {results[name]['ops']:14,.1f} ops/s "
+              f"{results[name]['bytes'] / 1024:12,.1f} KiB/call")
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f'Saved baseline to {args.baseline}')
+        return
+
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f'No baseline at {args.baseline}, run with --save to create it')
+        return
+
+    regressions = compare(results, baseline,
+                          args.max_slowdown, args.max_growth)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
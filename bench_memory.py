@@ -0,0 +1,159 @@
+"""
+bench_memory.py
+
+This module measures how much memory holding many direct messages takes,
+comparing the plain dict and __dict__ representations used before with
+the slotted MessageRecord (server) and DirectMessage (client) records.
+
+Every representation is built in a fresh interpreter, so the growth of
+its resident set size (RSS) is not skewed by memory freed earlier.
+
+Usage:
+    python bench_memory.py --count 1000000
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from ds_messenger import DirectMessage
+from server_store import MessageRecord
+
+PEERS = 50
+
+
+class LegacyDirectMessage:
+    """
+    DirectMessage as it was before it used slots.
+    """
+
+    def __init__(self, sender, message, timestamp, from_user):
+        self.sender = sender
+        self.message = message
+        self.timestamp = timestamp
+        self.from_user = from_user
+
+
+def _fields(count: int):
+    """
+    Yields (peer, message, timestamp) for count messages. Peer names are
+    built per message, as they are when parsed from JSON.
+    """
+    for i in range(count):
+        yield (''.join(['user', str(i % PEERS)]), f'message {i}',
+               str(1700000000.0 + i))
+
+
+def build_server_dict(count: int) -> list:
+    """
+    Messages as the server kept them before: one dict per message.
+    """
+    return [{'message': message, 'from': peer, 'timestamp': timestamp,
+             'status': 'new'}
+            for peer, message, timestamp in _fields(count)]
+
+
+def build_server_record(count: int) -> list:
+    """
+    Messages as JsonStore keeps them now.
+    """
+    return [MessageRecord(peer, message, timestamp, 'new')
+            for peer, message, timestamp in _fields(count)]
+
+
+def build_client_dict(count: int) -> list:
+    """
+    Messages as DirectMessage objects with a per-instance __dict__.
+    """
+    return [LegacyDirectMessage(peer, message, timestamp, False)
+            for peer, message, timestamp in _fields(count)]
+
+
+def build_client_slots(count: int) -> list:
+    """
+    Messages as the slotted DirectMessage.
+    """
+    return [DirectMessage(peer, message, timestamp, False)
+            for peer, message, timestamp in _fields(count)]
+
+
+BUILDERS = {
+    'server-dict': build_server_dict,
+    'server-record': build_server_record,
+    'client-dict': build_client_dict,
+    'client-slots': build_client_slots,
+}
+
+
+def _rss() -> int:
+    """
+    Returns the current resident set size in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # No /proc, fall back to the peak, which only grows here anyway.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def measure(name: str, count: int) -> int:
+    """
+    Builds count messages with the named representation in this process.
+
+    Returns:
+        int: The growth of the RSS in bytes.
+    """
+    before = _rss()
+    messages = BUILDERS[name](count)
+    after = _rss()
+    del messages
+    return after - before
+
+
+def run(name: str, count: int) -> int:
+    """
+    Measures a representation in a fresh interpreter.
+
+    Returns:
+        int: The growth of the RSS in bytes.
+    """
+    output = subprocess.run(
+        [sys.executable, __file__, '--count', str(count), '--only', name],
+        check=True, capture_output=True, text=True
+        ).stdout
+    return json.loads(output)['rss']
+
+
+def main() -> None:
+    """
+    Parses the arguments and prints the RSS growth of every representation.
+    """
+    parser = argparse.ArgumentParser(description='DSU message memory benchmark')
+    parser.add_argument('--count', type=int, default=1000000,
+                        help='number of messages to hold')
+    parser.add_argument('--only', choices=sorted(BUILDERS),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        print(json.dumps({'rss': measure(args.only, args.count)}))
+        return
+
+    results = {name: run(name, args.count) for name in BUILDERS}
+    print(f'{args.count} messages')
+    for name, rss in results.items():
+        print(f'{name:>14}: {rss / 2 ** 20:8.1f} MiB '
+              f'({rss / args.count:6.1f} bytes/message)')
+    for old, new in (('server-dict', 'server-record'),
+                     ('client-dict', 'client-slots')):
+        saved = 1 - results[new] / results[old]
+        print(f'{new} saves {saved:.0%} over {old}')
+
+
+if __name__ == '__main__':
+    main()
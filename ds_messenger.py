@@ -2,13 +2,37 @@
 ds_messenger.py
 
 This module provides functionality for sending and retrieving direct messages
-using a socket connection to a Distributed Social Universe (DSU) server.
+using a socket connection to a Distributed Social Universe (DSU) server,
+with a blocking client (DirectMessenger) and an asyncio client
+(AsyncDirectMessenger), and a durable Outbox holding messages until the
+server can be reached.
 
 """
+import asyncio
+import contextlib
+import itertools
 import socket
 import datetime
+import json
+import os
+import random
+import select
+import sys
+import threading
+import time
+import uuid
+from codecs import iterdecode
+from pathlib import Path
 from ds_protocol import extract_direct_message, format_join_msg
 from ds_protocol import extract_json, format_direct_msg, format_msg_request
+from ds_protocol import extract_history_page, format_history_request
+from ds_protocol import extract_pushed_messages, format_subscribe_msg
+from ds_protocol import extract_batch_results, format_direct_msgs
+from ds_protocol import iter_direct_messages, extract_codec, encode_frame
+from ds_protocol import get_codec, CODECS, FrameDecoder
+
+# The most bytes read from a socket at once.
+RECV_SIZE = 65536
 
 
 class UnexpectedError(Exception):
@@ -21,8 +45,13 @@ class DirectMessage:
     """
     Represents a direct message with s
     ender, message content, timestamp, and origin information.
+
+    Uses slots instead of a per-instance dict, and interns the sender so
+    the messages of one conversation share a single string.
     """
 
+    __slots__ = ('sender', 'message', 'timestamp', 'from_user')
+
     def __init__(self,
                  sender: str,
                  message: str,
@@ -40,7 +69,7 @@ class DirectMessage:
                 Whether the message is from the user (True)
                 or to the user (False).
         """
-        self.sender = sender
+        self.sender = sys.intern(sender) if type(sender) is str else sender
         self.message = message
         self.timestamp = timestamp
         self.from_user = from_user
@@ -66,17 +95,70 @@ class DirectMessage:
             'from_user': self.from_user
         }
 
+    @classmethod
+    def from_dictionary(cls, data: dict) -> 'DirectMessage':
+        """
+        Create a Direct Message from the format of dictionary_user_info
+        """
+        return cls(
+            data['sender'],
+            data['message'],
+            data['timestamp'],
+            data['from_user']
+            )
+
+
+def direct_message_from_dict(msg: dict) -> DirectMessage:
+    """
+    Convert a message object sent by the server into a DirectMessage.
+
+    Args:
+        msg (dict): A message with a 'from' or 'recipient' field.
+
+    Returns:
+        DirectMessage: The message, or None if it has neither field.
+    """
+    if 'recipient' in msg:
+        return DirectMessage(
+            msg['recipient'],
+            msg['message'],
+            msg['timestamp'],
+            True
+            )
+    if 'from' in msg:
+        return DirectMessage(
+            msg['from'],
+            msg['message'],
+            msg['timestamp'],
+            False
+            )
+    return None
+
 
 class DirectMessenger:
     """
     Handles sending and retrieving direct messages
     using a socket connection to a DSU server.
+
+    The connection and its session token are kept open between calls
+    and reopened when the server drops them. Call close(), or use the
+    messenger as a context manager, to release the connection.
+
+    The connection uses JSON unless codecs names other codecs to ask the
+    server for at join, such as 'binary'.
     """
 
+    # Largest response accepted, except by iter_messages, which streams.
+    max_response = 256 * 1024 * 1024
+    # Seconds to wait for the server to accept the connection or to send
+    # data before giving up, or None to wait forever.
+    timeout = 30
+
     def __init__(self,
                  dsuserver: str = None,
                  username: str = None,
-                 password: str = None
+                 password: str = None,
+                 codecs: list = None
                  ):
         """
         Initialize a DirectMessenger object.
@@ -85,16 +167,220 @@ class DirectMessenger:
             dsuserver (str): The DSU server address.
             username (str): The username for authentication.
             password (str): The password for authentication.
+            codecs (list, optional): Names of codecs to use if the server
+                supports them, in order of preference. Codecs that are not
+                installed are skipped. Defaults to None, JSON.
         """
         self.token = None
         self.username = username
         self.dsuserver = dsuserver
         self.password = password
+        self.codecs = codecs
+        self.codec = None
         self.port = 3001
+        self.history_cursor = None
+        self._push_socket = None
+        self._client = None
+        self._decoder = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the connection to the server, if one is open.
+        """
+        with self._lock:
+            client = self._client
+            self._client = None
+            self._decoder = None
+            self.token = None
+            self.codec = None
+            if client is not None:
+                try:
+                    client.close()
+                except OSError:
+                    pass
+
+    def is_connected(self) -> bool:
+        """
+        Checks whether the connection to the server is open and usable,
+        without sending anything.
+
+        Returns:
+            bool: True if the connection is open and the server has
+            neither closed it nor sent anything unexpected.
+        """
+        with self._lock:
+            if self._client is None or len(self._decoder):
+                return False
+            try:
+                readable, _, _ = select.select([self._client], [], [], 0)
+            except (OSError, ValueError):
+                return False
+            # A readable connection means the server closed it or sent a
+            # stray response the next request would read instead of its own.
+            return not readable
+
+    @staticmethod
+    def _receive(client: socket.socket, decoder: FrameDecoder):
+        """
+        Reads from the connection until decoder completes an object.
+
+        Returns:
+            The decoded object, or None if it could not be decoded.
+
+        Raises:
+            EOFError: If the server closes the connection first.
+        """
+        data = b''
+        while True:
+            for obj in decoder.feed(data):
+                return obj
+            data = client.recv(RECV_SIZE)
+            if not data:
+                raise EOFError('Connection closed by the server')
+
+    def _join(self, client: socket.socket, decoder: FrameDecoder,
+              accept: list = None):
+        """
+        Authenticates a new connection.
+
+        Returns:
+            tuple: The DataTuple of the join response, or None if the
+            server refused the credentials, and the response itself.
+        """
+        join_msg = format_join_msg(
+            self.username, self.password, decoder.codec, accept
+            )
+        client.sendall(encode_frame(join_msg, decoder.codec))
+        try:
+            resp = self._receive(client, decoder)
+        except EOFError:
+            resp = None
+        response = extract_json(resp) if resp is not None else None
+
+        if response is None or response.type != "ok":
+            print("Authentication Error:",
+                  response.message if response else resp)
+            return None, resp
+        return response, resp
+
+    def _connect(self) -> bool:
+        """
+        Opens a connection and joins the server,
+        unless a connection is already open.
+
+        Returns:
+            bool: True if the connection is authenticated, False if the
+            server refused the credentials.
+
+        Raises:
+            socket.error: If the server cannot be reached.
+        """
+        if self._client is not None:
+            return True
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        decoder = FrameDecoder(max_size=self.max_response)
+        accept = [name for name in self.codecs or [] if name in CODECS]
+        try:
+            client.settimeout(self.timeout)
+            client.connect((self.dsuserver, self.port))
+            response, resp = self._join(client, decoder, accept)
+        except BaseException:
+            client.close()
+            raise
+
+        if response is None:
+            client.close()
+            return False
+
+        name = extract_codec(resp) if accept else None
+        if name in accept:
+            decoder.codec = get_codec(name)
+            self.codec = decoder.codec
+
+        self._client = client
+        self._decoder = decoder
+        self.token = response.token
+        return True
+
+    def _request(self, formatter, *args, stream: int = 0,
+                 retry: bool = True):
+        """
+        Sends one request over the open connection and reads the response,
+        reconnecting once if the server dropped the connection.
+
+        Args:
+            formatter: The ds_protocol function formatting the request.
+                It is called with the session token followed by args.
+            *args: The remaining arguments of formatter.
+            stream (int, optional): Return the response line as an
+                iterator of chunks of up to stream bytes, received one at
+                a time so it can be parsed while it arrives. Framed codecs
+                always return the decoded response. Defaults to 0, the
+                decoded response.
+            retry (bool, optional): Whether the request may be sent again
+                when the connection drops before the response arrives.
+                Only pass False for requests the server may not carry out
+                twice, such as retrieving new messages, which marks them
+                read. Defaults to True.
+
+        Returns:
+            The decoded response, or None if the server refused the
+            credentials or sent something that could not be decoded.
+
+        Raises:
+            socket.error: If the server cannot be reached, does not
+                respond within timeout, or drops the connection during a
+                request that is not retried.
+        """
+        with self._lock:
+            for attempt in range(2):
+                if not retry and not self.is_connected():
+                    # The request is not sent again, so do not send it
+                    # over a connection the server already closed.
+                    self.close()
+                if not self._connect():
+                    return None
+                codec = self._decoder.codec
+                try:
+                    request = formatter(self.token, *args, codec=codec)
+                    self._client.sendall(encode_frame(request, codec))
+                    if stream and not codec.framed:
+                        chunks = self._decoder.line_chunks(
+                            self._client.recv, stream
+                            )
+                        return itertools.chain([next(chunks)], chunks)
+                    return self._receive(self._client, self._decoder)
+                except socket.timeout:
+                    # The server may still carry out the request and
+                    # answer it late, so neither reuse nor resend it.
+                    self.close()
+                    raise
+                except EOFError:
+                    if not retry:
+                        self.close()
+                        raise ConnectionError(
+                            'Connection closed by the server'
+                            ) from None
+                except socket.error:
+                    if attempt or not retry:
+                        self.close()
+                        raise
+                # The server closed the connection, for example after a
+                # restart. Join again on a fresh connection.
+                self.close()
+            raise ConnectionError('Connection closed by the server')
 
     def send(self, message: str, recipient: str) -> bool:
         """
-        Sends a direct message to a recipient.
+        Sends a direct message to a recipient. The message carries a new
+        unique id, so it is stored once even if the request is retried.
 
         Args:
             message (str): The message content to send.
@@ -104,53 +390,94 @@ class DirectMessenger:
             bool: True if the message was sent successfully, False otherwise.
         """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((self.dsuserver, self.port))
-                send_file = client.makefile('w', encoding='utf-8')
-                recv_file = client.makefile('r', encoding='utf-8')
+            timestamp = str(
+                datetime.datetime.now().timestamp()
+                )
+            print(f'Sending message: "{message}" to {recipient}')
 
-                # Authenticate user
-                join_msg = format_join_msg(self.username, self.password)
-                send_file.write(join_msg + '\r\n')
-                send_file.flush()
+            resp = self._request(
+                format_direct_msg, message, recipient, timestamp,
+                uuid.uuid4().hex
+                )
+            if resp is None:
+                return False
+            response = extract_json(resp)
 
-                resp = recv_file.readline().strip()
-                response = extract_json(resp)
+            if response.type != "ok":
+                print("Message Sending Error:", response.message)
+                return False
 
-                if response.type != "ok":
-                    print("Authentication Error:", response.message)
-                    return False
+            print("Message sent successfully!")
+            return True
 
-                self.token = response.token
+        except socket.error as e:
+            print(f"Socket error: {e}")
 
-                timestamp = str(
-                    datetime.datetime.now().timestamp()
-                    )
-                print(f'Sending message: "{message}" to {recipient}')
+        return False
 
-                direct_msg = format_direct_msg(
-                    token=self.token,
-                    direct_msg=message,
-                    recipient=recipient,
-                    timestamp=timestamp
+    def send_many(self, messages: list, message_ids: list = None) -> list:
+        """
+        Sends several direct messages in one request.
+
+        Args:
+            messages (list): (recipient, message) pairs.
+            message_ids (list, optional): A unique id for each message.
+                The server acknowledges a message whose id it already
+                stored without storing it again, so the batch can be
+                retried safely. Defaults to None, new unique ids.
+
+        Returns:
+            list: For each pair, True if the message was sent,
+            False otherwise.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+        results = self._send_batch(messages, message_ids)
+        if results is None:
+            return [False] * len(messages)
+        return [result == 'ok' for result in results]
+
+    def _send_batch(self, messages: list, message_ids: list = None):
+        """
+        Sends a batch direct message request.
+
+        Args:
+            messages (list): (recipient, message) pairs.
+            message_ids (list, optional): A unique id for each message.
+                Defaults to None, new unique ids.
+
+        Returns:
+            list: 'ok' or 'error' for each pair, or None if the request
+            was not carried out: the server could not be reached or
+            refused the request as a whole, for example because the
+            batch is too large.
+        """
+        if message_ids is None:
+            message_ids = [uuid.uuid4().hex for _ in messages]
+        try:
+            timestamp = str(
+                datetime.datetime.now().timestamp()
                 )
-                send_file.write(direct_msg + '\r\n')
-                send_file.flush()
+            print(f'Sending {len(messages)} messages')
 
-                resp = recv_file.readline().strip()
-                response = extract_json(resp)
+            resp = self._request(
+                format_direct_msgs, messages, timestamp, message_ids
+                )
+            if resp is None:
+                return None
+            results = extract_batch_results(resp)
 
-                if response.type != "ok":
-                    print("Message Sending Error:", response.message)
-                    return False
+            if len(results) != len(messages):
+                print("Message Sending Error:", extract_json(resp))
+                return None
 
-                print("Message sent successfully!")
-                return True
+            return results
 
         except socket.error as e:
             print(f"Socket error: {e}")
 
-        return False
+        return None
 
     def retrieve_messages(self, message_type: str) -> list:
         """
@@ -163,76 +490,943 @@ class DirectMessenger:
         Returns:
             list: A list of DirectMessage objects.
         """
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((self.dsuserver, self.port))
-                send_file = client.makefile('w', encoding='utf-8')
-                recv_file = client.makefile('r', encoding='utf-8')
-
-                # Authenticate user
-                join_msg = format_join_msg(self.username, self.password)
-                send_file.write(join_msg + '\r\n')
-                send_file.flush()
+        return list(self.iter_messages(message_type))
 
-                resp = recv_file.readline().strip()
-                response = extract_json(resp)
+    def iter_messages(self, message_type: str = 'all',
+                      chunk_size: int = 65536):
+        """
+        Retrieves messages of the specified type ('new' or 'all'),
+        parsing the response as it arrives and yielding one message at a
+        time. Memory stays bounded by chunk_size and the largest message,
+        however long the history is.
 
-                if response.type != "ok":
-                    print("Authentication Error:", response.message)
-                    return []
+        The iterator takes the connection over until it is exhausted, so
+        other requests made meanwhile, from this thread or another, open
+        a connection of their own instead of waiting for it. If it is
+        abandoned early, its connection is closed.
 
-                self.token = response.token
+        Args:
+            message_type (str, optional):
+                The type of messages to retrieve ('new' or 'all').
+                Defaults to 'all'.
+            chunk_size (int, optional):
+                The most bytes read from the socket at once.
+                Defaults to 65536.
 
+        Yields:
+            DirectMessage: The messages in the order they were stored.
+        """
+        try:
+            with self._lock:
                 # Request messages
-                request_msg = format_msg_request(self.token, message_type)
                 print(f'Retrieving {message_type} messages')
                 print(f'for {self.username}')
-                send_file.write(request_msg + '\r\n')
-                send_file.flush()
+                line = self._request(
+                    format_msg_request, message_type, stream=chunk_size,
+                    retry=message_type != 'new'
+                    )
+                if line is None:
+                    return
+                if not isinstance(line, dict):
+                    # Detach the connection, so the lock is not held
+                    # while the caller consumes the messages.
+                    connection = (self._client, self._decoder,
+                                  self.token, self.codec)
+                    self._client = self._decoder = None
+                    self.token = self.codec = None
+            if isinstance(line, dict):
+                # A frame arrives whole, there is nothing to stream.
+                for msg in extract_direct_message(line):
+                    dm = direct_message_from_dict(msg)
+                    if dm:
+                        yield dm
+                return
+            drained = False
+            try:
+                for msg in iter_direct_messages(iterdecode(line, 'utf-8')):
+                    dm = direct_message_from_dict(msg)
+                    if dm:
+                        yield dm
+                for _ in line:
+                    pass
+                drained = True
+            finally:
+                # Give the connection back unless the rest of the response
+                # is still unread and would be taken for the next one, or
+                # another connection was opened meanwhile.
+                with self._lock:
+                    if drained and self._client is None:
+                        (self._client, self._decoder,
+                         self.token, self.codec) = connection
+                    else:
+                        connection[0].close()
+
+        except (socket.error, EOFError) as e:
+            print(f"Socket error: {e}")
 
-                resp = recv_file.readline().strip()
-                messages = extract_direct_message(resp)
+    def retrieve_all(self) -> list:
+        """
+        Retrieves all messages.
+
+        Returns:
+            list: A list of all DirectMessage objects.
+        """
+        return self.retrieve_messages('all')
+
+    def retrieve_new(self) -> list:
+        """
+        Retrieves only new messages.
+
+        Returns:
+            list: A list of new DirectMessage objects.
+        """
+        return self.retrieve_messages('new')
 
-                direct_messages = []
+    def iter_history(self, since: int = None, limit: int = 100):
+        """
+        Iterates over the message history one page at a time, starting
+        after a cursor. Unlike retrieve_all, reading the history does not
+        mark messages as read.
+
+        After each page, history_cursor holds the cursor to resume from,
+        so a later call with since=self.history_cursor only fetches
+        messages received in the meantime.
+
+        Args:
+            since (int, optional):
+                The cursor to start after. Defaults to None, the start
+                of the history.
+            limit (int, optional):
+                The number of messages requested per page. The server may
+                send fewer. Defaults to 100.
+
+        Yields:
+            DirectMessage: The messages in the order they were stored.
+        """
+        try:
+            cursor = since
+            while True:
+                resp = self._request(format_history_request, cursor, limit)
+                if resp is None:
+                    return
+                messages, next_cursor = extract_history_page(resp)
+                # The server may send fewer messages than limit, so only
+                # a page without messages ends the history.
+                if next_cursor is None or not messages:
+                    return
                 for msg in messages:
-                    if 'recipient' in msg:
-                        dm = DirectMessage(
-                            msg['recipient'],
-                            msg['message'],
-                            msg['timestamp'],
-                            True
+                    dm = direct_message_from_dict(msg)
+                    if dm:
+                        yield dm
+                cursor = next_cursor
+                self.history_cursor = cursor
+
+        except socket.error as e:
+            print(f"Socket error: {e}")
+
+    def iter_pushed(self):
+        """
+        Subscribes to the direct messages of the user and yields them as
+        the server pushes them. The subscription uses a connection of its
+        own and lasts until the server closes it or stop_listening is
+        called. Messages delivered this way are marked read on the server.
+
+        Yields:
+            DirectMessage: The received messages, as they arrive.
+        """
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+                self._push_socket = client
+                client.settimeout(self.timeout)
+                client.connect((self.dsuserver, self.port))
+                decoder = FrameDecoder(max_size=self.max_response)
+
+                # Authenticate user. The token belongs to this connection
+                # only, the one of the request connection stays valid.
+                response, _ = self._join(client, decoder)
+                if response is None:
+                    return
+
+                subscribe_msg = format_subscribe_msg(
+                    response.token, codec=decoder.codec
+                    )
+                client.sendall(encode_frame(subscribe_msg, decoder.codec))
+
+                while True:
+                    data = client.recv(RECV_SIZE)
+                    if not data:
+                        return
+                    for resp in decoder.feed(data):
+                        if resp is None:
+                            continue
+                        messages = extract_pushed_messages(resp)
+                        if messages is None:
+                            # Not an event, the response to the subscription.
+                            response = extract_json(resp)
+                            if response is None or response.type != "ok":
+                                print("Subscription Error:",
+                                      response.message if response else resp)
+                                return
+                            # Events come whenever a message arrives.
+                            client.settimeout(None)
+                            continue
+                        for msg in messages:
+                            dm = direct_message_from_dict(msg)
+                            if dm:
+                                yield dm
+
+        except socket.error as e:
+            if self._push_socket is not None:
+                print(f"Socket error: {e}")
+        finally:
+            self._push_socket = None
+
+    def start_listening(self, callback) -> threading.Thread:
+        """
+        Calls callback with every direct message the server pushes,
+        from a background thread.
+
+        Args:
+            callback: A function taking a DirectMessage.
+
+        Returns:
+            threading.Thread: The listening thread. It ends when the
+            subscription does.
+        """
+        def listen():
+            for dm in self.iter_pushed():
+                callback(dm)
+
+        listener = threading.Thread(target=listen, daemon=True)
+        listener.start()
+        return listener
+
+    def stop_listening(self) -> None:
+        """
+        Ends the subscription started by iter_pushed or start_listening.
+        """
+        client = self._push_socket
+        self._push_socket = None
+        if client is not None:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class DirectMessengerPool:
+    """
+    Keeps a bounded set of authenticated DirectMessenger connections per
+    (server, username) and hands them out to threads one at a time.
+
+    Connections idle for longer than idle_timeout are closed, and a
+    connection is checked before it is handed out again, so a connection
+    the server dropped is replaced instead of failing the next call.
+    """
+
+    def __init__(self,
+                 max_per_user: int = 4,
+                 idle_timeout: float = 60.0,
+                 port: int = 3001
+                 ):
+        """
+        Initialize a DirectMessengerPool object.
+
+        Args:
+            max_per_user (int):
+                The most connections open at once for one
+                (server, username).
+            idle_timeout (float):
+                Seconds an unused connection is kept open.
+            port (int): The DSU server port.
+        """
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.port = port
+        self._idle = {}  # (server, username) -> [(messenger, last used)]
+        self._in_use = {}  # (server, username) -> checked out count
+        self._condition = threading.Condition()
+        self._last_sweep = time.monotonic()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self,
+                dsuserver: str,
+                username: str,
+                password: str,
+                timeout: float = None
+                ) -> DirectMessenger:
+        """
+        Checks out a messenger for (dsuserver, username). The caller must
+        give it back with release().
+
+        Args:
+            dsuserver (str): The DSU server address.
+            username (str): The username for authentication.
+            password (str): The password for authentication.
+            timeout (float, optional):
+                Seconds to wait when all connections of the user are
+                checked out. Defaults to None, waiting until one is free.
+
+        Returns:
+            DirectMessenger: A messenger used by no other thread.
+
+        Raises:
+            TimeoutError: If no messenger became free within timeout.
+            RuntimeError: If the pool is closed.
+        """
+        key = (dsuserver, username)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError('DirectMessengerPool is closed')
+                self._sweep()
+                idle = self._idle.get(key, [])
+                while idle:
+                    messenger, _ = idle.pop()
+                    if messenger.is_connected():
+                        break
+                    messenger.close()
+                else:
+                    messenger = None
+                    if self._in_use.get(key, 0) < self.max_per_user:
+                        messenger = DirectMessenger(
+                            dsuserver, username, password
                             )
-                        direct_messages.append(dm)
-                    elif 'from' in msg:
-                        dm = DirectMessage(
-                            msg['from'],
-                            msg['message'],
-                            msg['timestamp'],
-                            False
+                        messenger.port = self.port
+                if messenger is not None:
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f'No free connection for {username}'
                             )
-                        direct_messages.append(dm)
+                self._condition.wait(remaining)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        if messenger.password != password:
+            messenger.close()
+            messenger.password = password
+        return messenger
 
-                return direct_messages
+    def release(self, messenger: DirectMessenger,
+                discard: bool = False) -> None:
+        """
+        Gives back a messenger checked out with acquire().
 
-        except socket.error as e:
+        Args:
+            messenger (DirectMessenger): The messenger to give back.
+            discard (bool, optional):
+                Close the connection instead of keeping it for reuse.
+                Defaults to False.
+        """
+        key = (messenger.dsuserver, messenger.username)
+        with self._condition:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            if discard or self._closed or not messenger.is_connected():
+                messenger.close()
+            else:
+                self._idle.setdefault(key, []).append(
+                    (messenger, time.monotonic())
+                    )
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self,
+                   dsuserver: str,
+                   username: str,
+                   password: str,
+                   timeout: float = None
+                   ):
+        """
+        Checks out a messenger for the duration of a with block. The
+        connection is closed instead of reused if the block raises.
+
+        Args:
+            dsuserver (str): The DSU server address.
+            username (str): The username for authentication.
+            password (str): The password for authentication.
+            timeout (float, optional):
+                Seconds to wait for a free connection.
+
+        Yields:
+            DirectMessenger: A messenger used by no other thread.
+        """
+        messenger = self.acquire(dsuserver, username, password, timeout)
+        failed = True
+        try:
+            yield messenger
+            failed = False
+        finally:
+            self.release(messenger, discard=failed)
+
+    def send(self,
+             dsuserver: str,
+             username: str,
+             password: str,
+             message: str,
+             recipient: str
+             ) -> bool:
+        """
+        Sends a direct message on behalf of username over a pooled
+        connection.
+
+        Returns:
+            bool: True if the message was sent successfully, False otherwise.
+        """
+        with self.connection(dsuserver, username, password) as messenger:
+            return messenger.send(message, recipient)
+
+    def evict_idle(self) -> None:
+        """
+        Closes every connection that has been idle for longer than
+        idle_timeout.
+        """
+        with self._condition:
+            self._last_sweep = 0
+            self._sweep()
+
+    def _sweep(self) -> None:
+        """
+        Closes expired idle connections, at most twice per idle_timeout.
+        Must be called with the condition held.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_timeout / 2:
+            return
+        self._last_sweep = now
+        for key in list(self._idle):
+            keep = []
+            for messenger, last_used in self._idle[key]:
+                if now - last_used > self.idle_timeout:
+                    messenger.close()
+                else:
+                    keep.append((messenger, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def stats(self) -> dict:
+        """
+        Counts the pooled connections.
+
+        Returns:
+            dict: The number of idle and checked out connections.
+        """
+        with self._condition:
+            return {
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'in_use': sum(self._in_use.values()),
+            }
+
+    def close(self) -> None:
+        """
+        Closes every idle connection. Connections still checked out are
+        closed when they are released.
+        """
+        with self._condition:
+            self._closed = True
+            for idle in self._idle.values():
+                for messenger, _ in idle:
+                    messenger.close()
+            self._idle = {}
+            self._condition.notify_all()
+
+
+class Outbox:
+    """
+    Durably queues direct messages that could not be sent and delivers
+    them in order once the server is reachable again.
+
+    Messages are stored one JSON object per line next to the profile, so
+    they survive a restart, along with the messages the server refused
+    until they are cleared. Each message gets a unique id when it is
+    queued, which lets the server drop copies delivered by a retry.
+    After a failed delivery the next attempt waits an exponentially
+    growing, randomly jittered delay.
+    """
+
+    def __init__(self,
+                 path,
+                 batch_size: int = 100,
+                 base_delay: float = 1.0,
+                 max_delay: float = 300.0):
+        """
+        Initializes the Outbox and loads the messages already queued.
+
+        Args:
+            path: The file the queued messages are stored in.
+            batch_size (int, optional): Most messages sent in one
+                request. Defaults to 100.
+            base_delay (float, optional): Seconds to wait after the first
+                failed delivery. Defaults to 1.0.
+            max_delay (float, optional): Longest wait between deliveries,
+                in seconds. Defaults to 300.0.
+        """
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.next_attempt = 0.0
+        self._batch_limit = batch_size
+        self._lock = threading.Lock()
+        self._flushing = False
+        self._messages = []
+        self._rejected = []
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        msg = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash while it was written.
+                        continue
+                    if msg.get('rejected'):
+                        self._rejected.append(msg)
+                    else:
+                        self._messages.append(msg)
+
+    @classmethod
+    def for_profile(cls, profile_path, **kwargs) -> 'Outbox':
+        """
+        Creates the Outbox stored next to a profile file.
+
+        Args:
+            profile_path: The path of the .dsu profile.
+            **kwargs: Passed on to Outbox.
+
+        Returns:
+            Outbox: The outbox of the profile.
+        """
+        return cls(Path(profile_path).with_suffix('.outbox'), **kwargs)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._messages)
+
+    def pending(self) -> list:
+        """
+        Returns the queued messages, oldest first.
+
+        Returns:
+            list: (recipient, message) pairs.
+        """
+        with self._lock:
+            return [(msg['recipient'], msg['message'])
+                    for msg in self._messages]
+
+    def rejected(self) -> list:
+        """
+        Returns the messages the server refused, oldest first. They are
+        kept, also across restarts, until clear_rejected is called.
+
+        Returns:
+            list: (recipient, message) pairs.
+        """
+        with self._lock:
+            return [(msg['recipient'], msg['message'])
+                    for msg in self._rejected]
+
+    def clear_rejected(self) -> None:
+        """
+        Forgets the messages the server refused.
+        """
+        with self._lock:
+            if self._rejected:
+                self._rejected = []
+                self._save()
+
+    def enqueue(self, message: str, recipient: str) -> str:
+        """
+        Queues a message and writes it to disk before returning.
+
+        Args:
+            message (str): The message content to send.
+            recipient (str): The recipient's username.
+
+        Returns:
+            str: The id of the queued message.
+        """
+        msg = {
+            'id': uuid.uuid4().hex,
+            'recipient': recipient,
+            'message': message,
+            'timestamp': str(datetime.datetime.now().timestamp())
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(msg) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self._messages.append(msg)
+        return msg['id']
+
+    def flush(self, messenger: DirectMessenger, force: bool = False) -> int:
+        """
+        Sends the queued messages, unless the delay after a failed
+        delivery has not passed yet.
+
+        Messages the server refuses one by one while the connection stays
+        open are moved to rejected instead of being retried forever. A
+        request the server refuses as a whole, for example while the same
+        messages are being sent on another connection or because the
+        batch is too large, keeps its messages queued like a lost
+        connection does, and later batches are half as large. The lock is
+        not held while sending, so messages can be queued meanwhile; a
+        flush started while another one runs returns at once.
+
+        Args:
+            messenger (DirectMessenger): The messenger to send with.
+            force (bool, optional): Try now even if the delay has not
+                passed. Defaults to False.
+
+        Returns:
+            int: The number of messages delivered.
+        """
+        delivered = 0
+        with self._lock:
+            if self._flushing or not self._messages:
+                return 0
+            if not force and time.monotonic() < self.next_attempt:
+                return 0
+            self._flushing = True
+        try:
+            while True:
+                with self._lock:
+                    batch = self._messages[:self._batch_limit]
+                    if not batch:
+                        # Everything was sent, so try full batches again.
+                        self._batch_limit = self.batch_size
+                if not batch:
+                    break
+                results = messenger._send_batch(
+                    [(msg['recipient'], msg['message']) for msg in batch],
+                    [msg['id'] for msg in batch]
+                    )
+                if results is None:
+                    with self._lock:
+                        self._batch_limit = max(1, len(batch) // 2)
+                        self._backoff()
+                    break
+                with self._lock:
+                    self.failures = 0
+                    self.next_attempt = 0.0
+                    for msg, result in zip(batch, results):
+                        if result == 'ok':
+                            delivered += 1
+                        else:
+                            self._rejected.append(dict(msg, rejected=True))
+                    # Only flush removes messages and enqueue appends, so
+                    # the batch is still at the front of the queue.
+                    del self._messages[:len(batch)]
+                    self._save()
+        finally:
+            with self._lock:
+                self._flushing = False
+        return delivered
+
+    def _backoff(self) -> None:
+        """
+        Schedules the next delivery after a failure, with full jitter so
+        clients reconnecting together do not retry in lockstep.
+        """
+        self.failures += 1
+        delay = min(self.max_delay,
+                    self.base_delay * 2 ** (self.failures - 1))
+        self.next_attempt = time.monotonic() + random.uniform(0, delay)
+
+    def _save(self) -> None:
+        """
+        Atomically rewrites the file with the messages still queued and
+        the rejected ones.
+        """
+        if not self._messages and not self._rejected:
+            self.path.unlink(missing_ok=True)
+            return
+        temp = self.path.with_name(self.path.name + '.tmp')
+        with open(temp, 'w', encoding='utf-8') as file:
+            for msg in self._rejected + self._messages:
+                file.write(json.dumps(msg) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.path)
+
+
+class AsyncDirectMessenger:
+    """
+    Handles sending and retrieving direct messages over an asyncio
+    stream connection to a DSU server, so one event loop can drive many
+    accounts without a thread per account.
+
+    Like DirectMessenger, the connection and its session token are kept
+    open between calls and reopened when the server drops them.
+    """
+
+    # Largest response accepted, so long histories fit in one frame.
+    max_response = 256 * 1024 * 1024
+    # Seconds to wait for the server to accept the connection or to send
+    # data before giving up, or None to wait forever.
+    timeout = 30
+
+    def __init__(self,
+                 dsuserver: str = None,
+                 username: str = None,
+                 password: str = None
+                 ):
+        """
+        Initialize an AsyncDirectMessenger object.
+
+        Args:
+            dsuserver (str): The DSU server address.
+            username (str): The username for authentication.
+            password (str): The password for authentication.
+        """
+        self.token = None
+        self.username = username
+        self.dsuserver = dsuserver
+        self.password = password
+        self.port = 3001
+        self._reader = None
+        self._writer = None
+        self._decoder = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Closes the connection to the server, if one is open.
+        """
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        self._decoder = None
+        self.token = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _connect(self) -> bool:
+        """
+        Opens a connection and joins the server,
+        unless a connection is already open.
+
+        Returns:
+            bool: True if the connection is authenticated, False if the
+            server refused the credentials.
+
+        Raises:
+            OSError: If the server cannot be reached.
+            asyncio.TimeoutError: If the server does not accept the
+                connection or answer the join within timeout.
+        """
+        if self._writer is not None:
+            return True
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.dsuserver, self.port), self.timeout
+            )
+        decoder = FrameDecoder(max_size=self.max_response)
+        try:
+            join_msg = format_join_msg(
+                self.username, self.password, decoder.codec
+                )
+            writer.write(encode_frame(join_msg, decoder.codec))
+            await writer.drain()
+            try:
+                resp = await asyncio.wait_for(
+                    self._receive(reader, decoder), self.timeout
+                    )
+            except EOFError:
+                resp = None
+        except BaseException:
+            writer.close()
+            raise
+        response = extract_json(resp) if resp is not None else None
+
+        if response is None or response.type != "ok":
+            print("Authentication Error:",
+                  response.message if response else resp)
+            writer.close()
+            return False
+
+        self._reader = reader
+        self._writer = writer
+        self._decoder = decoder
+        self.token = response.token
+        return True
+
+    @staticmethod
+    async def _receive(reader: asyncio.StreamReader, decoder: FrameDecoder):
+        """
+        Reads from the stream until decoder completes an object.
+
+        Returns:
+            The decoded object, or None if it could not be decoded.
+
+        Raises:
+            EOFError: If the server closes the connection first.
+        """
+        data = b''
+        while True:
+            for obj in decoder.feed(data):
+                return obj
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                raise EOFError('Connection closed by the server')
+
+    async def _request(self, formatter, *args, retry: bool = True):
+        """
+        Sends one request over the open connection and reads the response,
+        reconnecting once if the server dropped the connection.
+
+        Args:
+            formatter: The ds_protocol function formatting the request.
+                It is called with the session token followed by args.
+            *args: The remaining arguments of formatter.
+            retry (bool, optional): Whether the request may be sent again
+                when the connection drops before the response arrives.
+                Defaults to True.
+
+        Returns:
+            The decoded response, or None if the server refused the
+            credentials or sent something that could not be decoded.
+
+        Raises:
+            OSError: If the server cannot be reached, does not respond
+                within timeout, or drops the connection during a request
+                that is not retried.
+        """
+        async with self._lock:
+            for attempt in range(2):
+                if not retry and self._reader is not None and (
+                        self._reader.at_eof()):
+                    await self.close()
+                try:
+                    if not await self._connect():
+                        return None
+                except asyncio.TimeoutError:
+                    raise TimeoutError('The server did not respond') from None
+                codec = self._decoder.codec
+                try:
+                    request = formatter(self.token, *args, codec=codec)
+                    self._writer.write(encode_frame(request, codec))
+                    await asyncio.wait_for(self._writer.drain(), self.timeout)
+                    return await asyncio.wait_for(
+                        self._receive(self._reader, self._decoder),
+                        self.timeout
+                        )
+                except asyncio.TimeoutError:
+                    # The server may still carry out the request and
+                    # answer it late, so neither reuse nor resend it.
+                    await self.close()
+                    raise TimeoutError('The server did not respond') from None
+                except EOFError:
+                    if not retry:
+                        await self.close()
+                        raise ConnectionError(
+                            'Connection closed by the server'
+                            ) from None
+                except OSError:
+                    if attempt or not retry:
+                        await self.close()
+                        raise
+                await self.close()
+            raise ConnectionError('Connection closed by the server')
+
+    async def send(self, message: str, recipient: str) -> bool:
+        """
+        Sends a direct message to a recipient. The message carries a new
+        unique id, so it is stored once even if the request is retried.
+
+        Args:
+            message (str): The message content to send.
+            recipient (str): The recipient's username.
+
+        Returns:
+            bool: True if the message was sent successfully, False otherwise.
+        """
+        try:
+            timestamp = str(datetime.datetime.now().timestamp())
+            resp = await self._request(
+                format_direct_msg, message, recipient, timestamp,
+                uuid.uuid4().hex
+                )
+            if resp is None:
+                return False
+            response = extract_json(resp)
+
+            if response.type != "ok":
+                print("Message Sending Error:", response.message)
+                return False
+            return True
+
+        except OSError as e:
+            print(f"Socket error: {e}")
+
+        return False
+
+    async def retrieve_messages(self, message_type: str) -> list:
+        """
+        Retrieves messages of the specified type ('new' or 'all').
+
+        Args:
+            message_type (str):
+                The type of messages to retrieve ('new' or 'all').
+
+        Returns:
+            list: A list of DirectMessage objects.
+        """
+        try:
+            resp = await self._request(
+                format_msg_request, message_type,
+                retry=message_type != 'new'
+                )
+            if resp is None:
+                return []
+            direct_messages = []
+            for msg in extract_direct_message(resp):
+                dm = direct_message_from_dict(msg)
+                if dm:
+                    direct_messages.append(dm)
+            return direct_messages
+
+        except OSError as e:
             print(f"Socket error: {e}")
 
         return []
 
-    def retrieve_all(self) -> list:
+    async def retrieve_all(self) -> list:
         """
         Retrieves all messages.
 
         Returns:
             list: A list of all DirectMessage objects.
         """
-        return self.retrieve_messages('all')
+        return await self.retrieve_messages('all')
 
-    def retrieve_new(self) -> list:
+    async def retrieve_new(self) -> list:
         """
         Retrieves only new messages.
 
         Returns:
             list: A list of new DirectMessage objects.
         """
-        return self.retrieve_messages('new')
+        return await self.retrieve_messages('new')
@@ -2,7 +2,8 @@
 ds_protocol.py
 
 This module provides functions to format and extract JSON messages for
-communication with a Distributed Social Universe (DSU) server.
+communication with a Distributed Social Universe (DSU) server, and the
+registry of codecs that serialize them.
 
 Author: Harmeet Singh
 Email: harmees2
@@ -10,19 +11,526 @@ Student ID: 27012171
 """
 
 import json
+import struct
 from collections import namedtuple
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Namedtuple to hold the values retrieved from JSON messages.
 DataTuple = namedtuple('DataTuple', ['type', 'message', 'token'])
 
+# Length prefix of the frames of framed codecs: a 4 byte big-endian size.
+FRAME_HEADER = struct.Struct('>I')
+
+# Payloads of the BinaryCodec values: sizes reuse FRAME_HEADER.
+_BINARY_INT = struct.Struct('>q')
+_BINARY_FLOAT = struct.Struct('>d')
+
+
+class Codec:
+    """
+    Serializes protocol objects for the wire.
+
+    Line codecs (framed is False) send one object per line ending in
+    '\r\n', which is how JSON has always been sent. Framed codecs send a
+    FRAME_HEADER with the size of the object followed by its bytes, so
+    they may contain any byte. Every connection starts with the default
+    JSON codec and may switch to another one at join.
+    """
+
+    name = ''
+    framed = False
+
+    def encode(self, obj) -> bytes:
+        """
+        Encodes a protocol object.
+        """
+        raise NotImplementedError
+
+    def decode(self, data):
+        """
+        Decodes a protocol object from bytes, or a str for JSON codecs.
+
+        Raises:
+            ValueError: If data is not a valid encoding.
+        """
+        raise NotImplementedError
+
+    def dumps(self, obj) -> str:
+        """
+        Encodes a protocol object as a str, for line codecs.
+        """
+        return self.encode(obj).decode('utf-8')
+
+
+class JsonCodec(Codec):
+    """
+    The standard library JSON codec.
+    """
+
+    name = 'json'
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+
+class OrjsonCodec(Codec):
+    """
+    JSON through orjson, producing the same protocol objects several times
+    faster. Used by default when orjson is installed.
+    """
+
+    name = 'orjson'
+
+    def encode(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Compact binary encoding through msgpack, sent in length-prefixed
+    frames. Available when msgpack is installed.
+    """
+
+    name = 'msgpack'
+    framed = True
 
-def extract_json(json_msg: str) -> DataTuple:
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f'Invalid msgpack data: {e}') from e
+
+
+def _pack_binary(obj, write) -> None:
+    """
+    Writes the BinaryCodec encoding of obj: a one byte tag, followed by
+    the big-endian value, or by a size and the items for str, list and
+    dict.
+    """
+    if obj is None:
+        write(b'N')
+    elif obj is True:
+        write(b'T')
+    elif obj is False:
+        write(b'F')
+    elif isinstance(obj, int):
+        try:
+            write(b'i' + _BINARY_INT.pack(obj))
+        except struct.error:
+            raise ValueError(f'Integer out of range: {obj}') from None
+    elif isinstance(obj, float):
+        write(b'd' + _BINARY_FLOAT.pack(obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        write(b's' + FRAME_HEADER.pack(len(data)))
+        write(data)
+    elif isinstance(obj, (list, tuple)):
+        write(b'l' + FRAME_HEADER.pack(len(obj)))
+        for item in obj:
+            _pack_binary(item, write)
+    elif isinstance(obj, dict):
+        write(b'm' + FRAME_HEADER.pack(len(obj)))
+        for key, value in obj.items():
+            _pack_binary(key, write)
+            _pack_binary(value, write)
+    else:
+        raise TypeError(
+            f'Object of type {type(obj).__name__} cannot be encoded'
+            )
+
+
+def _unpack_binary(data, pos: int) -> tuple:
+    """
+    Reads the BinaryCodec value starting at pos.
+
+    Returns:
+        tuple: The value and the position after it.
+    """
+    tag = data[pos]
+    pos += 1
+    if tag == 0x4e:  # N
+        return None, pos
+    if tag == 0x54:  # T
+        return True, pos
+    if tag == 0x46:  # F
+        return False, pos
+    if tag == 0x69:  # i
+        return _BINARY_INT.unpack_from(data, pos)[0], pos + 8
+    if tag == 0x64:  # d
+        return _BINARY_FLOAT.unpack_from(data, pos)[0], pos + 8
+    size = FRAME_HEADER.unpack_from(data, pos)[0]
+    pos += 4
+    if tag == 0x73:  # s
+        end = pos + size
+        if end > len(data):
+            raise ValueError('Invalid binary data: truncated string')
+        return str(data[pos:end], 'utf-8'), end
+    if tag == 0x6c:  # l
+        items = []
+        for _ in range(size):
+            item, pos = _unpack_binary(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == 0x6d:  # m
+        obj = {}
+        for _ in range(size):
+            key, pos = _unpack_binary(data, pos)
+            obj[key], pos = _unpack_binary(data, pos)
+        return obj, pos
+    raise ValueError(f'Invalid binary data: unknown type tag {tag}')
+
+
+class BinaryCodec(Codec):
+    """
+    Compact binary encoding that needs only the standard library, sent in
+    length-prefixed frames. Strings are sent as their UTF-8 bytes without
+    escaping and numbers as fixed size big-endian values, so it is always
+    available, unlike msgpack.
+    """
+
+    name = 'binary'
+    framed = True
+
+    def encode(self, obj) -> bytes:
+        parts = []
+        try:
+            _pack_binary(obj, parts.append)
+        except RecursionError:
+            raise ValueError('Object nested too deeply') from None
+        return b''.join(parts)
+
+    def decode(self, data):
+        try:
+            obj, end = _unpack_binary(data, 0)
+        except (struct.error, IndexError, TypeError, RecursionError) as e:
+            raise ValueError(f'Invalid binary data: {e}') from e
+        if end != len(data):
+            raise ValueError('Invalid binary data: trailing bytes')
+        return obj
+
+
+CODECS = {}
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Makes a codec available to get_codec and to join negotiation.
+
+    Args:
+        codec (Codec): The codec, registered under codec.name.
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(name: str = None) -> Codec:
+    """
+    Looks up a registered codec.
+
+    Args:
+        name (str, optional): The name of the codec. Defaults to None,
+          the default JSON codec.
+
+    Returns:
+        Codec: The codec.
+
+    Raises:
+        ValueError: If no codec is registered under name.
+    """
+    if name is None:
+        return DEFAULT_CODEC
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unknown codec: {name}') from None
+
+
+register_codec(JsonCodec())
+register_codec(BinaryCodec())
+if orjson is not None:
+    register_codec(OrjsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+# orjson reads and writes the same JSON, so it replaces the standard
+# library codec wherever no codec was negotiated.
+DEFAULT_CODEC = CODECS.get('orjson', CODECS['json'])
+
+
+def _encode(obj, codec: Codec = None) -> str | bytes:
+    """
+    Encodes a protocol object as a JSON string, or as bytes with codec.
+    """
+    if codec is None:
+        return DEFAULT_CODEC.dumps(obj)
+    return codec.encode(obj)
+
+
+def _decode(data, codec: Codec = None):
+    """
+    Decodes a protocol object with codec, or the default JSON codec.
+    Objects already decoded, for example by a FrameDecoder, are returned
+    as they are.
+    """
+    if isinstance(data, dict):
+        return data
+    return (codec or DEFAULT_CODEC).decode(data)
+
+
+def encode_frame(data: bytes, codec: Codec = None) -> bytes:
+    """
+    Wraps an encoded object for sending with codec: a line for line
+    codecs, a length-prefixed frame for framed codecs.
+
+    Args:
+        data (bytes): The encoded object.
+        codec (Codec, optional): The codec of the connection.
+          Defaults to None, the default JSON codec.
+
+    Returns:
+        bytes: The bytes to send.
+    """
+    if codec is not None and codec.framed:
+        return FRAME_HEADER.pack(len(data)) + data
+    return data + b'\r\n'
+
+
+def select_codec(names) -> Codec:
+    """
+    Picks the codec a server uses for a connection from the names the
+    client asked for at join, in the client's order of preference.
+
+    Args:
+        names: A codec name or a list of names.
+
+    Returns:
+        Codec: The first registered codec, or None if none is registered.
+    """
+    if isinstance(names, str):
+        names = [names]
+    if not isinstance(names, list):
+        return None
+    for name in names:
+        if isinstance(name, str) and name in CODECS:
+            return CODECS[name]
+    return None
+
+
+class FrameTooLongError(ValueError):
+    """
+    Raised by FrameDecoder when a frame grows past its max_size.
+    """
+
+
+class FrameDecoder:
+    """
+    Splits the bytes received on a connection into frames and decodes
+    them with the codec of the connection.
+
+    Data is appended to one buffer and frames are consumed by moving an
+    offset, so each received byte is copied into the buffer once and out
+    of it once, and the consumed part is dropped once per feed() instead
+    of once per frame.
+
+    Line codecs frame objects with line breaks; blank lines are skipped.
+    Framed codecs frame them with a FRAME_HEADER. Assigning codec switches
+    the framing of everything not yielded yet, which is how a connection
+    moves to the codec negotiated at join.
+    """
+
+    def __init__(self, codec: Codec = None, max_size: int = 1024 * 1024):
+        """
+        Initializes a FrameDecoder.
+
+        Args:
+            codec (Codec, optional): The codec of the connection.
+              Defaults to None, the default JSON codec.
+            max_size (int, optional): Size in bytes of the largest frame
+              accepted. Defaults to 1 MiB.
+        """
+        self.codec = codec or DEFAULT_CODEC
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._start = 0
+        self._scanned = 0
+
+    def __len__(self) -> int:
+        """
+        Returns the number of bytes received but not yielded yet.
+        """
+        return len(self._buffer) - self._start
+
+    def feed(self, data: bytes = b''):
+        """
+        Adds bytes received from the connection and yields every object
+        they complete. Frames not consumed because the caller stopped
+        iterating are yielded by the next call.
+
+        Args:
+            data (bytes, optional): The received bytes. Defaults to b'',
+              to only yield the frames already buffered.
+
+        Yields:
+            The decoded objects, in order. A frame the codec cannot decode
+            is yielded as None, so the reader can answer it and carry on.
+
+        Raises:
+            FrameTooLongError: If a frame is larger than max_size.
+        """
+        self._buffer += data
+        try:
+            while True:
+                frame = self._next_frame()
+                if frame is None:
+                    return
+                try:
+                    obj = self.codec.decode(frame)
+                except ValueError:
+                    obj = None
+                yield obj
+        finally:
+            self._compact()
+
+    def _next_frame(self) -> bytearray:
+        """
+        Consumes the next complete frame.
+
+        Returns:
+            bytearray: The payload of the frame, or None if no complete
+            frame is buffered.
+        """
+        buffer = self._buffer
+        while True:
+            start = self._start
+            if self.codec.framed:
+                if len(buffer) - start < FRAME_HEADER.size:
+                    return None
+                size, = FRAME_HEADER.unpack_from(buffer, start)
+                if size > self.max_size:
+                    raise FrameTooLongError(f'Frame of {size} bytes')
+                end = start + FRAME_HEADER.size + size
+                if len(buffer) < end:
+                    return None
+                self._start = end
+                return buffer[start + FRAME_HEADER.size:end]
+            newline = buffer.find(b'\n', max(start, self._scanned))
+            if newline == -1:
+                if len(buffer) - start > self.max_size:
+                    raise FrameTooLongError('Line too long')
+                self._scanned = len(buffer)
+                return None
+            end = newline
+            if end > start and buffer[end - 1] == 13:
+                end -= 1
+            if end - start > self.max_size:
+                raise FrameTooLongError('Line too long')
+            self._start = newline + 1
+            frame = buffer[start:end]
+            if frame and not frame.isspace():
+                return frame
+
+    def _compact(self) -> None:
+        """
+        Drops the consumed part of the buffer.
+        """
+        if self._start:
+            del self._buffer[:self._start]
+            self._scanned = max(0, self._scanned - self._start)
+            self._start = 0
+
+    def line_chunks(self, recv, size: int = 65536):
+        """
+        Yields the next line as it is received, in chunks, without
+        holding the whole line in memory, for parsing it incrementally.
+        Bytes received after the line stay buffered.
+
+        Args:
+            recv: A function reading up to size bytes from the connection,
+              returning b'' when it is closed.
+            size (int, optional): The most bytes read at once.
+              Defaults to 65536.
+
+        Yields:
+            bytes: The chunks of the line, the last one ending with its
+            line break.
+
+        Raises:
+            EOFError: If the connection closes before the line ends.
+        """
+        while True:
+            buffer = self._buffer
+            newline = buffer.find(b'\n', self._start)
+            if newline != -1:
+                chunk = bytes(buffer[self._start:newline + 1])
+                self._start = newline + 1
+                self._compact()
+                yield chunk
+                return
+            if len(buffer) > self._start:
+                chunk = bytes(buffer[self._start:])
+                buffer.clear()
+                self._start = 0
+                self._scanned = 0
+                yield chunk
+            data = recv(size)
+            if not data:
+                raise EOFError('Connection closed in the middle of a line')
+            self._buffer += data
+
+
+def extract_codec(json_msg: str) -> str:
+    """
+    Takes the JSON response to a join command and extracts the codec the
+    server switched the connection to.
+
+    Args:
+        json_msg (str):
+          A string representing the JSON message to be parsed.
+
+    Returns:
+        str: The name of the codec, or None if the connection stays on
+        the default JSON codec.
+    """
+    try:
+        json_obj = _decode(json_msg)
+        return json_obj['response'].get('codec')
+
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def extract_json(json_msg: str, codec: Codec = None) -> DataTuple:
     """
     Takes a JSON string and converts it to a DataTuple object containing
     the type, message, and token extracted from the JSON message.
 
     Args:
         json_msg (str): A string representing the JSON message to be parsed.
+        codec (Codec, optional):
+          The codec the message is encoded with. Defaults to None,
+          the default JSON codec.
 
     Returns:
         DataTuple: A namedtuple containing the parsed values
@@ -30,7 +538,7 @@ def extract_json(json_msg: str) -> DataTuple:
                   Returns None if JSON cannot be decoded.
     """
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = _decode(json_msg, codec)
         response_type = json_obj['response']['type']
         message = json_obj['response']['message']
         if response_type == 'ok':
@@ -42,37 +550,47 @@ def extract_json(json_msg: str) -> DataTuple:
             token = None
         return DataTuple(response_type, message, token)
 
-    except json.JSONDecodeError:
+    except (ValueError, TypeError):
         print("JSON cannot be decoded.")
         return None
 
 
-def format_join_msg(username: str, password: str) -> str:
+def format_join_msg(username: str, password: str, codec: Codec = None,
+                    accept: list = None) -> str | bytes:
     """
-    Creates a formatted JSON string
+    Creates a formatted request
     to join a session with provided credentials.
 
     Args:
         username (str): The username of the user.
         password (str): The password of the user.
+        accept (list, optional):
+          Names of codecs to switch the connection to after joining, in
+          order of preference. Defaults to None, staying on JSON.
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
 
     Returns:
-        str: A JSON string representing the join request.
+        str | bytes: The join request, as a JSON string, or as
+        bytes encoded with codec.
     """
-    return json.dumps({
-        "join": {
-            "username": username,
-            "password": password,
-            "token": ""
-        }
-    })
+    join = {
+        "username": username,
+        "password": password,
+        "token": ""
+    }
+    if accept:
+        join["codec"] = list(accept)
+    return _encode({"join": join}, codec)
 
 
 def format_direct_msg(
-        token: str, direct_msg: str, recipient: str, timestamp: str = ''
-        ) -> str:
+        token: str, direct_msg: str, recipient: str, timestamp: str = '',
+        message_id: str = None, codec: Codec = None
+        ) -> str | bytes:
     """
-    Creates a formatted JSON string to send a direct message with the provided
+    Creates a formatted request to send a direct message with the provided
     token, message, recipient, and timestamp.
 
     Args:
@@ -83,27 +601,40 @@ def format_direct_msg(
           The recipient of the message.
         timestamp (str, optional):
           The timestamp of the message. Defaults to ''.
+        message_id (str, optional):
+          A unique id the server uses to drop retried copies of the
+          message. Defaults to None.
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
 
     Returns:
-        str: A JSON string representing the direct message request.
+        str | bytes: The direct message request, as a JSON string, or as
+        bytes encoded with codec.
     """
-    return json.dumps({
+    direct_message = {
+        "entry": direct_msg,
+        "recipient": recipient,
+        "timestamp": timestamp
+    }
+    if message_id is not None:
+        direct_message["id"] = message_id
+    return _encode({
         "token": token,
-        "directmessage": {
-            "entry": direct_msg,
-            "recipient": recipient,
-            "timestamp": timestamp
-        }
-    })
+        "directmessage": direct_message
+    }, codec)
 
 
-def extract_direct_message(json_msg: str) -> list:
+def extract_direct_message(json_msg: str, codec: Codec = None) -> list:
     """
     Takes a JSON string and extracts direct messages from it.
 
     Args:
         json_msg (str):
           A string representing the JSON message to be parsed.
+        codec (Codec, optional):
+          The codec the message is encoded with. Defaults to None,
+          the default JSON codec.
 
     Returns:
         list: A list of messages.
@@ -111,14 +642,14 @@ def extract_direct_message(json_msg: str) -> list:
         or is invalid.
     """
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = _decode(json_msg, codec)
         response_type = json_obj['response']['type']
         messages = json_obj['response'].get('messages', [])
         if response_type == 'ok' and messages:
             return messages
         return []
 
-    except json.JSONDecodeError:
+    except ValueError:
         print("JSON cannot be decoded.")
         return []
     except KeyError as key_error:
@@ -126,18 +657,357 @@ def extract_direct_message(json_msg: str) -> list:
         return []
 
 
-def format_msg_request(token: str, message_type: str) -> str:
+class _ChunkReader:
     """
-    Creates a formatted JSON string to request messages of a specific type.
+    Reads JSON values from an iterable of text chunks, keeping only the
+    unread part of the text in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _read(self, size: int = 0) -> bool:
+        """
+        Drops the text already read and appends chunks until at least
+        size characters are unread.
+
+        Returns:
+            bool: False if the chunks ran out before anything was added.
+        """
+        buffer = [self._buffer[self._pos:]]
+        unread = len(buffer[0])
+        added = False
+        while not added or unread < size:
+            chunk = next(self._chunks, '')
+            if not chunk:
+                break
+            buffer.append(chunk)
+            unread += len(chunk)
+            added = True
+        self._buffer = ''.join(buffer)
+        self._pos = 0
+        return added
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or '' at the end.
+        """
+        while True:
+            while (self._pos < len(self._buffer)
+                   and self._buffer[self._pos] in ' \t\r\n'):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return ''
+
+    def take(self, expected: str) -> None:
+        """
+        Consumes the next character, which must be expected.
+
+        Raises:
+            json.JSONDecodeError: If the next character is different.
+        """
+        if self.peek() != expected:
+            raise json.JSONDecodeError(
+                f'Expecting {expected!r}', self._buffer, self._pos
+                )
+        self._pos += 1
+
+    def value(self):
+        """
+        Decodes the next complete JSON value.
+
+        Raises:
+            json.JSONDecodeError: If the text is not valid JSON.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number at the very end of the buffer may continue in
+                # the next chunk.
+                if end < len(self._buffer):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            # Doubling the unread text keeps re-parsing a value that spans
+            # many chunks linear in its length.
+            if not self._read(2 * (len(self._buffer) - self._pos)):
+                value, self._pos = self._decoder.raw_decode(
+                    self._buffer, self._pos
+                    )
+                return value
+
+
+def _iter_response_messages(reader: _ChunkReader):
+    """
+    Reads a response object and yields its messages if it is ok.
+    """
+    response_type = None
+    reader.take('{')
+    while reader.peek() != '}':
+        key = reader.value()
+        reader.take(':')
+        if key == 'messages' and response_type == 'ok' \
+                and reader.peek() == '[':
+            reader.take('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                if reader.peek() == ',':
+                    reader.take(',')
+            reader.take(']')
+        else:
+            value = reader.value()
+            if key == 'type':
+                response_type = value
+        if reader.peek() == ',':
+            reader.take(',')
+    reader.take('}')
+
+
+def iter_direct_messages(chunks):
+    """
+    Incrementally parses a direct message response received in chunks
+    and yields its messages one at a time, so neither the response nor
+    the list of messages is ever held in memory as a whole.
+
+    Args:
+        chunks:
+          An iterable of strings which together form the JSON response.
+
+    Yields:
+        dict: The messages, if the response type is 'ok'.
+        Stops early if the JSON cannot be decoded.
+    """
+    reader = _ChunkReader(chunks)
+    try:
+        reader.take('{')
+        while reader.peek() != '}':
+            key = reader.value()
+            reader.take(':')
+            if key == 'response':
+                yield from _iter_response_messages(reader)
+            else:
+                reader.value()
+            if reader.peek() == ',':
+                reader.take(',')
+
+    except json.JSONDecodeError:
+        print("JSON cannot be decoded.")
+
+
+def format_msg_request(token: str, message_type: str,
+                       codec: Codec = None) -> str | bytes:
+    """
+    Creates a formatted request for messages of a specific type.
 
     Args:
         token (str): The authentication token.
         message_type (str): The type of messages to request ('new' or 'all').
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
 
     Returns:
-        str: A JSON string representing the message request.
+        str | bytes: The message request, as a JSON string, or as
+        bytes encoded with codec.
     """
-    return json.dumps({
+    return _encode({
         "token": token,
         "directmessage": message_type
-    })
+    }, codec)
+
+
+def format_history_request(token: str, since: int = None,
+                           limit: int = 100,
+                           codec: Codec = None) -> str | bytes:
+    """
+    Creates a formatted request for one page of the message history
+    after a cursor.
+
+    Args:
+        token (str): The authentication token.
+        since (int, optional):
+          The cursor returned with the previous page.
+          Defaults to None, the start of the history.
+        limit (int, optional):
+          The largest number of messages to return. Defaults to 100.
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
+
+    Returns:
+        str | bytes: The history request, as a JSON string, or as
+        bytes encoded with codec.
+    """
+    return _encode({
+        "token": token,
+        "directmessage": {
+            "since": since,
+            "limit": limit
+        }
+    }, codec)
+
+
+def extract_history_page(json_msg: str, codec: Codec = None) -> tuple:
+    """
+    Takes a JSON string and extracts one page of the message history.
+
+    Args:
+        json_msg (str):
+          A string representing the JSON message to be parsed.
+        codec (Codec, optional):
+          The codec the message is encoded with. Defaults to None,
+          the default JSON codec.
+
+    Returns:
+        tuple: The list of messages and the cursor to request the next page
+        with. Returns an empty list and None if JSON cannot be decoded
+        or is invalid.
+    """
+    try:
+        json_obj = _decode(json_msg, codec)
+        response_type = json_obj['response']['type']
+        if response_type != 'ok':
+            return [], None
+        return (json_obj['response']['messages'],
+                json_obj['response']['cursor'])
+
+    except ValueError:
+        print("JSON cannot be decoded.")
+        return [], None
+    except KeyError as key_error:
+        print(f"ERROR: Missing key in JSON - {key_error}")
+        return [], None
+
+
+def format_subscribe_msg(token: str, subscribe: bool = True,
+                         codec: Codec = None) -> str | bytes:
+    """
+    Creates a formatted request to subscribe the connection to
+    direct messages pushed by the server, or to unsubscribe it.
+
+    Args:
+        token (str): The authentication token.
+        subscribe (bool, optional):
+          False to unsubscribe instead. Defaults to True.
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
+
+    Returns:
+        str | bytes: The subscribe request, as a JSON string, or as
+        bytes encoded with codec.
+    """
+    return _encode({
+        "token": token,
+        "subscribe": subscribe
+    }, codec)
+
+
+def extract_pushed_messages(json_msg: str, codec: Codec = None) -> list:
+    """
+    Takes a JSON string and extracts the messages of a directmessage event
+    pushed by the server.
+
+    Args:
+        json_msg (str):
+          A string representing the JSON message to be parsed.
+        codec (Codec, optional):
+          The codec the message is encoded with. Defaults to None,
+          the default JSON codec.
+
+    Returns:
+        list: A list of messages.
+        Returns None if the JSON is not a directmessage event,
+        for example a response to a command.
+    """
+    try:
+        json_obj = _decode(json_msg, codec)
+        event = json_obj['event']
+        if event['type'] != 'directmessage':
+            return None
+        return event['messages']
+
+    except ValueError:
+        print("JSON cannot be decoded.")
+        return None
+    except (KeyError, TypeError):
+        return None
+
+
+def format_direct_msgs(token: str, messages: list,
+                       timestamp: str = '', message_ids: list = None,
+                       codec: Codec = None) -> str | bytes:
+    """
+    Creates a formatted request to send several direct messages in
+    one request.
+
+    Args:
+        token (str): The authentication token.
+        messages (list):
+          (recipient, message) pairs.
+        timestamp (str, optional):
+          The timestamp of the messages. Defaults to ''.
+        message_ids (list, optional):
+          A unique id for each message, used by the server to drop
+          retried copies. Defaults to None.
+        codec (Codec, optional):
+          The codec to encode the request with, which returns bytes.
+          Defaults to None, a JSON string.
+
+    Returns:
+        str | bytes: The batch direct message request, as a JSON string,
+        or as bytes encoded with codec.
+    """
+    direct_messages = [
+        {
+            "entry": direct_msg,
+            "recipient": recipient,
+            "timestamp": timestamp
+        }
+        for recipient, direct_msg in messages
+    ]
+    if message_ids is not None:
+        for direct_message, message_id in zip(direct_messages, message_ids):
+            direct_message["id"] = message_id
+    return _encode({
+        "token": token,
+        "directmessages": direct_messages
+    }, codec)
+
+
+def extract_batch_results(json_msg: str, codec: Codec = None) -> list:
+    """
+    Takes a JSON string and extracts the status of every message of a
+    batch direct message request.
+
+    Args:
+        json_msg (str):
+          A string representing the JSON message to be parsed.
+        codec (Codec, optional):
+          The codec the message is encoded with. Defaults to None,
+          the default JSON codec.
+
+    Returns:
+        list: 'ok' or 'error' for every message, in request order.
+        Returns an empty list if JSON cannot be decoded
+        or the request failed as a whole.
+    """
+    try:
+        json_obj = _decode(json_msg, codec)
+        if json_obj['response']['type'] != 'ok':
+            return []
+        return json_obj['response']['results']
+
+    except ValueError:
+        print("JSON cannot be decoded.")
+        return []
+    except KeyError as key_error:
+        print(f"ERROR: Missing key in JSON - {key_error}")
+        return []
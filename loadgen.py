@@ -0,0 +1,297 @@
+"""
+loadgen.py
+
+This module load tests the DSU server end to end. It starts a DSUServer
+(or an AsyncDSUServer) on an ephemeral port with a temporary store, then
+drives a number of simulated DirectMessenger clients, each in its own
+thread, through a configurable mix of commands:
+
+    join  - disconnect and join again on a fresh connection
+    send  - send a direct message to another simulated user
+    new   - retrieve_new
+    all   - retrieve_all
+
+When the run ends, it reports the throughput, the p50/p95/p99 latency
+and the error count of every command, and the size of the store files
+sampled over time.
+
+Usage:
+    python loadgen.py --clients 50 --duration 30 --mix send=6,new=3,all=1
+    python loadgen.py --storage sqlite --asyncio --codec binary
+
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+import threading
+import time
+import server
+from ds_messenger import DirectMessenger
+from server_store import STORES, create_store
+
+COMMANDS = ('join', 'send', 'new', 'all')
+DEFAULT_MIX = 'join=1,send=6,new=2,all=1'
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parses a command mix such as 'send=6,new=3,all=1'.
+
+    Args:
+        mix (str): Comma separated command=weight pairs.
+
+    Returns:
+        dict: The relative weight of every command with a positive weight.
+
+    Raises:
+        ValueError: If a command is unknown or a weight is not a number.
+    """
+    weights = {}
+    for pair in mix.split(','):
+        command, _, weight = pair.partition('=')
+        command = command.strip()
+        if command not in COMMANDS:
+            raise ValueError(f'Unknown command: {command}')
+        weights[command] = float(weight or 1)
+    weights = {command: w for command, w in weights.items() if w > 0}
+    if not weights:
+        raise ValueError('The mix has no command with a positive weight')
+    return weights
+
+
+def percentile(latencies: list, pct: float) -> float:
+    """
+    Returns the nearest-rank percentile of sorted latencies.
+    """
+    if not latencies:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+def store_size(store_dir: str) -> int:
+    """
+    Returns the total size of the files in the store directory in bytes.
+    """
+    total = 0
+    for root, _, files in os.walk(store_dir):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Replaced by an atomic rewrite while walking.
+                pass
+    return total
+
+
+class Client(threading.Thread):
+    """
+    A simulated user running random commands until the deadline.
+
+    Latencies in seconds are collected per command in latencies, failed
+    commands are counted in errors.
+    """
+
+    def __init__(self, index: int, users: list, port: int, weights: dict,
+                 deadline: float, message: str, codecs: list = None,
+                 seed: int = None):
+        super().__init__(daemon=True)
+        self.username = users[index]
+        self.peers = [user for user in users if user != self.username]
+        self.messenger = DirectMessenger(
+            '127.0.0.1', self.username, 'password', codecs
+            )
+        self.messenger.port = port
+        self.commands = list(weights)
+        self.weights = list(weights.values())
+        self.deadline = deadline
+        self.message = message
+        self.random = random.Random(None if seed is None else seed + index)
+        self.latencies = {command: [] for command in COMMANDS}
+        self.errors = {command: 0 for command in COMMANDS}
+
+    def _run_command(self, command: str) -> bool:
+        """
+        Runs one command.
+
+        Returns:
+            bool: True if the command succeeded.
+        """
+        messenger = self.messenger
+        if command == 'join':
+            messenger.close()
+            with messenger._lock:
+                return messenger._connect()
+        if command == 'send':
+            recipient = self.random.choice(self.peers or [self.username])
+            return messenger.send(self.message, recipient)
+        if command == 'new':
+            messenger.retrieve_new()
+        else:
+            messenger.retrieve_all()
+        # Retrieving reports failures by returning no messages, but a
+        # failed request always leaves the messenger without a session.
+        return messenger.token is not None
+
+    def run(self) -> None:
+        with self.messenger:
+            while time.perf_counter() < self.deadline:
+                command = self.random.choices(self.commands, self.weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = self._run_command(command)
+                except (OSError, ValueError):
+                    ok = False
+                self.latencies[command].append(time.perf_counter() - start)
+                if not ok:
+                    self.errors[command] += 1
+
+
+def run(clients: int = 10, duration: float = 10.0, mix: str = DEFAULT_MIX,
+        storage: str = 'json', use_asyncio: bool = False, codecs: list = None,
+        message_size: int = 64, interval: float = 1.0,
+        seed: int = None) -> dict:
+    """
+    Starts a server with a temporary store and runs the clients against it.
+
+    Args:
+        clients (int): Number of simulated clients. Defaults to 10.
+        duration (float): Seconds to run the clients for. Defaults to 10.
+        mix (str): Relative weights of the commands, see parse_mix.
+        storage (str): The server storage backend. Defaults to 'json'.
+        use_asyncio (bool): Run AsyncDSUServer instead of DSUServer.
+        codecs (list, optional): Codecs the clients ask for at join.
+        message_size (int): Length of every sent message. Defaults to 64.
+        interval (float): Seconds between store size samples.
+        seed (int, optional): Seed making the command sequences repeatable.
+
+    Returns:
+        dict: The report, see print_report.
+    """
+    weights = parse_mix(mix)
+    server.DEBUG = False
+    with tempfile.TemporaryDirectory(prefix='dsu-loadgen-') as store_dir:
+        store = create_store(storage, store_dir)
+        if use_asyncio:
+            dsu_server = server.AsyncDSUServer('127.0.0.1', 0, store)
+        else:
+            dsu_server = server.DSUServer(
+                '127.0.0.1', 0, store, backlog=clients
+                )
+        server_thread = threading.Thread(
+            target=dsu_server.start_server, daemon=True
+            )
+        server_thread.start()
+        if not dsu_server.ready.wait(10):
+            raise RuntimeError('The server did not start')
+
+        users = [f'load{i}' for i in range(clients)]
+        # Messages can only be sent to users who have joined before.
+        for user in users:
+            store.get_or_create_user(user, 'password')
+        message = 'x' * message_size
+        sizes = []
+        # The clients print every request; keep the report readable.
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            deadline = start + duration
+            threads = [
+                Client(i, users, dsu_server.port, weights, deadline,
+                       message, codecs, seed)
+                for i in range(clients)
+            ]
+            for thread in threads:
+                thread.start()
+            now = start
+            while now < deadline:
+                sizes.append((now - start, store_size(store_dir)))
+                time.sleep(min(interval, deadline - now))
+                now = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            dsu_server.shutdown()
+            server_thread.join(10)
+        sizes.append((elapsed, store_size(store_dir)))
+
+    report = {'clients': clients, 'elapsed': elapsed, 'commands': {},
+              'store_size': sizes}
+    for command in COMMANDS:
+        latencies = sorted(latency for thread in threads
+                           for latency in thread.latencies[command])
+        if not latencies:
+            continue
+        report['commands'][command] = {
+            'count': len(latencies),
+            'errors': sum(thread.errors[command] for thread in threads),
+            'ops': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+    return report
+
+
+def print_report(report: dict) -> None:
+    """
+    Prints a report returned by run.
+    """
+    commands = report['commands']
+    total = sum(stats['count'] for stats in commands.values())
+    errors = sum(stats['errors'] for stats in commands.values())
+    print(f"{report['clients']} clients, {report['elapsed']:.1f} s, "
+          f"{total} commands ({total / report['elapsed']:,.1f}/s), "
+          f"{errors} errors")
+    print(f"{'command':>8} {'count':>8} {'errors':>7} {'ops/s':>10} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for command, stats in commands.items():
+        print(f"{command:>8} {stats['count']:>8} {stats['errors']:>7} "
+              f"{stats['ops']:>10,.1f} {stats['p50'] * 1000:>9.2f} "
+              f"{stats['p95'] * 1000:>9.2f} {stats['p99'] * 1000:>9.2f}")
+    print('store size:')
+    for elapsed, size in report['store_size']:
+        print(f'{elapsed:8.1f} s {size / 1024:12,.1f} KiB')
+
+
+def main() -> None:
+    """
+    Parses the arguments, runs the load test and prints the report.
+    """
+    parser = argparse.ArgumentParser(description='DSU server load generator')
+    parser.add_argument('--clients', type=int, default=10,
+                        help='number of simulated clients (default: 10)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run for (default: 10)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='relative weights of the commands '
+                             f'(default: {DEFAULT_MIX})')
+    parser.add_argument('--storage', choices=sorted(STORES), default='json',
+                        help='server storage backend (default: json)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the asyncio server')
+    parser.add_argument('--codec', action='append',
+                        help='codec the clients ask for at join, repeatable')
+    parser.add_argument('--message-size', type=int, default=64,
+                        help='length of the sent messages (default: 64)')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between store size samples '
+                             '(default: 1)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for repeatable command sequences')
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print_report(run(args.clients, args.duration, args.mix, args.storage,
+                     args.asyncio, args.codec, args.message_size,
+                     args.interval, args.seed))
+
+
+if __name__ == '__main__':
+    main()
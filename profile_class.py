@@ -6,12 +6,57 @@ which are used to manage user profiles
 and posts for a Distributed Social Universe (DSU) server.
 It includes functionality for
 saving and loading profiles, managing posts, and handling exceptions.
+
+A .dsu file is a log of JSON lines. The first line is a header holding
+the profile fields, {"dsu_format": 2, "dsuserver":, "username":,
+"password":, "bio":}. Every following line is a record of one change,
+{"op": <op>, "data": <data>}, where op is one of:
+
+    message   - data is a message dict appended to messages
+    friend    - data is a username appended to friends
+    post      - data is {"entry":, "timestamp":} appended to posts
+    profile   - data holds header fields that changed
+
+Saving appends the changes made since the last save, so it costs time
+proportional to the changes rather than to the whole profile, until the
+appended records grow large enough that saving compacts the file. compact()
+rewrites the file as a header, which then also holds the friends and an
+index of the blocks that follow, a block of post records, and a block of
+message records for every conversation. A lazily loaded profile reads
+the header and the records appended after the blocks, and a block only
+when its posts or conversation are used. Files written before this
+format, a single JSON object, are still loaded and are compacted to the
+new format on their next save.
+
+ProfileWriter saves a profile from a background thread, collecting the
+changes made within a short delay into one save.
+
+SqliteProfile keeps a profile in a SQLite database file instead, with
+messages indexed by recipient and timestamp, for profiles too large for
+the JSON log. import_dsu converts a JSON .dsu file to one, and
+open_profile loads a .dsu file of either kind.
 """
 
+import atexit
 import json
+import os
+import sqlite3
+import threading
 import time
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 
+FORMAT_VERSION = 2
+
+# Profile fields stored in the header of a .dsu file.
+HEADER_FIELDS = ('dsuserver', 'username', 'password', 'bio')
+
+# A save compacts the file once the records appended after its blocks
+# take COMPACT_TAIL_SIZE bytes and at least 1/COMPACT_TAIL_RATIO of the
+# blocks, so lazy loads read little and rewrites stay rare as it grows.
+COMPACT_TAIL_SIZE = 1024 * 1024
+COMPACT_TAIL_RATIO = 10
+
 
 class DsuFileError(Exception):
     """
@@ -100,6 +145,115 @@ class Post(dict):
     timestamp = property(get_time, set_time)
 
 
+def _timestamp_key(message: dict) -> float:
+    """
+    Returns the timestamp of a message as a float, or 0.0 if it has none.
+    """
+    try:
+        return float(message['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+class Conversation:
+    """
+    The messages exchanged with one recipient, ordered by timestamp.
+    Messages with the same timestamp keep the order they were added in.
+    """
+
+    __slots__ = ('times', 'messages')
+
+    def __init__(self):
+        self.times = []
+        self.messages = []
+
+    def add(self, message: dict) -> None:
+        """
+        Add a message, in time order.
+
+        Args:
+            message (dict): The message to add.
+        """
+        key = _timestamp_key(message)
+        if not self.times or key >= self.times[-1]:
+            self.times.append(key)
+            self.messages.append(message)
+        else:
+            index = bisect_right(self.times, key)
+            self.times.insert(index, key)
+            self.messages.insert(index, message)
+
+    def last(self, count: int) -> list[dict]:
+        """
+        Get the latest messages.
+
+        Args:
+            count (int): How many messages to return.
+
+        Returns:
+            list[dict]: Up to count messages, oldest first.
+        """
+        if count <= 0:
+            return []
+        return self.messages[-count:]
+
+    def between(self, start: float = None, end: float = None) -> list[dict]:
+        """
+        Get the messages with a timestamp in a range.
+
+        Args:
+            start (float, optional): The earliest timestamp included.
+                Defaults to None, no lower bound.
+            end (float, optional): The latest timestamp included.
+                Defaults to None, no upper bound.
+
+        Returns:
+            list[dict]: The messages in the range, oldest first.
+        """
+        low = 0 if start is None else bisect_left(self.times, start)
+        high = len(self.times) if end is None else bisect_right(
+            self.times, end)
+        return self.messages[low:high]
+
+
+class _LazyBody:
+    """
+    The blocks of a compacted DSU file that a lazily loaded profile has
+    not read yet. Blocks are [offset, length] in bytes, counted from the
+    end of the header line.
+    """
+
+    __slots__ = ('path', 'header', 'posts', 'conversations', 'loaded')
+
+    def __init__(self, path: Path, header: bytes, index: dict):
+        self.path = path
+        # The header line, to notice a file rewritten since it was read.
+        self.header = header
+        # None once the posts are read.
+        self.posts = index.get('posts')
+        self.conversations = dict(index.get('conversations', {}))
+        # recipient -> the messages read from its block
+        self.loaded = {}
+
+    def read(self, block: list) -> list:
+        """
+        Returns the data of the records in a block.
+
+        Raises:
+            DsuProfileError: If the file was rewritten since it was loaded.
+        """
+        offset, length = block
+        with open(self.path, 'rb') as f:
+            if f.read(len(self.header)) != self.header:
+                raise DsuProfileError(
+                    'The DSU file was rewritten since it was loaded'
+                    )
+            f.seek(len(self.header) + offset)
+            data = f.read(length)
+        return [json.loads(line)['data']
+                for line in data.split(b'\n') if line.strip()]
+
+
 class Profile:
     """
     The Profile class manages user profiles
@@ -127,7 +281,50 @@ class Profile:
         self.bio = ''  # OPTIONAL
         self._posts = []  # OPTIONAL
         self.friends = []
-        self.messages = []
+        self._messages = []
+        # recipient -> Conversation, so a conversation is read without
+        # scanning every message. Kept up to date by add_message.
+        self._conversations = {}
+        # The unread blocks of the file of a lazily loaded profile. Its
+        # messages are then only those appended after the blocks.
+        self._lazy = None
+        # Whether the profile was loaded lazily, so compacting leaves the
+        # messages it wrote to blocks unread again.
+        self._lazy_loaded = False
+        # Guards messages and conversations against a lazy load reading
+        # blocks on the writer thread while messages are added.
+        self._index_lock = threading.Lock()
+        # What the file at _saved_path holds, so saving only appends
+        # what changed since. None if the profile was never saved there.
+        self._saved_path = None
+        self._saved_size = 0
+        self._saved_header = None
+        self._saved_counts = None
+        # Bytes of the header and blocks of that file, before the records
+        # appended since it was compacted.
+        self._compacted_size = 0
+        # Bumped when the lists change in a way that can't be appended.
+        self._generation = 0
+        self._save_lock = threading.RLock()
+
+    @property
+    def messages(self) -> list[dict]:
+        """
+        All messages of the profile. For a lazily loaded profile, this
+        reads every conversation that was not read yet.
+        """
+        self._load_body()
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: list[dict]) -> None:
+        with self._save_lock:
+            self._lazy = None
+            self._messages = messages
+            self._index_messages()
+            # The file no longer matches, so the next save compacts.
+            self._generation += 1
+            self._saved_path = None
 
     def add_post(self, post: Post) -> None:
         """
@@ -148,11 +345,15 @@ class Profile:
         Returns:
             bool: True if the post was deleted, False otherwise.
         """
+        self._load_posts()
         try:
             del self._posts[index]
-            return True
         except IndexError:
             return False
+        # Records can't be removed from the log, so the next save compacts.
+        self._generation += 1
+        self._saved_path = None
+        return True
 
     def get_posts(self) -> list[Post]:
         """
@@ -161,6 +362,7 @@ class Profile:
         Returns:
             list[Post]: The list of Post objects.
         """
+        self._load_posts()
         return self._posts
 
     def add_message(self, message: dict) -> None:
@@ -170,7 +372,31 @@ class Profile:
         Args:
             message (dict): The message to add.
         """
-        self.messages.append(message)
+        with self._index_lock:
+            self._messages.append(message)
+            self._index_message(message)
+
+    def _index_message(self, message: dict) -> None:
+        """
+        Add a message to the conversation with its recipient.
+        """
+        recipient = message['recipient']
+        conversation = self._conversations.get(recipient)
+        if conversation is None:
+            if (self._lazy is not None
+                    and recipient in self._lazy.conversations):
+                # Added when the conversation is read.
+                return
+            conversation = self._conversations[recipient] = Conversation()
+        conversation.add(message)
+
+    def _index_messages(self) -> None:
+        """
+        Rebuild the conversations from the messages list.
+        """
+        self._conversations = {}
+        for message in self._messages:
+            self._index_message(message)
 
     def add_friend(self, friend_username: str) -> None:
         """
@@ -182,6 +408,99 @@ class Profile:
         if friend_username not in self.friends:
             self.friends.append(friend_username)
 
+    def _conversation(self, recipient: str) -> Conversation:
+        """
+        Returns the conversation with recipient, reading it from the
+        file if the profile was loaded lazily, or None if there is none.
+
+        Raises:
+            DsuProfileError: If the conversation can't be read.
+        """
+        conversation = self._conversations.get(recipient)
+        if conversation is not None or self._lazy is None:
+            return conversation
+        with self._save_lock:
+            lazy = self._lazy
+            if lazy is None or recipient not in lazy.conversations:
+                return self._conversations.get(recipient)
+            try:
+                body = lazy.read(lazy.conversations[recipient])
+            except (OSError, ValueError, KeyError) as ex:
+                raise DsuProfileError(ex) from ex
+            with self._index_lock:
+                conversation = Conversation()
+                # Blocks are in time order, so this only appends.
+                for message in body:
+                    conversation.add(message)
+                for message in self._messages:
+                    if message['recipient'] == recipient:
+                        conversation.add(message)
+                lazy.loaded[recipient] = body
+                self._conversations[recipient] = conversation
+            return conversation
+
+    def _load_posts(self) -> None:
+        """
+        Reads the posts of a lazily loaded profile, if not read yet.
+        """
+        if self._lazy is None or self._lazy.posts is None:
+            return
+        with self._save_lock:
+            lazy = self._lazy
+            if lazy is None or lazy.posts is None:
+                return
+            try:
+                posts = [Post(data['entry'], data['timestamp'])
+                         for data in lazy.read(lazy.posts)]
+            except (OSError, ValueError, KeyError) as ex:
+                raise DsuProfileError(ex) from ex
+            self._posts[:0] = posts
+            lazy.posts = None
+            if self._saved_counts is not None:
+                messages, friends, saved = self._saved_counts
+                self._saved_counts = (messages, friends, saved + len(posts))
+
+    def _load_body(self) -> None:
+        """
+        Reads everything a lazily loaded profile has not read yet, so it
+        holds the whole profile again.
+        """
+        if self._lazy is None:
+            return
+        with self._save_lock:
+            lazy = self._lazy
+            if lazy is None:
+                return
+            self._load_posts()
+            try:
+                bodies = {
+                    recipient: (lazy.loaded[recipient]
+                                if recipient in lazy.loaded
+                                else lazy.read(block))
+                    for recipient, block in lazy.conversations.items()
+                    }
+            except (OSError, ValueError, KeyError) as ex:
+                raise DsuProfileError(ex) from ex
+            body = [message for messages in bodies.values()
+                    for message in messages]
+            with self._index_lock:
+                unread = {recipient: Conversation() for recipient in bodies
+                          if recipient not in self._conversations}
+                for recipient, conversation in unread.items():
+                    for message in bodies[recipient]:
+                        conversation.add(message)
+                for message in self._messages:
+                    conversation = unread.get(message['recipient'])
+                    if conversation is not None:
+                        conversation.add(message)
+                self._conversations.update(unread)
+                # In place, so messages being appended aren't lost.
+                self._messages[:0] = body
+                self._lazy = None
+            if self._saved_counts is not None:
+                saved, friends, posts = self._saved_counts
+                self._saved_counts = (saved + len(body), friends, posts)
+
     def get_messages_for_recipient(self, recipient: str) -> list[dict]:
         """
         Get messages for a specific recipient.
@@ -190,14 +509,110 @@ class Profile:
             recipient (str): The recipient's username.
 
         Returns:
-            list[dict]: The list of messages for the recipient.
+            list[dict]: The list of messages for the recipient,
+            ordered by timestamp.
+        """
+        conversation = self._conversation(recipient)
+        return list(conversation.messages) if conversation else []
+
+    def get_last_messages(self, recipient: str, count: int) -> list[dict]:
+        """
+        Get the latest messages exchanged with a recipient.
+
+        Args:
+            recipient (str): The recipient's username.
+            count (int): How many messages to return.
+
+        Returns:
+            list[dict]: Up to count messages, oldest first.
         """
-        return [msg for msg in self.messages if msg['recipient'] == recipient]
+        conversation = self._conversation(recipient)
+        return conversation.last(count) if conversation else []
+
+    def get_messages_between(self, recipient: str, start: float = None,
+                             end: float = None) -> list[dict]:
+        """
+        Get the messages exchanged with a recipient in a time range.
+
+        Args:
+            recipient (str): The recipient's username.
+            start (float, optional): The earliest timestamp included.
+                Defaults to None, no lower bound.
+            end (float, optional): The latest timestamp included.
+                Defaults to None, no upper bound.
+
+        Returns:
+            list[dict]: The messages in the range, oldest first.
+        """
+        conversation = self._conversation(recipient)
+        return conversation.between(start, end) if conversation else []
+
+    def _header(self) -> dict:
+        """
+        Returns the profile fields stored in the header of a .dsu file.
+        """
+        return {field: getattr(self, field) for field in HEADER_FIELDS}
+
+    def _counts(self) -> tuple:
+        """
+        Returns how many messages, friends and posts the profile holds,
+        not counting the unread blocks of a lazily loaded profile.
+        """
+        return len(self._messages), len(self.friends), len(self._posts)
+
+    @staticmethod
+    def _records(op: str, items) -> list:
+        """
+        Returns the JSON lines recording items with op.
+        """
+        if op == 'post':
+            items = ({'entry': post.get_entry(), 'timestamp': post.get_time()}
+                     for post in items)
+        return [json.dumps({'op': op, 'data': item}) + '\n' for item in items]
+
+    def _mark_saved(self, p: Path, header: dict, counts: tuple,
+                    generation: int) -> None:
+        """
+        Remembers that the file at p holds the profile as it was when
+        header and counts were taken.
+        """
+        if generation != self._generation:
+            # A post was deleted while writing, so the file can't be
+            # appended to anymore.
+            self._saved_path = None
+            return
+        self._saved_path = p.resolve()
+        self._saved_size = p.stat().st_size
+        self._saved_header = header
+        self._saved_counts = counts
+
+    def _can_append(self, p: Path) -> bool:
+        """
+        Checks that the file at p holds what this profile last saved,
+        so the changes since can be appended to it.
+        """
+        if self._saved_path != p.resolve():
+            return False
+        if p.stat().st_size != self._saved_size:
+            # Changed by someone else since.
+            return False
+        return all(
+            saved <= count
+            for saved, count in zip(self._saved_counts, self._counts())
+            )
 
     def save_profile(self, path: str) -> None:
         """
         Save the profile to a DSU file.
 
+        If the file holds the profile as it was last saved or loaded,
+        only the changes since are appended. Otherwise, or once the
+        records appended since the file was compacted are too long, the
+        file is rewritten with compact().
+
+        Saving may run on another thread while messages, friends and
+        posts are added: it only writes what was added before it started.
+
         Args:
             path (str): The path to the DSU file.
 
@@ -207,22 +622,205 @@ class Profile:
         p = Path(path)
 
         if p.exists() and p.suffix == '.dsu':
+            with self._save_lock:
+                try:
+                    if not self._can_append(p):
+                        self._compact(p)
+                        return
+                    generation = self._generation
+                    header = self._header()
+                    saved = self._saved_counts
+                    # Slicing copies the new items in one step.
+                    messages = self._messages[saved[0]:]
+                    friends = self.friends[saved[1]:]
+                    posts = self._posts[saved[2]:]
+                    lines = self._records('message', messages)
+                    lines += self._records('friend', friends)
+                    lines += self._records('post', posts)
+                    changed = {
+                        field: value for field, value in header.items()
+                        if self._saved_header[field] != value
+                        }
+                    if changed:
+                        lines += self._records('profile', [changed])
+                    if lines:
+                        with open(p, 'a', encoding='utf-8') as f:
+                            f.writelines(lines)
+                        counts = (saved[0] + len(messages),
+                                  saved[1] + len(friends),
+                                  saved[2] + len(posts))
+                        self._mark_saved(p, header, counts, generation)
+                    if self._tail_too_long():
+                        self._compact(p)
+                except Exception as ex:
+                    raise DsuFileError(
+                        "Error while attempting to process the DSU file."
+                        ) from ex
+        else:
+            raise DsuFileError("Invalid DSU file path or type")
+
+    def _tail_too_long(self) -> bool:
+        """
+        Checks whether the records appended to the saved file since it
+        was compacted are long enough to compact it again.
+        """
+        if self._saved_path is None:
+            return False
+        tail = self._saved_size - self._compacted_size
+        return (tail >= COMPACT_TAIL_SIZE
+                and tail * COMPACT_TAIL_RATIO >= self._compacted_size)
+
+    def compact(self, path: str) -> None:
+        """
+        Rewrite a DSU file without the history of changes: the header,
+        holding the friends and an index of the blocks that follow, then
+        a block of post records and a block of message records, in time
+        order, for every conversation. load_profile(path, lazy=True) only
+        reads the blocks it needs.
+
+        The file is replaced atomically, so it holds either the old or
+        the new profile if writing is interrupted.
+
+        Args:
+            path (str): The path to the DSU file.
+
+        Raises:
+            DsuFileError: If there is an error saving the file.
+        """
+        with self._save_lock:
             try:
-                with open(p, 'w', encoding='utf-8') as f:
-                    json.dump(self.__dict__, f)
+                self._compact(Path(path))
             except Exception as ex:
                 raise DsuFileError(
                     "Error while attempting to process the DSU file."
                     ) from ex
-        else:
-            raise DsuFileError("Invalid DSU file path or type")
 
-    def load_profile(self, path: str) -> None:
+    def _compact(self, p: Path) -> None:
+        """
+        Rewrites the file at p, with _save_lock held.
+        """
+        self._load_body()
+        generation = self._generation
+        header = self._header()
+        with self._index_lock:
+            messages = self._messages[:]
+        friends = self.friends[:]
+        posts = self._posts[:]
+
+        blocks = [''.join(self._records('post', posts)).encode('utf-8')]
+        index = {'posts': [0, len(blocks[0])], 'conversations': {}}
+        offset = len(blocks[0])
+        conversations = {}
+        for message in messages:
+            conversations.setdefault(message['recipient'], []).append(message)
+        for recipient, conversation in conversations.items():
+            conversation.sort(key=_timestamp_key)
+            block = ''.join(self._records('message', conversation))
+            blocks.append(block.encode('utf-8'))
+            index['conversations'][recipient] = [offset, len(blocks[-1])]
+            offset += len(blocks[-1])
+        index['size'] = offset
+        header_line = dict(dsu_format=FORMAT_VERSION, **header,
+                           friends=friends, index=index)
+
+        first = json.dumps(header_line).encode('utf-8') + b'\n'
+        tmp = p.with_name(p.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(first)
+            f.writelines(blocks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, p)
+        self._compacted_size = len(first) + offset
+        counts = (len(messages), len(friends), len(posts))
+        self._mark_saved(p, header, counts, generation)
+        if self._lazy_loaded and self._saved_path is not None:
+            self._unload(p, first, index, len(messages))
+
+    def _unload(self, p: Path, first: bytes, index: dict,
+                count: int) -> None:
+        """
+        Drops the first count messages, just written to the blocks of
+        the file at p, so a lazily loaded profile reads them on demand
+        again instead of holding every message since it was compacted.
+        """
+        lazy = _LazyBody(p, first, index)
+        # Posts are few, so they stay read.
+        lazy.posts = None
+        with self._index_lock:
+            # In place, keeping messages added while writing.
+            del self._messages[:count]
+            self._lazy = lazy
+            self._conversations = {}
+            for message in self._messages:
+                self._index_message(message)
+        messages, friends, posts = self._saved_counts
+        self._saved_counts = (messages - count, friends, posts)
+
+    def _load_legacy(self, obj: dict) -> None:
+        """
+        Loads a profile stored as a single JSON object.
+        """
+        self.username = obj['username']
+        self.password = obj['password']
+        self.dsuserver = obj['dsuserver']
+        self.bio = obj['bio']
+        self.friends = obj['friends']
+        self._messages = obj['messages']
+        for post_obj in obj['_posts']:
+            post = Post(post_obj['entry'], post_obj['timestamp'])
+            self._posts.append(post)
+
+    def _load_log(self, header: dict, lines: list) -> bool:
+        """
+        Loads a profile stored as a header and a log of records.
+
+        Returns:
+            bool: False if the last record was cut off, for example by a
+            crash while it was appended. It is ignored.
+        """
+        for field in HEADER_FIELDS:
+            setattr(self, field, header[field])
+        self.friends = list(header.get('friends', []))
+        self._messages = []
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if number == len(lines):
+                    return False
+                raise
+            op, data = record['op'], record['data']
+            if op == 'message':
+                self._messages.append(data)
+            elif op == 'friend':
+                if data not in self.friends:
+                    self.friends.append(data)
+            elif op == 'post':
+                self._posts.append(Post(data['entry'], data['timestamp']))
+            elif op == 'profile':
+                for field in HEADER_FIELDS:
+                    if field in data:
+                        setattr(self, field, data[field])
+            else:
+                raise DsuProfileError(f'Unknown record {number}: {op}')
+        return True
+
+    def load_profile(self, path: str, lazy: bool = False) -> None:
         """
         Load a profile from a DSU file.
 
         Args:
             path (str): The path to the DSU file.
+            lazy (bool, optional): Only read the header and the changes
+                appended since the file was compacted. Conversations and
+                posts are read when they are first used, and messages
+                reads them all. Files that were never compacted are read
+                whole; saving compacts them once enough was appended, and
+                messages written to blocks are then unread again.
+                Defaults to False.
 
         Raises:
             DsuProfileError: If there is an error loading the file.
@@ -232,18 +830,576 @@ class Profile:
 
         if p.exists() and p.suffix == '.dsu':
             try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    obj = json.load(f)
-                    self.username = obj['username']
-                    self.password = obj['password']
-                    self.dsuserver = obj['dsuserver']
-                    self.bio = obj['bio']
-                    self.friends = obj['friends']
-                    self.messages = obj['messages']
-                    for post_obj in obj['_posts']:
-                        post = Post(post_obj['entry'], post_obj['timestamp'])
-                        self._posts.append(post)
+                self._lazy = None
+                self._lazy_loaded = lazy
+                self._compacted_size = 0
+                with open(p, 'rb') as f:
+                    first = f.readline()
+                    try:
+                        header = json.loads(first)
+                    except json.JSONDecodeError:
+                        header = None
+                    if not (isinstance(header, dict)
+                            and 'dsu_format' in header):
+                        # A single JSON object, possibly on several lines.
+                        self._load_legacy(json.loads(first + f.read()))
+                        complete = False
+                    elif lazy and 'index' in header:
+                        # Skip the blocks, read what was appended after.
+                        f.seek(len(first) + header['index']['size'])
+                        complete = self._load_log(
+                            header, f.read().split(b'\n')
+                            )
+                        self._lazy = _LazyBody(p, first, header['index'])
+                        self._compacted_size = (len(first)
+                                                + header['index']['size'])
+                    else:
+                        complete = self._load_log(
+                            header, f.read().split(b'\n')
+                            )
+                        if 'index' in header:
+                            self._compacted_size = (len(first)
+                                                    + header['index']['size'])
+                self._index_messages()
+                if complete:
+                    self._mark_saved(
+                        p, self._header(), self._counts(), self._generation
+                        )
+                else:
+                    # Compact on the next save.
+                    self._saved_path = None
             except Exception as ex:
                 raise DsuProfileError(ex) from ex
         else:
             raise DsuFileError()
+
+
+class ProfileWriter:
+    """
+    Saves a profile to its DSU file from a background thread.
+
+    Changes are reported with mark_dirty, which returns at once. The
+    writer waits delay seconds after the first change it has not saved,
+    then saves everything changed meanwhile in one write, so a burst of
+    messages costs one save instead of one per message. Pending changes
+    are saved by flush, by close and when the interpreter exits.
+    """
+
+    def __init__(self, profile: Profile, path: str, delay: float = 1.0):
+        """
+        Initialize a ProfileWriter object and start its thread.
+
+        Args:
+            profile (Profile): The profile to save.
+            path (str): The path to the DSU file.
+            delay (float, optional): Seconds changes are collected for
+                before they are saved. Defaults to 1.0.
+        """
+        self.profile = profile
+        self.path = path
+        self.delay = delay
+        # The DsuFileError of the last failed save, None after a success.
+        self.error = None
+        self._dirty = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name='ProfileWriter', daemon=True
+            )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def mark_dirty(self) -> None:
+        """
+        Schedules a save of the profile's changes.
+        """
+        with self._condition:
+            self._dirty = True
+            self._condition.notify()
+
+    def flush(self) -> None:
+        """
+        Saves pending changes now, on the calling thread.
+        """
+        with self._condition:
+            dirty = self._dirty
+            self._dirty = False
+        if dirty:
+            self._save()
+
+    def close(self) -> None:
+        """
+        Saves pending changes and stops the thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def _save(self) -> None:
+        """
+        Saves the profile, keeping the error if it fails.
+        """
+        try:
+            self.profile.save_profile(self.path)
+            self.error = None
+        except DsuFileError as ex:
+            print(f'Unable to save the profile: {ex}')
+            self.error = ex
+
+    def _run(self) -> None:
+        """
+        Saves changes a delay after they are marked until closed.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._dirty or self._closed)
+                if self._closed:
+                    return
+                # Collect the changes of the next delay seconds as well.
+                self._condition.wait_for(lambda: self._closed, self.delay)
+                if not self._dirty:
+                    # Saved by flush meanwhile.
+                    continue
+                self._dirty = False
+            self._save()
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+SQLITE_PROFILE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS profile (
+    field TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS friends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL,
+    from_user INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_recipient
+    ON messages (recipient, timestamp, id);
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    entry TEXT,
+    timestamp REAL NOT NULL
+);
+'''
+
+
+class SqliteProfile:
+    """
+    A profile kept in a SQLite database instead of a JSON log, with the
+    API of Profile.
+
+    Messages, friends and posts are written to the database as they are
+    added and save_profile commits them, so saving costs time
+    proportional to the changes. Messages are indexed on (recipient,
+    timestamp), so reading a conversation is an indexed query and only
+    the header fields and friends are kept in memory.
+
+    Until it is first saved or loaded, the profile lives in an in-memory
+    database. Database files use the .dsu suffix too; open_profile tells
+    them apart from JSON profiles.
+    """
+
+    def __init__(self,
+                 dsuserver: str = None,
+                 username: str = None,
+                 password: str = None
+                 ):
+        """
+        Initialize a SqliteProfile object.
+
+        Args:
+            dsuserver (str): The DSU server address.
+            username (str): The username for the profile.
+            password (str): The password for the profile.
+        """
+        self.dsuserver = dsuserver
+        self.username = username
+        self.password = password
+        self.bio = ''
+        self.friends = []
+        self.path = None
+        # The connection is shared with the ProfileWriter thread.
+        self._lock = threading.RLock()
+        self._conn = self._connect(':memory:')
+
+    @staticmethod
+    def _connect(path) -> sqlite3.Connection:
+        """
+        Opens a profile database, creating the schema if needed.
+        """
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SQLITE_PROFILE_SCHEMA)
+        return conn
+
+    @staticmethod
+    def _message(row: sqlite3.Row) -> dict:
+        """
+        Returns a message row as the dict Profile stores.
+        """
+        return {'recipient': row['recipient'], 'message': row['message'],
+                'from_user': bool(row['from_user']),
+                'timestamp': row['timestamp']}
+
+    def _query_messages(self, where: str = '', args: tuple = ()) -> list:
+        """
+        Returns the messages matching a WHERE clause in time order.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT * FROM messages {where} ORDER BY timestamp, id',
+                args
+                ).fetchall()
+        return [self._message(row) for row in rows]
+
+    @property
+    def messages(self) -> list[dict]:
+        """
+        All messages of the profile, ordered by timestamp.
+        """
+        return self._query_messages()
+
+    def add_message(self, message: dict) -> None:
+        """
+        Add a message to the profile.
+
+        Args:
+            message (dict): The message to add.
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO messages (recipient, message, from_user, '
+                'timestamp) VALUES (?, ?, ?, ?)',
+                (message['recipient'], message['message'],
+                 bool(message['from_user']), message['timestamp'])
+                )
+
+    def add_friend(self, friend_username: str) -> None:
+        """
+        Add a friend to the profile's friends list.
+
+        Args:
+            friend_username (str): The username of the friend to add.
+        """
+        if friend_username not in self.friends:
+            self.friends.append(friend_username)
+            with self._lock:
+                self._conn.execute(
+                    'INSERT OR IGNORE INTO friends (username) VALUES (?)',
+                    (friend_username,)
+                    )
+
+    def add_post(self, post: Post) -> None:
+        """
+        Add a Post object to the profile's posts.
+
+        Args:
+            post (Post): The Post object to add.
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO posts (entry, timestamp) VALUES (?, ?)',
+                (post.get_entry(), post.get_time())
+                )
+
+    def del_post(self, index: int) -> bool:
+        """
+        Delete the post at the specified index.
+
+        Args:
+            index (int): The index of the post to delete.
+
+        Returns:
+            bool: True if the post was deleted, False otherwise.
+        """
+        with self._lock:
+            if index < 0:
+                index += self._conn.execute(
+                    'SELECT COUNT(*) FROM posts').fetchone()[0]
+                if index < 0:
+                    return False
+            cursor = self._conn.execute(
+                'DELETE FROM posts WHERE id = (SELECT id FROM posts '
+                'ORDER BY id LIMIT 1 OFFSET ?)', (index,)
+                )
+            return cursor.rowcount == 1
+
+    def get_posts(self) -> list[Post]:
+        """
+        Get the posts in the profile.
+
+        Returns:
+            list[Post]: The Post objects, oldest first.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT entry, timestamp FROM posts ORDER BY id'
+                ).fetchall()
+        return [Post(row['entry'], row['timestamp']) for row in rows]
+
+    def get_messages_for_recipient(self, recipient: str) -> list[dict]:
+        """
+        Get messages for a specific recipient.
+
+        Args:
+            recipient (str): The recipient's username.
+
+        Returns:
+            list[dict]: The list of messages for the recipient,
+            ordered by timestamp.
+        """
+        return self._query_messages('WHERE recipient = ?', (recipient,))
+
+    def get_last_messages(self, recipient: str, count: int) -> list[dict]:
+        """
+        Get the latest messages exchanged with a recipient.
+
+        Args:
+            recipient (str): The recipient's username.
+            count (int): How many messages to return.
+
+        Returns:
+            list[dict]: Up to count messages, oldest first.
+        """
+        if count <= 0:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM messages WHERE recipient = ? '
+                'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                (recipient, count)
+                ).fetchall()
+        return [self._message(row) for row in reversed(rows)]
+
+    def get_messages_between(self, recipient: str, start: float = None,
+                             end: float = None) -> list[dict]:
+        """
+        Get the messages exchanged with a recipient in a time range.
+
+        Args:
+            recipient (str): The recipient's username.
+            start (float, optional): The earliest timestamp included.
+                Defaults to None, no lower bound.
+            end (float, optional): The latest timestamp included.
+                Defaults to None, no upper bound.
+
+        Returns:
+            list[dict]: The messages in the range, oldest first.
+        """
+        where = 'WHERE recipient = ?'
+        args = [recipient]
+        if start is not None:
+            where += ' AND timestamp >= ?'
+            args.append(start)
+        if end is not None:
+            where += ' AND timestamp <= ?'
+            args.append(end)
+        return self._query_messages(where, tuple(args))
+
+    def save_profile(self, path: str) -> None:
+        """
+        Save the profile to a DSU file.
+
+        Saving to the file the profile was loaded from or last saved to
+        commits the changes since. Saving to another file replaces it
+        with a copy of the database, which the profile then uses.
+
+        Args:
+            path (str): The path to the DSU file.
+
+        Raises:
+            DsuFileError: If there is an error saving the file.
+        """
+        p = Path(path)
+
+        if not (p.exists() and p.suffix == '.dsu'):
+            raise DsuFileError("Invalid DSU file path or type")
+        with self._lock:
+            try:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO profile VALUES (?, ?)',
+                    [(field, getattr(self, field))
+                     for field in HEADER_FIELDS]
+                    )
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO friends (username) VALUES (?)',
+                    [(friend,) for friend in self.friends]
+                    )
+                self._conn.commit()
+                if self.path == p.resolve():
+                    return
+                tmp = p.with_name(p.name + '.tmp')
+                tmp.unlink(missing_ok=True)
+                copy = sqlite3.connect(tmp)
+                try:
+                    self._conn.backup(copy)
+                finally:
+                    copy.close()
+                os.replace(tmp, p)
+                self._conn.close()
+                self._conn = self._connect(p)
+                self.path = p.resolve()
+            except (sqlite3.Error, OSError) as ex:
+                raise DsuFileError(
+                    "Error while attempting to process the DSU file."
+                    ) from ex
+
+    def compact(self, path: str) -> None:
+        """
+        Save the profile and rebuild its database file to reclaim the
+        space of deleted rows.
+
+        Args:
+            path (str): The path to the DSU file.
+
+        Raises:
+            DsuFileError: If there is an error saving the file.
+        """
+        self.save_profile(path)
+        with self._lock:
+            try:
+                self._conn.execute('VACUUM')
+            except sqlite3.Error as ex:
+                raise DsuFileError(
+                    "Error while attempting to process the DSU file."
+                    ) from ex
+
+    def load_profile(self, path: str, lazy: bool = True) -> None:
+        """
+        Load a profile from a SQLite DSU file. Only the header fields and
+        friends are read; messages and posts are queried when used.
+
+        Args:
+            path (str): The path to the DSU file.
+            lazy (bool, optional): Accepted for parity with Profile.
+                A SqliteProfile is always loaded lazily.
+
+        Raises:
+            DsuProfileError: If the file is not a SQLite profile.
+            DsuFileError: If the file is invalid.
+        """
+        p = Path(path)
+
+        if not (p.exists() and p.suffix == '.dsu'):
+            raise DsuFileError()
+        if not is_sqlite_profile(p):
+            raise DsuProfileError(
+                f'{p} is not a SQLite profile, convert it with import_dsu'
+                )
+        with self._lock:
+            try:
+                conn = self._connect(p)
+                fields = dict(conn.execute('SELECT field, value FROM profile'))
+                friends = [row[0] for row in conn.execute(
+                    'SELECT username FROM friends ORDER BY id')]
+            except sqlite3.Error as ex:
+                raise DsuProfileError(ex) from ex
+            self._conn.close()
+            self._conn = conn
+            self.path = p.resolve()
+            for field in HEADER_FIELDS:
+                if field in fields:
+                    setattr(self, field, fields[field])
+            self.friends = friends
+
+    def close(self) -> None:
+        """
+        Close the database, discarding changes that were not saved.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def is_sqlite_profile(path: str) -> bool:
+    """
+    Checks whether a DSU file is a SQLite database.
+
+    Args:
+        path (str): The path to the DSU file.
+
+    Returns:
+        bool: True for a SqliteProfile file, False otherwise.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+def open_profile(path: str, lazy: bool = False):
+    """
+    Load a DSU file with the profile class matching its format.
+
+    Args:
+        path (str): The path to the DSU file.
+        lazy (bool, optional): Load a JSON profile lazily, see
+            Profile.load_profile. Defaults to False.
+
+    Returns:
+        Profile or SqliteProfile: The loaded profile.
+
+    Raises:
+        DsuProfileError: If there is an error loading the file.
+        DsuFileError: If the file is invalid.
+    """
+    profile = SqliteProfile() if is_sqlite_profile(path) else Profile()
+    profile.load_profile(path, lazy=lazy)
+    return profile
+
+
+def import_dsu(source: str, destination: str) -> SqliteProfile:
+    """
+    Copy a JSON DSU profile, in either the log or the legacy format,
+    into a new SQLite profile file.
+
+    Args:
+        source (str): The path to the JSON DSU file.
+        destination (str): The path to the SQLite DSU file to create.
+            An existing file is replaced.
+
+    Returns:
+        SqliteProfile: The imported profile, using destination.
+
+    Raises:
+        DsuProfileError: If the source can't be loaded.
+        DsuFileError: If the source or destination is invalid.
+    """
+    profile = Profile()
+    profile.load_profile(source)
+    imported = SqliteProfile(
+        profile.dsuserver, profile.username, profile.password
+        )
+    imported.bio = profile.bio
+    imported.friends = list(profile.friends)
+    with imported._lock:
+        imported._conn.executemany(
+            'INSERT INTO messages (recipient, message, from_user, timestamp) '
+            'VALUES (?, ?, ?, ?)',
+            [(msg['recipient'], msg['message'], bool(msg['from_user']),
+              msg['timestamp']) for msg in profile.messages]
+            )
+        imported._conn.executemany(
+            'INSERT INTO posts (entry, timestamp) VALUES (?, ?)',
+            [(post.get_entry(), post.get_time())
+             for post in profile.get_posts()]
+            )
+    destination = Path(destination)
+    destination.touch()
+    imported.save_profile(destination)
+    return imported
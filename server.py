@@ -1,22 +1,34 @@
 import socket
 import threading
-import json
-from pathlib import Path
-import sys
-from flask import Flask, render_template, redirect, url_for
+import argparse
+import asyncio
+import queue
+import selectors
+import time
+from collections import OrderedDict, deque
+from flask import Flask, Response, render_template, redirect, url_for
 from datetime import datetime
 import string
 import secrets
 
-USERS_PATH = 'users.json'
-POSTS_PATH = 'posts.json'
-STORE_DIR_PATH = 'store'
+from server_store import JsonStore, STORES, STORE_DIR_PATH, create_store
+from ds_protocol import DEFAULT_CODEC, FrameDecoder, FrameTooLongError, encode_frame, get_codec, select_codec
+from server_metrics import CommandMetrics, TimedLock, render_metrics
+
 DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
+HISTORY_PAGE_SIZE = 100 ##messages per page of a directmessage history request without a limit
+MAX_HISTORY_PAGE_SIZE = 1000 ##larger limits are capped to this
+MAX_BATCH_SIZE = 1000 ##most direct messages accepted in one directmessages request
+MAX_DELIVERED_IDS = 100000 ##message ids remembered to drop retried messages
+SEND_TIMEOUT = 10 ##seconds a response or pushed event may take to send before the client is disconnected
+PUSH_QUEUE_SIZE = 64 ##events waiting to be pushed to a subscribed connection before it is disconnected
 
 
 ##The server uses two json files to store data:
 ##users - bio's, posts
 ##posts - just the posts for each user and timestamp 
+##Both are kept in memory by the store (see server_store.py). Every change is appended to store/users.journal
+##and the json files are rewritten from memory in the background, so they stay readable by the old format.
 
 ##user schema:
 #{user_name: {'bio':{'entry':, 'timestamp':}, 'posts':[{'entry':, 'timestamp':}]} }
@@ -24,6 +36,27 @@ DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
 #posts[{'username':,'entry':, 'timestamp:']
 #messages[{'entry','from/recipient', 'timestamp','status'}] ##status can be "new" or "read". "from" denotes the user recieved the message and "recipient" denotes that they sent it 
 
+##directmessage requests:
+#{"token":, "directmessage": {"entry":, "recipient":, "timestamp":}} sends a message
+#{"token":, "directmessage": "new" | "all"} returns the new messages / the whole history and marks them read
+#{"token":, "directmessage": {"since": <cursor or null>, "limit": N}} returns up to N messages after the cursor
+#   and the cursor of the next page: {"response": {"type": "ok", "messages": [...], "cursor": <cursor>}}
+#{"token":, "directmessages": [{"entry":, "recipient":, "timestamp":}, ...]} sends several messages in one
+#   storage transaction: {"response": {"type": "ok", "message":, "results": ["ok" | "error", ...]}}
+#Sent messages may carry a client generated "id". A message whose id the sender already delivered is acknowledged
+#   again but not stored twice, so clients can safely retry. The server remembers the last MAX_DELIVERED_IDS ids,
+#   in memory only: they are lost when the server restarts, so a retry that reaches a restarted server is stored again.
+##codecs:
+#Every connection starts with JSON lines. A join may ask for other codecs, {"join": {..., "codec": ["msgpack", "binary"]}},
+#   in order of preference. The response names the first one the server supports, {"response": {..., "codec": "binary"}},
+#   and all later commands, responses and events on the connection use it. Framed codecs (binary, msgpack) send a 4 byte
+#   big-endian length before each object instead of ending it with a line break. See ds_protocol.CODECS.
+##subscriptions:
+#{"token":, "subscribe": true | false} (un)subscribes the connection to the user's direct messages. While subscribed,
+#   new messages are pushed as they arrive as {"event": {"type": "directmessage", "messages": [...]}}, and marked read
+#   once the event was sent. A subscriber that does not keep up with its events is disconnected; the messages it was
+#   not sent stay new.
+
 def generate_token():
     '''Randomly generate a token of the form xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx'''
     return f'{_generate_random_string(8)}-{_generate_random_string(4)}-{_generate_random_string(4)}-{_generate_random_string(4)}-{_generate_random_string(12)}'
@@ -34,438 +67,1030 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
-users_file_lock = threading.Lock()
-posts_file_lock = threading.Lock()
+def _command_name(command):
+
+    '''Name a decoded command is counted under in the metrics, e.g. "join" or "directmessage_new"'''
+    if type(command) is not dict:
+        return 'invalid'
+    for name in ('join', 'bio', 'post', 'directmessages', 'subscribe'):
+        if name in command:
+            return name
+    if 'directmessage' in command:
+        args = command['directmessage']
+        if type(args) is dict:
+            return 'directmessage_history' if 'since' in args else 'directmessage_send'
+        if args in ('new', 'all'):
+            return f'directmessage_{args}'
+    return 'invalid'
+
+users_file_lock = TimedLock('users') ##timed, so /metrics can show how long commands wait for the store
+posts_file_lock = TimedLock('posts')
+
+class ClientConnection:
+
+    ##A connection of the threaded DSUServer: its socket, the decoder holding partly received commands and
+    ##the session token. Between commands it waits in the server's selector instead of holding a worker thread.
+
+    def __init__(self, client_socket, client_address, max_line = 1024 * 1024):
+        self.socket = client_socket
+        self.address = client_address
+        self.decoder = FrameDecoder(max_size = max_line) ##its codec is switched by a join that negotiates another codec
+        self.token = None
+        self.subscription = None
+        self.closed = False
+        self.serving = False ##a worker is executing its commands, so the selector does not watch it
+        self._send_lock = threading.Lock() ##responses and pushed events may be written by two workers at once
+
+    def send(self, resp):
+
+        '''Write a response or event object to the client'''
+        with self._send_lock:
+            self.socket.sendall(encode_frame(self.decoder.codec.encode(resp), self.decoder.codec))
+
+    def abort(self):
+
+        '''Disconnect the client from another thread. The selector sees the connection end and a worker closes it'''
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class Subscription:
+
+    ##Pushes the direct messages a user receives to one subscribed ClientConnection. Events wait in a bounded queue,
+    ##so the sender of a message never waits for the subscriber. The queue holds no thread: while it is not empty the
+    ##server's selector watches the socket for writing, and once it can be written a worker of the pool sends the next
+    ##event. Messages are marked read once their event was sent. A subscriber whose queue is full, or whose socket
+    ##does not take an event within SEND_TIMEOUT, is disconnected; its messages stay new for "new" after it reconnects.
+
+    def __init__(self, server, username, conn):
+        self.server = server
+        self.username = username
+        self.conn = conn
+        self._cursor = None ##key of the last message queued, see peek_new_messages of the stores
+        self._events = deque() ##(messages, keys) to send
+        self._lock = threading.Lock()
+        self._writing = False ##a worker is sending an event
+        self._cancelled = False
+
+    def notify(self):
+
+        '''Queue an event with the messages username received since the last one'''
+        with self._lock:
+            if self._cancelled:
+                return
+            page = self.server.store.peek_new_messages(self.username, self._cursor)
+            if not page or not page[0]:
+                return
+            full = len(self._events) >= PUSH_QUEUE_SIZE
+            if not full:
+                self._events.append(page)
+                self._cursor = page[1][-1]
+        if full:
+            self._drop()
+        else:
+            self.server._watch_later(self.conn)
+
+    def wants_write(self):
+
+        '''Whether the selector should watch the socket for writing, to hand the next event to a worker'''
+        with self._lock:
+            return bool(self._events) and not self._writing and not self._cancelled
+
+    def start_write(self):
+
+        '''Called by the selector before it queues the subscription for a worker, which then calls write'''
+        with self._lock:
+            self._writing = True
+
+    def write(self):
+
+        '''Send the next queued event and mark its messages read. Called by a worker once the socket can be written'''
+        try:
+            with self._lock:
+                if self._cancelled or not self._events:
+                    return
+                messages, keys = self._events.popleft()
+            try:
+                self.conn.send({'event': {'type': 'directmessage', 'messages': messages}})
+            except OSError:
+                self._drop()
+                return
+            self.server.store.mark_read(self.username, keys)
+        finally:
+            with self._lock:
+                self._writing = False
+            self.server._watch_later(self.conn) ##watch for writing again if more events are queued
+
+    def cancel(self):
+
+        '''Stop pushing. Events not sent yet are dropped and their messages stay new'''
+        with self._lock:
+            self._cancelled = True
+            self._events.clear()
+
+    def _drop(self):
+
+        '''Cancel the subscription of a subscriber that does not keep up and disconnect it'''
+        if DEBUG:
+            print(f'Disconnecting a subscriber of {self.username} that does not read its events')
+        self.server._unsubscribe(self)
+        self.conn.abort()
+
 class DSUServer:
     
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, store = None, backlog = 5, workers = 32, queue_size = 64, max_line = 1024 * 1024, max_connections = 1000):
         self.host = host
         self.port = port
+        self.max_line = max_line ##longest command accepted, in bytes
         self.sessions = {} ##token -> user 
-        self.clients = []
-    
-    def handle_client(self, client_socket, client_address):
+        self.clients = set() ##sockets (stream writers) of the open connections
+        self.subscribers = {} ##user -> Subscriptions of the user's subscribed connections
+        self._subscribers_lock = threading.Lock()
+        self._delivered_ids = OrderedDict() ##(user, message id) of recently delivered messages, oldest first. Kept in memory only, not across restarts
+        self._sending_ids = {} ##(user, message id) -> Event set once the message being sent with it is stored or failed
+        self._delivered_lock = threading.Lock()
+        if store is None:
+            store = JsonStore(STORE_DIR_PATH, users_file_lock, posts_file_lock)
+        self.store = store
+        ##idle connections wait in a selector. When one receives data it is queued for a fixed pool of worker threads,
+        ##which execute its complete commands and hand it back to the selector, so a worker is only busy while a
+        ##command runs and persistent or subscribed clients hold none. Pushed events are sent by the same workers,
+        ##once the selector sees the socket of a subscription with queued events can be written. A client connecting while every worker is busy
+        ##and queue_size connections already wait for one, or while max_connections are open, gets a "busy" error instead.
+        self.backlog = backlog
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self._connections = queue.Queue() ##ClientConnections with received data and Subscriptions to write. Each is in it at most once
+        self._rearm = queue.SimpleQueue() ##ClientConnections whose selector registration is to be updated
+        self._wakeup = None ##written to wake up the selector
+        self._stats_lock = threading.Lock()
+        self._busy_workers = 0
+        self._open_connections = 0
+        self._accepted = 0
+        self._rejected = 0
+        self.metrics = CommandMetrics() ##requests, errors and latency of every command, served on /metrics
+        self.ready = threading.Event() ##set once the server accepts connections. With port 0, self.port is then the port picked by the OS
+        self._listener = None
+
+    def pool_stats(self):
+
+        '''Returns the counters of the worker pool and the queue of connections waiting for a worker'''
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'busy_workers': self._busy_workers,
+                'queue_size': self.queue_size,
+                'queue_depth': self._connections.qsize(),
+                'connections': self._open_connections,
+                'max_connections': self.max_connections,
+                'accepted': self._accepted,
+                'rejected': self._rejected,
+            }
+
+    def _worker(self):
 
-        '''Handle requests from a single client'''
-        current_user_token = None   
-        self.clients.append(client_socket)
+        '''Serve connections with received data and write subscriptions' events until a None sentinel is queued'''
+        while True:
+            conn = self._connections.get()
+            if conn is None:
+                break
+            if isinstance(conn, Subscription):
+                conn.write()
+                continue
+            with self._stats_lock:
+                self._busy_workers += 1
+            try:
+                self._serve(conn)
+            except Exception as e:
+                ##no client may take a worker of the pool down with it
+                print(f"Error serving client {conn.address}: {e}")
+                try:
+                    self._close_connection(conn)
+                except Exception:
+                    pass
+            finally:
+                with self._stats_lock:
+                    self._busy_workers -= 1
+
+    def _reject(self, connection):
+
+        '''Tell a client the server is saturated and close its connection'''
+        with self._stats_lock:
+            self._rejected += 1
+        resp = {'response': {'type': 'error', 'message': 'Server busy, try again later.'}}
         try:
-            while True:
-                data = client_socket.recv(4096)
+            connection.settimeout(1)
+            connection.sendall(encode_frame(DEFAULT_CODEC.encode(resp)))
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def _accept(self, srv, selector):
+
+        '''Accept a connection and watch it, or reject it if no worker is free and the queue is full or too many connections are open'''
+        try:
+            connection, address = srv.accept()
+        except BlockingIOError:
+            return
+        with self._stats_lock:
+            saturated = self._busy_workers >= self.workers and self._connections.qsize() >= self.queue_size
+            saturated = saturated or self._open_connections >= self.max_connections
+            if not saturated:
+                self._open_connections += 1
+        if saturated:
+            self._reject(connection)
+            return
+        connection.settimeout(SEND_TIMEOUT) ##reads only happen once data arrived, so this bounds sends
+        conn = ClientConnection(connection, address, self.max_line)
+        self.clients.add(connection)
+        selector.register(connection, selectors.EVENT_READ, conn)
+        with self._stats_lock:
+            self._accepted += 1
+
+    def _watch_later(self, conn):
+
+        '''Have the selector update what it watches conn for, from any thread'''
+        self._rearm.put(conn)
+        self._wake()
+
+    def _watch(self, selector, conn):
+
+        '''Watch conn for commands and, while its subscription has events to send, for writing. A connection
+        whose commands a worker executes is not watched at all, so the worker may close it. Only called by the
+        selector's thread'''
+        events = 0
+        if not conn.closed and not conn.serving:
+            events = selectors.EVENT_READ
+            if conn.subscription is not None and conn.subscription.wants_write():
+                events |= selectors.EVENT_WRITE
+        try:
+            registered = selector.get_key(conn.socket).events
+        except (KeyError, ValueError):
+            registered = 0
+        if events == registered:
+            return
+        if not events:
+            selector.unregister(conn.socket)
+        elif registered:
+            selector.modify(conn.socket, events, conn)
+        else:
+            selector.register(conn.socket, events, conn)
+
+    def _wake(self):
+
+        '''Wake up the selector of start_server'''
+        try:
+            self._wakeup.send(b'\0')
+        except (AttributeError, OSError): ##not started, closed, or a wake up is pending already
+            pass
+
+    def _serve(self, conn):
+
+        '''Read what a connection received, execute its complete commands and hand it back to the selector'''
+        try:
+            data = conn.socket.recv(65536)
+            if not data:
                 if DEBUG:
-                    print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
-                msg = data.decode().strip() 
-                if not msg:
-                    if DEBUG:
-                        print("Connection closed.")
-                    break
-                try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else: 
-                    message = ""
+                    print("Connection closed.")
+                self._close_connection(conn)
+                return
+            ##commands may be split across several reads or several commands may arrive in one read
+            for command in conn.decoder.feed(data):
+                if DEBUG:
+                    print(f"Message received by server: {repr(command)}")
+                resp, conn.token = self._handle_request(command, conn.token, conn)
+                conn.send(resp)
+                if 'codec' in resp['response']:
+                    conn.decoder.codec = get_codec(resp['response']['codec'])
+        except FrameTooLongError:
+            try:
+                conn.send({'response': {'type': 'error', 'message': 'Message too long.'}})
+            except OSError: ##the client is gone already
+                pass
+            self._close_connection(conn)
+            return
+        except Exception as e:
+            print(f"Error handling client {conn.address}: {e}")
+            self._close_connection(conn)
+            return
+        conn.serving = False
+        self._watch_later(conn)
+
+    def _close_connection(self, conn):
+
+        '''End the session of a connection and close it'''
+        if conn.closed:
+            return
+        conn.closed = True
+        with self._stats_lock:
+            self._open_connections -= 1
+        self._unsubscribe(conn.subscription)
+        self.sessions.pop(conn.token, None)
+        conn.socket.close()
+        self.clients.discard(conn.socket)
+
+    def _handle_request(self, command, current_user_token, connection = None):
+
+        '''Execute one decoded command received on a connection whose session token is current_user_token.
+        command is None if the connection's FrameDecoder could not decode it.
+        connection is the ClientConnection (AsyncClientConnection) the command came from, used by subscribe commands.
+        Returns the response object and the session token of the connection after the command.'''
+        start = time.perf_counter()
+        direct_message_read = False
+        direct_message_sent = False
+        next_cursor = None
+        batch_results = None
+        selected_codec = None
+        if type(command) is not dict:
+            message = 'Incorrectly formatted JSON message.'
+            status = 'error'
+        else: 
+            message = ""
+            status = "error"
+            
+            if 'join' in command:
+                
+                if len(command) != 1: 
+                    status = "error"
+                    message = "Incorrectly formatted join command."
+                elif type(command['join']) is not dict or len(command['join']) > (4 if 'codec' in command['join'] else 3):
+                    status = "error"
+                    message = "Extra fields provided to join command object."
+                elif not all(field in command['join'] for field in ['username', 'password', 'token']):
                     status = "error"
+                    message = "Missing required fields for join command object."
+                elif current_user_token:
+                    status = "error"
+                    message = "User already joined on the active session."
+                else:
+                    ##execute join command
+                    
+                    uname = command['join']['username']
+                    password = command['join']['password']
+                    token = command['join']['token']
+                    if 'codec' in command['join']:
+                        selected_codec = select_codec(command['join']['codec'])
                     
-                    if 'join' in command:
+                    fetched_user = self._get_or_create_new_user(uname, password)
+
+                    current_user_token = generate_token()
+                    if not fetched_user:
+                        message = f'Welcome to ICS32 Distributed Social, {uname}!'
+                        status = 'ok'
+                        self.sessions[current_user_token] = uname
+
                         
-                        if len(command) != 1: 
-                            status = "error"
-                            message = "Incorrectly formatted join command."
-                        elif len(command['join']) > 3:
-                            status = "error"
-                            message = "Extra fields provided to join command object."
-                        elif not all(field in command['join'] for field in ['username', 'password', 'token']):
-                            status = "error"
-                            message = "Missing required fields for join command object."
-                        elif current_user_token:
+                    else:
+                        if fetched_user['password'] != password:
                             status = "error"
-                            message = "User already joined on the active session."
-                        else:
-                            ##execute join command
-                            
-                            uname = command['join']['username']
-                            password = command['join']['password']
-                            token = command['join']['token']
+                            message = f'Incorrect password for the user {uname}'
+                            current_user_token = None
                             
-                            fetched_user = self._get_or_create_new_user(uname, password)
+                        else:
+                            status = "ok"
+                            message = f'Welcome back, {uname}!'
+                            self.sessions[current_user_token] = uname
 
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
 
-                                
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {uname}'
-                                    current_user_token = None
-                                    
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
+            elif 'bio' in command:
+                if 'token' not in command:
+                
+                    message = "Missing token."
+                    status = "error"
+                    #print('Missing token')
+                elif len(command) != 2:
+                    message = "Incorrectly formatted bio command."
+                    status = "error"
+                    #print('Incorrectly formatted command')
+                elif len(command['bio']) > 2:
+                    message = "Extra fields provided to bio command object."
+                    status = "error"
+                    #print('Incorrect number of fields')
+                elif not all(field in command['bio'] for field in ['entry', 'timestamp']):
+                    status = "error"
+                    message = "Missing required fields for bio command object."
+                
+                else:
+                    entry = command['bio']['entry']
+                    #timestamp = command['bio']['timestamp']
+                    
+                    timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+                    token = command['token']
+                    if token == current_user_token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        self._update_bio(current_user, entry, timestamp)
+                        message = f"Bio for {current_user} updated."
+                        status = 'ok'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
 
+            elif 'directmessages' in command:
+                ##batch send: every item is checked and stored on its own, but all of them in one storage transaction
+                items = command['directmessages']
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2 or type(items) is not list:
+                    message = "Incorrectly formatted directmessages command."
+                    status = 'error'
+                elif len(items) > MAX_BATCH_SIZE:
+                    message = f'Too many direct messages in one request (at most {MAX_BATCH_SIZE}).'
+                    status = 'error'
+                else:
+                    token = command['token']
+                    if token != current_user_token or token not in self.sessions:
+                        message = 'Invalid user token.'
+                        status = 'error'
+                    else:
+                        current_user = self.sessions[token]
+                        timestamp = str((datetime.now().timestamp()))
+                        valid = [type(item) is dict and all(field in item for field in ['entry', 'timestamp', 'recipient'])
+                                 and (len(item) == 3 or (len(item) == 4 and type(item.get('id')) is str))
+                                 for item in items]
+                        ##items with the id of a message already delivered are acknowledged without storing them again
+                        ids = [item['id'] if ok and 'id' in item else None for item, ok in zip(items, valid)]
+                        delivered_ids = self._claim_message_ids(current_user, set(ids) - {None})
+                        if delivered_ids is None:
+                            message = 'Messages with the same ids are being sent, try again later.'
+                            status = 'error'
+                        else:
+                            duplicate = []
+                            batch_ids = set()
+                            for message_id in ids:
+                                duplicate.append(message_id is not None and (message_id in batch_ids or message_id in delivered_ids))
+                                batch_ids.add(message_id)
+                            to_send = [item for item, ok, dup in zip(items, valid, duplicate) if ok and not dup]
+                            results = [False] * len(to_send)
+                            try:
+                                results = self._send_messages(current_user, [(item['entry'], item['recipient']) for item in to_send], timestamp)
+                            finally:
+                                ##claimed ids are released even if the store failed, so the client can retry them
+                                for item, delivered in zip(to_send, results):
+                                    if 'id' in item:
+                                        self._release_message_id(current_user, item['id'], delivered)
+                            sent = iter(results)
+                            batch_results = []
+                            recipients = set()
+                            for item, ok, dup in zip(items, valid, duplicate):
+                                if dup:
+                                    batch_results.append('ok')
+                                elif ok and next(sent):
+                                    batch_results.append('ok')
+                                    recipients.add(item['recipient'])
+                                else:
+                                    batch_results.append('error')
+                            for recipient in recipients:
+                                self._notify(recipient)
+                            message = f"{batch_results.count('ok')} of {len(items)} direct messages sent"
+                            status = 'ok'
 
-                    elif 'bio' in command:
-                        if 'token' not in command:
-                        
-                            message = "Missing token."
-                            status = "error"
-                            #print('Missing token')
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted bio command."
-                            status = "error"
-                            #print('Incorrectly formatted command')
-                        elif len(command['bio']) > 2:
-                            message = "Extra fields provided to bio command object."
-                            status = "error"
-                            #print('Incorrect number of fields')
-                        elif not all(field in command['bio'] for field in ['entry', 'timestamp']):
-                            status = "error"
-                            message = "Missing required fields for bio command object."
-                        
+            elif 'subscribe' in command:
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2 or type(command['subscribe']) is not bool:
+                    message = "Incorrectly formatted subscribe command."
+                    status = 'error'
+                elif connection is None:
+                    message = 'Subscriptions are not supported on this connection.'
+                    status = 'error'
+                else:
+                    token = command['token']
+                    if token == current_user_token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        if command['subscribe']:
+                            if connection.subscription is None:
+                                connection.subscription = self._subscribe(current_user, connection)
+                            message = f'Subscribed {current_user} to direct messages.'
+                            connection.subscription.notify() ##deliver what arrived before the subscription
                         else:
-                            entry = command['bio']['entry']
-                            #timestamp = command['bio']['timestamp']
-                            
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._update_bio(current_user, entry, timestamp)
-                                message = f"Bio for {current_user} updated."
+                            self._unsubscribe(connection.subscription)
+                            connection.subscription = None
+                            message = f'Unsubscribed {current_user} from direct messages.'
+                        status = 'ok'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+
+            elif 'post' in command:
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted post command."
+                    status = 'error'
+                elif len(command['post']) > 2:
+                    message = "Extra fields provided to post command object."
+                    status = 'error'
+                elif not all(field in command['post'] for field in ['entry', 'timestamp']):
+                    message = "Missing required fields for post command."
+                    status = 'error'
+                else:
+                    entry = command['post']['entry']
+                    #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
+                    
+                    timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+                    token = command['token']
+                    if token == current_user_token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        self._create_post(current_user, entry, timestamp)
+                        message = f'Post created by {current_user}'
+                        status = 'ok'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+
+            ###direct message handling
+            elif 'directmessage' in command:
+                
+                args = command['directmessage']
+
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted directmessage command."
+                    status = 'error'
+                elif args not in ['all', 'new'] and not (type(args) is dict and (len(args) == 3 or (len(args) == 4 and type(args.get('id')) is str) or 'since' in args)):
+                    message = "Incorrect fields provided to directmessage command object."
+                    status = 'error'
+                elif type(args) is dict and 'since' in args and not all(field in ['since', 'limit'] for field in args):
+                    message = "Extra fields provided to directmessage history request."
+                    status = 'error'
+                elif type(args) is dict and 'since' not in args and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
+                    message = "Missing required fields for directmessage command."
+                    status = 'error'
+                else:
+                    token = command['token']
+                    
+                    if type(args) is dict and 'since' in args:
+                        ##one page of the history after a cursor. Unlike "all" this leaves the status of the messages alone.
+                        since = args['since']
+                        limit = args.get('limit', HISTORY_PAGE_SIZE)
+                        if not (since is None or (type(since) is int and since >= 0)) or type(limit) is not int or limit < 1:
+                            message = 'Invalid cursor or limit for directmessage history request.'
+                            status = 'error'
+                        elif token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            page = self._read_messages_since(current_user, since, min(limit, MAX_HISTORY_PAGE_SIZE))
+                            if page:
+                                direct_message_read = True
+                                message, next_cursor = page
                                 status = 'ok'
                             else:
-                                message = 'Invalid user token.'
+                                message = 'Unable to read direct messages.'
                                 status = 'error'
-
-                    elif 'post' in command:
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted post command."
-                            status = 'error'
-                        elif len(command['post']) > 2:
-                            message = "Extra fields provided to post command object."
-                            status = 'error'
-                        elif not all(field in command['post'] for field in ['entry', 'timestamp']):
-                            message = "Missing required fields for post command."
-                            status = 'error'
                         else:
-                            entry = command['post']['entry']
-                            #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
+                            message = 'Invalid user token.'
+                            status = 'error'
+                    elif type(args) is dict:
+                        recipient = args['recipient']
+                        #timestamp = args['timestamp']
+                        timestamp = str((datetime.now().timestamp()))
+                        entry = args['entry']
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            direct_message_sent = True
                             
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._create_post(current_user, entry, timestamp)
-                                message = f'Post created by {current_user}'
+                            delivered_ids = self._claim_message_ids(current_user, [args['id']] if 'id' in args else [])
+                            if delivered_ids is None:
+                                message = 'A message with the same id is being sent, try again later.'
+                                status = 'error'
+                            elif delivered_ids:
+                                message = f'Direct message sent'
                                 status = 'ok'
+                            elif self._send_message_once(entry, current_user, recipient, timestamp, args.get('id')):
+                                message = f'Direct message sent'
+                                status = 'ok'
+                                self._notify(recipient)
                             else:
-                                message = 'Invalid user token.'
+                                message = f'Unable to send direct message (_send_message error)'
                                 status = 'error'
-
-                    ###direct message handling
-                    elif 'directmessage' in command:
-                        
-                        args = command['directmessage']
-
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'new'] and not (type(args) is dict and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
+                        else:
+                            message = 'Invalid user token.'
                             status = 'error'
-                        elif type(args) is dict and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
+                    elif args == 'all':
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            direct_message_read = True
+                            message = self._read_all_messages(current_user)
+                            status = 'ok'
+                        else:
+                            message = f'Invalid user token.'
                             status = 'error'
+                    elif args == 'new':
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            direct_message_read = True
+                            message = self._read_new_messages(current_user)
+                            status = 'ok'
                         else:
-                            token = command['token']
-                            
-                            if type(args) is dict:
-                                recipient = args['recipient']
-                                #timestamp = args['timestamp']
-                                timestamp = str((datetime.now().timestamp()))
-                                entry = args['entry']
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_sent = True
-                                    
-                                    if self._send_message(entry,current_user, recipient, timestamp):
-                                        message = f'Direct message sent'
-                                        status = 'ok'
-                                    else:
-                                        message = f'Unable to send direct message (_send_message error)'
-                                        status = 'error'
-                                else:
-                                    message = 'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'all':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_read = True
-                                    message = self._read_all_messages(current_user)
-                                    status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'new':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_read = True
-                                    message = self._read_new_messages(current_user)
-                                    status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
-                                    status = 'error'
-
-                            else:
-                                message = 'Invalid argument for directmessage field.'
-                                status = 'error'
+                            message = f'Invalid user token.'
+                            status = 'error'
 
                     else:
-                        message = 'Invalid command.'
+                        message = 'Invalid argument for directmessage field.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type':status, 'messages': message} }
-                elif direct_message_sent:
-                    resp = {'response': {'type':status, 'message': message} }
-                elif status == 'ok':
-                    resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
-                else:
-                    resp = {'response': {'type':status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
-        except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self.clients.remove(client_socket)
+
+            else:
+                message = 'Invalid command.'
+                status = 'error'
+        if DEBUG:
+            ##a message list can hold a user's whole history, don't print it all
+            print(f'Server sending the following message: "{message if type(message) is str else f"{len(message)} messages"}"')
+        if direct_message_read and next_cursor is not None:
+            resp = {'response': {'type':status, 'messages': message, 'cursor': next_cursor} }
+        elif direct_message_read:
+            resp = {'response': {'type':status, 'messages': message} }
+        elif direct_message_sent:
+            resp = {'response': {'type':status, 'message': message} }
+        elif batch_results is not None:
+            resp = {'response': {'type':status, 'message': message, 'results': batch_results} }
+        elif status == 'ok':
+            resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+        else:
+            resp = {'response': {'type':status, 'message': message}}
+        if status == 'ok' and selected_codec is not None:
+            resp['response']['codec'] = selected_codec.name
+        self.metrics.observe(_command_name(command), time.perf_counter() - start, status == 'ok')
+        return resp, current_user_token
             
     
 
-    def _send_message(self, entry, username, recipient, timestamp = ''):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-            
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
+    def _claim_message_ids(self, username, message_ids):
 
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
-            
-            else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'new'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
-        return True
+        '''Claim the distinct client generated message_ids of messages username is about to send. Returns the set of ids already delivered, which are not claimed, or None if other messages with some of the ids were still being sent after SEND_TIMEOUT'''
+        keys = [(username, message_id) for message_id in message_ids]
+        while True:
+            with self._delivered_lock:
+                ##all ids are checked and claimed under one lock, so two retries of a message can not both store it
+                sending = next((self._sending_ids[key] for key in keys if key in self._sending_ids), None)
+                if sending is None:
+                    delivered_ids = set()
+                    for key in keys:
+                        if key in self._delivered_ids:
+                            self._delivered_ids.move_to_end(key)
+                            delivered_ids.add(key[1])
+                        else:
+                            self._sending_ids[key] = threading.Event()
+                    return delivered_ids
+            ##another connection is sending one of the messages. Wait holding no claim, so connections sending the
+            ##same ids in another order can not wait for each other, then check again whether it was stored
+            if not sending.wait(SEND_TIMEOUT):
+                return None
 
-    def _read_all_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'new':
-                    message['status'] = 'read'
+    def _release_message_id(self, username, message_id, delivered):
 
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        '''Remember a claimed message_id if the message was delivered, or forget it so the client can retry. Only the last MAX_DELIVERED_IDS delivered ids are kept'''
+        key = (username, message_id)
+        with self._delivered_lock:
+            sending = self._sending_ids.pop(key)
+            if delivered:
+                self._delivered_ids[key] = None
+                if len(self._delivered_ids) > MAX_DELIVERED_IDS:
+                    self._delivered_ids.popitem(last = False)
+        sending.set()
 
-    
-    def _read_new_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'new':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
-            
-            
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+    def _send_message_once(self, entry, username, recipient, timestamp, message_id):
 
+        '''Send a direct message whose message_id, if any, username already claimed'''
+        delivered = False
+        try:
+            delivered = self._send_message(entry, username, recipient, timestamp)
+        finally:
+            if message_id is not None:
+                self._release_message_id(username, message_id, delivered)
+        return delivered
 
+    def _subscribe(self, username, connection):
 
+        '''Push the direct messages username receives to connection from now on. Returns the subscription'''
+        subscription = self._create_subscription(username, connection)
+        with self._subscribers_lock:
+            self.subscribers.setdefault(username, []).append(subscription)
+        return subscription
 
-    def _get_user(self, username):
+    def _create_subscription(self, username, connection):
+        return Subscription(self, username, connection)
 
-        '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
-    
+    def _unsubscribe(self, subscription):
+
+        '''Stop pushing to a subscription, if it is not None'''
+        if subscription is None:
+            return
+        subscription.cancel()
+        with self._subscribers_lock:
+            subscriptions = self.subscribers.get(subscription.username, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.subscribers.pop(subscription.username, None)
 
+    def _notify(self, username):
+
+        '''Queue the new messages of username for its subscribed connections'''
+        with self._subscribers_lock:
+            subscriptions = list(self.subscribers.get(username, []))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def _send_message(self, entry, username, recipient, timestamp = ''):
+        return self.store.send_message(entry, username, recipient, timestamp)
+
+    def _send_messages(self, username, messages, timestamp = ''):
+        return self.store.send_messages(username, messages, timestamp)
+
+    def _read_all_messages(self, username):
+        return self.store.read_all_messages(username)
+
+    def _read_new_messages(self, username):
+        return self.store.read_new_messages(username)
+
+    def _read_messages_since(self, username, since, limit):
+        return self.store.read_messages_since(username, since, limit)
+
+    def _get_user(self, username):
+
+        '''Gets the bio and posts associated with the username.'''
+        return self.store.get_user(username)
 
     def _get_or_create_new_user(self, username, password):
 
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        '''Get the user associated with the username. If it doesnt exist, create a new user.'''
+        return self.store.get_or_create_user(username, password)
 
-            fetched_user = existing_users.get(username, None)
-            if fetched_user:
-                return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
-            
-    
-    
     def _update_bio(self,username, entry, timestamp):
 
         '''Update the bio associated with the username.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            with users_path.open('w') as user_file:
-                
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that no user exists
-                    return False
-                else:
-                    fetched_user['bio'] = {'entry':entry, 'timestamp':timestamp}
-                    
-                json.dump(existing_users, user_file)
+        return self.store.update_bio(username, entry, timestamp)
 
-    
     def _create_post(self, username, entry, timestamp):
         '''Create a post for the user (username). Add the post to the user's posts and add the post to the list of all posts'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        return self.store.create_post(username, entry, timestamp)
 
-            fetched_user = existing_users.get(username, None)
-            
-            with users_path.open('w') as user_file:
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that user exists
-                    return False
-                else:
-                    fetched_user['posts'].insert(0, {'user': username, 'entry':entry, 'timestamp':timestamp})
-                    
-                json.dump(existing_users, user_file)
-        with posts_file_lock:
-            existing_posts = None
-            posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-            with posts_path.open('r') as posts_file:
-                existing_posts = json.load(posts_file)['posts']
-            
-            existing_posts.insert(0, {'user':username, 'entry':entry, 'timestamp':timestamp})
-
-            with posts_path.open('w') as posts_file:
-                json.dump({"posts":existing_posts}, posts_file)
-        
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
-        if not posts_path.exists():
-            with posts_path.open('w') as json_file:
-                json.dump({'posts':[]}, json_file, indent=4)
+        '''Creates the local storage system if it doesnt already exist, loads it and replays its journal. Will create a directory called "store" with two files posts.json and users.json'''
+        self.store.open()
 
     def start_server(self):
         
         '''Starts the server (hence the name of the method :))'''
         self._create_storage_system() #does nothing if the server store files exists already
+        wakeup = None
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv, selectors.DefaultSelector() as selector:
                 srv.bind((self.host, self.port))
-                srv.listen(5)
+                srv.listen(self.backlog)
+                srv.setblocking(False)
+                self.port = srv.getsockname()[1]
+                wakeup, self._wakeup = socket.socketpair()
+                wakeup.setblocking(False)
+                self._wakeup.setblocking(False)
+                selector.register(srv, selectors.EVENT_READ)
+                selector.register(wakeup, selectors.EVENT_READ)
+                for _ in range(self.workers):
+                    threading.Thread(target = self._worker, daemon = True).start()
+                self._listener = srv
+                self.ready.set()
                 if DEBUG:
                     print("DSUserver is listening on port", self.port)
-                while True:
-                    connection, address = srv.accept()
-                    client_handler = threading.Thread(target = self.handle_client, args = (connection,address))
-                    client_handler.start()
+                while self._listener is not None: ##cleared by shutdown()
+                    for key, mask in selector.select():
+                        if key.fileobj is srv:
+                            self._accept(srv, selector)
+                        elif key.fileobj is wakeup:
+                            try:
+                                while wakeup.recv(4096):
+                                    pass
+                            except BlockingIOError:
+                                pass
+                            while True:
+                                try:
+                                    conn = self._rearm.get_nowait()
+                                except queue.Empty:
+                                    break
+                                self._watch(selector, conn)
+                        else:
+                            ##the registration is updated before queueing, so a worker closing the connection
+                            ##never closes a socket the selector still watches
+                            conn = key.data
+                            subscription = conn.subscription
+                            write = mask & selectors.EVENT_WRITE and subscription is not None and subscription.wants_write()
+                            if mask & selectors.EVENT_READ:
+                                ##a worker owns the connection's commands until it hands it back
+                                conn.serving = True
+                            if write:
+                                subscription.start_write()
+                            self._watch(selector, conn)
+                            if mask & selectors.EVENT_READ:
+                                self._connections.put(conn)
+                            if write:
+                                self._connections.put(subscription)
         except KeyboardInterrupt as e:
             if DEBUG:
                 print(f'Server shutting down...')
         finally:
-            for conn in self.clients:
+            self._listener = None
+            self.ready.clear()
+            for _ in range(self.workers):
+                self._connections.put(None)
+            for conn in list(self.clients): ##workers may still be closing connections
                 conn.close()
-            self.clients = []
+            self.clients = set()
+            if wakeup is not None:
+                wakeup.close()
+                self._wakeup.close()
             if DEBUG:
                 print('Disconnected all clients.')
+            self.store.close()
+
+    def shutdown(self):
+
+        '''Stops accepting connections and disconnects all clients, so start_server returns. Call it from another thread'''
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            self._wake()
 
         
 
+
+class AsyncClientConnection:
+
+    ##A connection of the AsyncDSUServer, see ClientConnection
+
+    def __init__(self, writer, max_line = 1024 * 1024):
+        self.writer = writer
+        self.decoder = FrameDecoder(max_size = max_line) ##its codec is switched by a join that negotiates another codec
+        self.subscription = None
+
+    def send(self, resp):
+
+        '''Write a response or event object to the stream, to be sent when the writer is drained'''
+        self.writer.write(encode_frame(self.decoder.codec.encode(resp), self.decoder.codec))
+
+class AsyncSubscription:
+
+    ##Subscription of an AsyncDSUServer connection: the same bounded queue of events as Subscription,
+    ##drained by a task on the event loop. Commands run on the event loop too, so no lock is needed.
+
+    def __init__(self, server, username, conn):
+        self.server = server
+        self.username = username
+        self.conn = conn
+        self._cursor = None
+        self._events = deque()
+        self._wakeup = asyncio.Event()
+        self._cancelled = False
+        self._task = asyncio.get_running_loop().create_task(self._write())
+
+    def notify(self):
+
+        '''Queue an event with the messages username received since the last one'''
+        if self._cancelled:
+            return
+        page = self.server.store.peek_new_messages(self.username, self._cursor)
+        if not page or not page[0]:
+            return
+        if len(self._events) >= PUSH_QUEUE_SIZE:
+            self._drop()
+            return
+        self._events.append(page)
+        self._cursor = page[1][-1]
+        self._wakeup.set()
+
+    async def _write(self):
+
+        '''Send the queued events, marking their messages read, until the subscription is cancelled'''
+        while not self._cancelled:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._events and not self._cancelled:
+                messages, keys = self._events.popleft()
+                if self.conn.writer.is_closing():
+                    return
+                self.conn.send({'event': {'type': 'directmessage', 'messages': messages}})
+                try:
+                    await asyncio.wait_for(self.conn.writer.drain(), SEND_TIMEOUT)
+                except (OSError, asyncio.TimeoutError):
+                    self._drop()
+                    return
+                self.server.store.mark_read(self.username, keys)
+
+    def cancel(self):
+
+        '''Stop pushing. Events not sent yet are dropped and their messages stay new'''
+        self._cancelled = True
+        self._events.clear()
+        self._wakeup.set()
+
+    def _drop(self):
+
+        '''Cancel the subscription of a subscriber that does not keep up and disconnect it'''
+        if DEBUG:
+            print(f'Disconnecting a subscriber of {self.username} that does not read its events')
+        self.server._unsubscribe(self)
+        self.conn.writer.close()
+
+class AsyncDSUServer(DSUServer):
+
+    ##Same protocol and storage as DSUServer, but every connection is a coroutine on one asyncio event loop
+    ##instead of being handed between worker threads, so there is no pool to saturate.
+    ##Commands are executed on the event loop; the json store answers them from memory.
+
+    def __init__(self, host = '127.0.0.1', port = 3001, store = None, backlog = 1024, max_line = 1024 * 1024):
+        super().__init__(host, port, store, backlog, max_line = max_line)
+
+    def _create_subscription(self, username, connection):
+        return AsyncSubscription(self, username, connection)
+
+    async def handle_connection(self, reader, writer):
+
+        '''Handle requests from a single client on the event loop'''
+        current_user_token = None
+        conn = AsyncClientConnection(writer, self.max_line)
+        client_address = writer.get_extra_info('peername')
+        self.clients.add(writer)
+
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    if DEBUG:
+                        print("Connection closed.")
+                    break
+                try:
+                    for command in conn.decoder.feed(data):
+                        if DEBUG:
+                            print(f"Message received by server: {repr(command)}")
+                        resp, current_user_token = self._handle_request(command, current_user_token, conn)
+                        conn.send(resp)
+                        if 'codec' in resp['response']:
+                            conn.decoder.codec = get_codec(resp['response']['codec'])
+                except FrameTooLongError:
+                    conn.send({'response': {'type': 'error', 'message': 'Message too long.'}})
+                    await writer.drain()
+                    break
+                await writer.drain()
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._unsubscribe(conn.subscription)
+            self.sessions.pop(current_user_token, None)
+            self.clients.discard(writer)
+            writer.close()
+
+    async def _serve_async(self):
+
+        '''Accept connections until the task is cancelled'''
+        srv = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog = self.backlog)
+        async with srv:
+            self.port = srv.sockets[0].getsockname()[1]
+            self._loop = asyncio.get_running_loop()
+            self._listener = srv
+            self.ready.set()
+            if DEBUG:
+                print("DSUserver (asyncio) is listening on port", self.port)
+            try:
+                await srv.serve_forever()
+            except asyncio.CancelledError:
+                if self._listener is not None: ##not closed by shutdown()
+                    raise
+
+    def start_server(self):
+
+        '''Starts the server on an asyncio event loop'''
+        self._create_storage_system()
+        try:
+            asyncio.run(self._serve_async())
+        except KeyboardInterrupt:
+            if DEBUG:
+                print(f'Server shutting down...')
+        finally:
+            self._listener = None
+            self.ready.clear()
+            self.clients = set()
+            if DEBUG:
+                print('Disconnected all clients.')
+            self.store.close()
+
+    def shutdown(self):
+
+        '''Stops the event loop's server and disconnects all clients, so start_server returns. Call it from another thread'''
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+
+        def stop():
+            listener.close()
+            for writer in list(self.clients):
+                writer.close()
+
+        self._loop.call_soon_threadsafe(stop)
+
 ## UNCOMMENT THIS LINE IF YOU WANT
 app = Flask(__name__) ##we also create a flask server for you to view the posts and users in a frontend
 
@@ -479,43 +1104,73 @@ def index():
 
 @app.route('/posts') #UNCOMMENT IF YOU WANT
 def posts():
-    with posts_file_lock:
-        existing_posts = None
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        with posts_path.open('r') as posts_file:
-            existing_posts = json.load(posts_file)['posts']
+    existing_posts = _get_store().get_posts()
 
     return render_template('index.html', posts = existing_posts)
 
 @app.route('/user/<string:username>') #UNCOMMENT IF YOU WANT
 def user_profile(username):
-    with users_file_lock:
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        existing_users = None
-        with users_path.open('r') as user_file:
-            existing_users = json.load(user_file)
-
-        fetched_user = existing_users.get(username, None)
-        #print(fetched_user['posts'])
-        if fetched_user:
-            user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'] }
-            return render_template('user_profile.html', user = user)
-        else:
-            return "User not found..."
+    fetched_user = _get_store().get_user(username)
+    #print(fetched_user['posts'])
+    if fetched_user:
+        user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'] }
+        return render_template('user_profile.html', user = user)
+    else:
+        return "User not found..."
+
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format: per command counters and latency histograms, sessions, connections, lock waits, store files
+    server = app.config.get('DSU_SERVER')
+    if server is None:
+        return Response('DSU server is not running\n', status = 503, mimetype = 'text/plain')
+    gauges = {
+        'dsu_sessions': ('Joined sessions.', len(server.sessions)),
+        'dsu_connections': ('Open client connections.', len(server.clients)),
+    }
+    counters = {}
+    if not isinstance(server, AsyncDSUServer):
+        stats = server.pool_stats()
+        gauges['dsu_worker_pool_size'] = ('Worker threads executing commands.', stats['workers'])
+        gauges['dsu_busy_workers'] = ('Worker threads serving a connection.', stats['busy_workers'])
+        gauges['dsu_queued_connections'] = ('Connections with received commands waiting for a worker.', stats['queue_depth'])
+        counters['dsu_connections_accepted_total'] = ('Connections accepted.', stats['accepted'])
+        counters['dsu_connections_rejected_total'] = ('Connections told the server is busy, because the queue was full or max_connections were open.', stats['rejected'])
+    locks = [lock for lock in (server.store.users_lock, server.store.posts_lock) if isinstance(lock, TimedLock)]
+    text = render_metrics(server.metrics, gauges, locks, server.store.store_dir, counters)
+    return Response(text, mimetype = 'text/plain; version=0.0.4')
+
+
+def _get_store():
+    '''Returns the store of the running DSUServer. If the flask app runs on its own, the store files are loaded read only.'''
+    store = app.config.get('DSU_STORE')
+    if store is None:
+        store = JsonStore(STORE_DIR_PATH, users_file_lock, posts_file_lock)
+        store.load()
+        app.config['DSU_STORE'] = store
+    return store
 
 
 def run_flask_server(host = '127.0.0.1', port = 3002):
     app.run(host = host, port = port)
 
 
-def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002):
+def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002, storage = 'json', use_asyncio = False, backlog = None, workers = 32, queue_size = 64, max_line = 1024 * 1024, max_connections = 1000):
+
+    store = create_store(storage, STORE_DIR_PATH, users_file_lock, posts_file_lock)
+    if use_asyncio:
+        server = AsyncDSUServer(host, port1, store, 1024 if backlog is None else backlog, max_line)
+    else:
+        server = DSUServer(host, port1, store, 5 if backlog is None else backlog, workers, queue_size, max_line, max_connections)
+    app.config['DSU_STORE'] = server.store
+    app.config['DSU_SERVER'] = server
 
     #UNCOMMENT THE FOLLOWING LINES TO RUN THE FLASK SERVER
     flask_thread = threading.Thread(target=run_flask_server, daemon=True, args = (host, port2))
     flask_thread.start()
 
     try:
-        server = DSUServer(host, port1)
         server.start_server()
     except Exception as e:
         print(f'Server raised the following error:{e}')
@@ -523,14 +1178,21 @@ def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002):
 
 
 if __name__ == '__main__':
-    host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
-    if len(sys.argv) >= 3:
-        port2 = int(sys.argv[2])
+    parser = argparse.ArgumentParser(description = 'Run the DSU server and the flask viewer.')
+    parser.add_argument('port1', nargs = '?', type = int, default = 3001, help = 'port of the DSU server')
+    parser.add_argument('port2', nargs = '?', type = int, default = 3002, help = 'port of the flask viewer')
+    parser.add_argument('--storage', choices = sorted(STORES), default = 'json', help = 'storage backend (default: json)')
+    parser.add_argument('--asyncio', action = 'store_true', help = 'serve all connections from one asyncio event loop instead of a thread per connection')
+    parser.add_argument('--backlog', type = int, help = 'listen backlog of the server socket (default: 5, 1024 with --asyncio)')
+    parser.add_argument('--workers', type = int, default = 32, help = 'number of worker threads executing commands (default: 32)')
+    parser.add_argument('--queue-size', type = int, default = 64, help = 'connections waiting for a worker before new clients are told the server is busy (default: 64)')
+    parser.add_argument('--max-connections', type = int, default = 1000, help = 'open connections before new clients are told the server is busy (default: 1000)')
+    parser.add_argument('--max-line', type = int, default = 1024 * 1024, help = 'longest command accepted from a client, in bytes (default: 1 MiB)')
+    parser.add_argument('--quiet', action = 'store_true', help = 'turn off the DEBUG prints of every command, see /metrics instead')
+    args = parser.parse_args()
+    if args.quiet:
+        DEBUG = False
    
-    run_servers(host,port1,port2)
+    run_servers('127.0.0.1', args.port1, args.port2, args.storage, args.asyncio, args.backlog, args.workers, args.queue_size, args.max_line, args.max_connections)
 
 
@@ -0,0 +1,278 @@
+"""
+server_metrics.py
+
+This module collects the metrics the DSU server exposes on the /metrics
+endpoint of its flask app: a request counter, an error counter and a
+latency histogram for every protocol command, and the time spent waiting
+for the store locks. render_metrics writes them, together with gauges
+taken when the endpoint is read, in the Prometheus text format.
+
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+    Counts observed values in buckets with fixed upper bounds.
+
+    Not thread safe: callers serialize observe and the readers.
+    """
+
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        """
+        Initialize a Histogram object.
+
+        Args:
+            bounds (tuple): The sorted upper bounds of the buckets.
+                Larger values are only counted in the +Inf bucket.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+        Counts one value.
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """
+        Returns (upper bound, count of values up to it) for every bucket,
+        ending with the '+Inf' bucket.
+        """
+        buckets = []
+        running = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            running += count
+            buckets.append((bound, running))
+        return buckets
+
+
+class TimedLock:
+    """
+    A threading.Lock that records how long acquiring it waited.
+
+    Acquiring a free lock costs one extra non-blocking attempt; only
+    contended acquisitions are timed. The statistics are updated while
+    the lock is held, so they need no lock of their own.
+    """
+
+    def __init__(self, name: str):
+        """
+        Initialize a TimedLock object.
+
+        Args:
+            name (str): The name the lock is reported under.
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = Histogram()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        """
+        Acquires the lock, with the arguments of threading.Lock.acquire.
+
+        Returns:
+            bool: True if the lock was acquired.
+        """
+        if self._lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        self.acquisitions += 1
+        self.contended += 1
+        self.wait.observe(time.perf_counter() - start)
+        return True
+
+    def release(self) -> None:
+        """
+        Releases the lock.
+        """
+        self._lock.release()
+
+    def locked(self) -> bool:
+        """
+        Returns True if the lock is held.
+        """
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class CommandMetrics:
+    """
+    Request counts, error counts and latency histograms by command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._errors = {}
+        self._latency = {}
+
+    def observe(self, command: str, seconds: float, ok: bool) -> None:
+        """
+        Records one executed command.
+
+        Args:
+            command (str): The name of the command.
+            seconds (float): How long executing it took.
+            ok (bool): False if the response was an error.
+        """
+        with self._lock:
+            if command not in self._latency:
+                self._requests[command] = 0
+                self._errors[command] = 0
+                self._latency[command] = Histogram()
+            self._requests[command] += 1
+            if not ok:
+                self._errors[command] += 1
+            self._latency[command].observe(seconds)
+
+    def snapshot(self) -> dict:
+        """
+        Returns a consistent copy of the metrics.
+
+        Returns:
+            dict: For every command, its 'requests', 'errors', the total
+            'seconds' and the cumulative latency 'buckets'.
+        """
+        with self._lock:
+            return {
+                command: {
+                    'requests': self._requests[command],
+                    'errors': self._errors[command],
+                    'seconds': histogram.total,
+                    'buckets': histogram.cumulative(),
+                }
+                for command, histogram in self._latency.items()
+            }
+
+
+def store_file_sizes(store_dir: str) -> dict:
+    """
+    Returns the size in bytes of every file in the store directory.
+    """
+    sizes = {}
+    try:
+        paths = list(Path(store_dir).iterdir())
+    except OSError:
+        return sizes
+    for path in paths:
+        try:
+            if path.is_file():
+                sizes[path.name] = path.stat().st_size
+        except OSError:
+            # Replaced by an atomic rewrite in the meantime.
+            pass
+    return sizes
+
+
+def _histogram_lines(name: str, labels: str, buckets: list,
+                     seconds: float) -> list:
+    """
+    Formats the _bucket, _sum and _count samples of a histogram.
+    """
+    lines = [f'{name}_bucket{{{labels}le="{bound}"}} {count}'
+             for bound, count in buckets]
+    lines.append(f'{name}_sum{{{labels.rstrip(",")}}} {seconds}')
+    lines.append(f'{name}_count{{{labels.rstrip(",")}}} {buckets[-1][1]}')
+    return lines
+
+
+def render_metrics(commands: CommandMetrics, gauges: dict,
+                   locks: list = (), store_dir: str = None,
+                   counters: dict = None) -> str:
+    """
+    Formats the metrics in the Prometheus text exposition format.
+
+    Args:
+        commands (CommandMetrics): The per-command metrics.
+        gauges (dict): Other current values by metric name, such as
+            'dsu_sessions', with a help text: {name: (help, value)}.
+        locks (list): The TimedLocks to report the wait time of.
+        store_dir (str): The store directory to report file sizes of.
+        counters (dict): Other totals that only grow, by metric name,
+            such as 'dsu_connections_accepted_total', with a help text:
+            {name: (help, value)}.
+
+    Returns:
+        str: The metrics.
+    """
+    lines = []
+    snapshot = commands.snapshot()
+    lines.append('# HELP dsu_requests_total Commands executed.')
+    lines.append('# TYPE dsu_requests_total counter')
+    for command, stats in snapshot.items():
+        lines.append(
+            f'dsu_requests_total{{command="{command}"}} {stats["requests"]}')
+    lines.append('# HELP dsu_request_errors_total Commands answered with '
+                 'an error.')
+    lines.append('# TYPE dsu_request_errors_total counter')
+    for command, stats in snapshot.items():
+        lines.append(f'dsu_request_errors_total{{command="{command}"}} '
+                     f'{stats["errors"]}')
+    lines.append('# HELP dsu_request_seconds Time taken to execute a '
+                 'command.')
+    lines.append('# TYPE dsu_request_seconds histogram')
+    for command, stats in snapshot.items():
+        lines.extend(_histogram_lines(
+            'dsu_request_seconds', f'command="{command}",',
+            stats['buckets'], stats['seconds']))
+
+    for name, (help_text, value) in gauges.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+
+    for name, (help_text, value) in (counters or {}).items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+
+    if locks:
+        lines.append('# HELP dsu_lock_acquisitions_total Store lock '
+                     'acquisitions.')
+        lines.append('# TYPE dsu_lock_acquisitions_total counter')
+        for lock in locks:
+            lines.append(f'dsu_lock_acquisitions_total{{lock="{lock.name}"}} '
+                         f'{lock.acquisitions}')
+        lines.append('# HELP dsu_lock_wait_seconds Time spent waiting for '
+                     'a store lock held by another thread.')
+        lines.append('# TYPE dsu_lock_wait_seconds histogram')
+        for lock in locks:
+            lines.extend(_histogram_lines(
+                'dsu_lock_wait_seconds', f'lock="{lock.name}",',
+                lock.wait.cumulative(), lock.wait.total))
+
+    if store_dir is not None:
+        lines.append('# HELP dsu_store_file_bytes Size of a store file.')
+        lines.append('# TYPE dsu_store_file_bytes gauge')
+        for name, size in sorted(store_file_sizes(store_dir).items()):
+            lines.append(f'dsu_store_file_bytes{{file="{name}"}} {size}')
+    return '\n'.join(lines) + '\n'
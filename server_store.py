@@ -0,0 +1,1197 @@
+"""
+server_store.py
+
+This module provides the storage engines used by the DSU server.
+
+JsonStore, the default, keeps users, messages and posts in memory, records
+every mutation in an append-only journal, and folds the journal into the
+regular users.json/posts.json snapshot files in the background.
+SqliteStore keeps the same data in indexed SQLite tables.
+
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+from bisect import bisect_right
+from pathlib import Path
+
+USERS_PATH = 'users.json'
+POSTS_PATH = 'posts.json'
+JOURNAL_PATH = 'users.journal'
+DB_PATH = 'users.db'
+STORE_DIR_PATH = 'store'
+
+# Messages serialized per hold of users_lock while taking a snapshot.
+SNAPSHOT_CHUNK = 10000
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    bio_entry TEXT NOT NULL DEFAULT '',
+    bio_timestamp TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    peer TEXT NOT NULL,
+    sent INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_status
+    ON messages (username, status);
+CREATE INDEX IF NOT EXISTS messages_timestamp
+    ON messages (username, timestamp);
+CREATE INDEX IF NOT EXISTS messages_cursor
+    ON messages (username, id);
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_username ON posts (username);
+'''
+
+
+def _write_atomic(path: Path, data: str) -> None:
+    """
+    Write data to path by writing a temporary file and renaming it over
+    the target, so readers never observe a partially written file.
+
+    Args:
+        path (Path): The file to replace.
+        data (str): The new contents of the file.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class MessageRecord:
+    """
+    One direct message held by JsonStore.
+
+    Messages are the bulk of the store, so they use slots instead of a
+    dict per message, and the username of the other party is interned so
+    every message of a conversation shares one string. status is 'sent'
+    for a message the user sent, otherwise 'new' or 'read'.
+    """
+
+    __slots__ = ('peer', 'message', 'timestamp', 'status')
+
+    def __init__(self, peer: str, message: str, timestamp: str, status: str):
+        self.peer = sys.intern(peer)
+        self.message = message
+        self.timestamp = timestamp
+        self.status = status
+
+    @classmethod
+    def from_dict(cls, msg: dict) -> 'MessageRecord':
+        """
+        Create a record from a message in the users.json format. Older
+        stores keep the text of a message under 'entry' and may hold
+        numeric timestamps.
+        """
+        message = msg.get('message', msg.get('entry', ''))
+        if 'recipient' in msg:
+            return cls(msg['recipient'], message,
+                       str(msg['timestamp']), 'sent')
+        return cls(msg['from'], message,
+                   str(msg['timestamp']), msg['status'])
+
+    def to_dict(self) -> dict:
+        """
+        Convert the record into the users.json format.
+        """
+        if self.status == 'sent':
+            return {'message': self.message, 'recipient': self.peer,
+                    'timestamp': self.timestamp, 'status': self.status}
+        return {'message': self.message, 'from': self.peer,
+                'timestamp': self.timestamp, 'status': self.status}
+
+    def to_response(self) -> dict:
+        """
+        Convert the record into the format sent to clients.
+        """
+        if self.status == 'sent':
+            return {'recipient': self.peer, 'message': self.message,
+                    'timestamp': self.timestamp}
+        return {'from': self.peer, 'message': self.message,
+                'timestamp': self.timestamp}
+
+
+def _decode_store_object(obj: dict):
+    """
+    json object_hook turning the messages of users.json into
+    MessageRecord objects while the file is parsed.
+    """
+    # Messages are told apart by their keys, whatever the type of their
+    # timestamp. User records are dicts, so a top-level users object with
+    # users named 'status', 'from' and 'timestamp' is not mistaken for one.
+    if isinstance(obj.get('status'), str) and 'timestamp' in obj \
+            and ('from' in obj or 'recipient' in obj):
+        return MessageRecord.from_dict(obj)
+    return obj
+
+
+def _encode_store_object(obj):
+    """
+    json default hook writing MessageRecord objects in the users.json
+    format.
+    """
+    if isinstance(obj, MessageRecord):
+        return obj.to_dict()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+class JsonStore:
+    """
+    In-memory user store backed by an append-only journal.
+
+    The on-disk layout is the one the server has always used
+    (store/users.json and store/posts.json), plus a journal of the
+    mutations applied since the last snapshot. Journal records carry the
+    list positions they were applied at, so replaying a record that is
+    already part of the snapshot is a no-op.
+
+    The positions of each user's unread messages are indexed, so fetching
+    new messages costs time proportional to the number of new messages.
+    In memory, messages are kept as MessageRecord objects.
+    """
+
+    def __init__(self,
+                 store_dir: str = STORE_DIR_PATH,
+                 users_lock: threading.Lock = None,
+                 posts_lock: threading.Lock = None,
+                 snapshot_interval: float = 5.0,
+                 fsync: bool = False
+                 ):
+        """
+        Initialize a JsonStore object.
+
+        Args:
+            store_dir (str): Directory holding the store files.
+            users_lock (Lock): Lock guarding users and the journal.
+            posts_lock (Lock): Lock guarding the list of all posts.
+            snapshot_interval (float):
+                Seconds between background snapshots.
+            fsync (bool): Whether to fsync the journal after every record.
+        """
+        self.store_dir = Path(store_dir)
+        self.users_path = self.store_dir / USERS_PATH
+        self.posts_path = self.store_dir / POSTS_PATH
+        self.journal_path = self.store_dir / JOURNAL_PATH
+        self.rotated_path = self.store_dir / (JOURNAL_PATH + '.1')
+        self.users_lock = users_lock or threading.Lock()
+        self.posts_lock = posts_lock or threading.Lock()
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self._users = {}
+        self._posts = []
+        self._unread = {}
+        self._journal = None
+        self._journal_ends = {}
+        self._dirty = False
+        self._snapshot_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+
+    def _create_files(self) -> None:
+        """
+        Create the store directory and empty snapshot files if missing.
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        if not self.users_path.exists():
+            with self.users_path.open('w') as json_file:
+                json.dump({}, json_file, indent=4)
+        if not self.posts_path.exists():
+            with self.posts_path.open('w') as json_file:
+                json.dump({'posts': []}, json_file, indent=4)
+
+    def load(self) -> None:
+        """
+        Load the snapshot files and replay any journal records on top.
+        """
+        with self.users_lock, self.posts_lock:
+            with self.users_path.open('r') as user_file:
+                self._users = json.load(
+                    user_file, object_hook=_decode_store_object
+                    )
+            with self.posts_path.open('r') as posts_file:
+                self._posts = json.load(posts_file)['posts']
+            self._unread = {
+                username: [index for index, message
+                           in enumerate(user['messages'])
+                           if message.status == 'new']
+                for username, user in self._users.items()
+            }
+            replayed = 0
+            for path in (self.rotated_path, self.journal_path):
+                replayed += self._replay(path)
+            self._dirty = replayed > 0
+
+    def _replay(self, path: Path) -> int:
+        """
+        Apply every record of a journal file to the in-memory state. The
+        offset after the last complete record is kept in _journal_ends, so
+        open() can cut off a record torn by a crash.
+
+        Args:
+            path (Path): The journal file to replay.
+
+        Returns:
+            int: The number of records read from the journal.
+        """
+        if not path.exists():
+            return 0
+        count = 0
+        end = 0
+        with path.open('rb') as journal:
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    # A torn final record from a crash mid-write.
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record)
+                count += 1
+                end += len(line)
+        self._journal_ends[path] = end
+        return count
+
+    def _truncate_torn_records(self) -> None:
+        """
+        Cut the journals back to their last complete record, so records
+        appended after a torn one are not lost on the next replay.
+        """
+        for path, end in self._journal_ends.items():
+            if path.exists() and path.stat().st_size > end:
+                print(f'Dropping a torn record at the end of {path.name}')
+                with path.open('r+b') as journal:
+                    journal.truncate(end)
+        self._journal_ends = {}
+
+    def open(self) -> None:
+        """
+        Create the store if needed, load it, open the journal for appending
+        and start the background snapshot thread.
+        """
+        self._create_files()
+        self.load()
+        self._truncate_torn_records()
+        self._journal = self.journal_path.open('a', encoding='utf-8')
+        self._stop.clear()
+        self._snapshot_thread = threading.Thread(
+            target=self._snapshot_loop, daemon=True
+            )
+        self._snapshot_thread.start()
+
+    def close(self) -> None:
+        """
+        Stop the snapshot thread, write a final snapshot and close the
+        journal.
+        """
+        self._stop.set()
+        if self._snapshot_thread:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        if self._journal:
+            self.snapshot()
+            self._journal.close()
+            self._journal = None
+
+    def _snapshot_loop(self) -> None:
+        """
+        Periodically fold the journal into the snapshot files.
+        """
+        while not self._stop.wait(self.snapshot_interval):
+            if self._dirty:
+                try:
+                    self.snapshot()
+                except OSError as e:
+                    print(f'Snapshot failed: {e}')
+
+    def snapshot(self) -> None:
+        """
+        Write users.json and posts.json from memory and discard the journal
+        records they now contain.
+
+        The journal is rotated first and the users are then serialized a
+        few at a time, so commands only wait for one chunk. Changes made
+        in the meantime may or may not be part of the snapshot, but they
+        are all in the new journal, whose replay skips what the snapshot
+        already holds.
+        """
+        with self._snapshot_lock:
+            with self.users_lock, self.posts_lock:
+                self._rotate_journal()
+                # Cleared here so changes made while writing set it again,
+                # and set back below if writing fails.
+                self._dirty = False
+                usernames = list(self._users)
+                posts = list(self._posts)
+            users_data = '{' + ', '.join(
+                f'{json.dumps(username)}: {self._dump_user(username)}'
+                for username in usernames
+                ) + '}'
+            posts_data = json.dumps({'posts': posts})
+            try:
+                _write_atomic(self.users_path, users_data)
+                _write_atomic(self.posts_path, posts_data)
+                self.rotated_path.unlink(missing_ok=True)
+            except BaseException:
+                # The rotated journal is kept and folded into the next
+                # snapshot, so make sure there is one.
+                with self.users_lock:
+                    self._dirty = True
+                raise
+
+    def _dump_user(self, username: str) -> str:
+        """
+        Serialize a user in the users.json format, holding users_lock for
+        at most SNAPSHOT_CHUNK messages at a time. Messages are only ever
+        appended, so the chunks are positions in the list.
+
+        Args:
+            username (str): The user to serialize.
+
+        Returns:
+            str: The user as a JSON object.
+        """
+        with self.users_lock:
+            user = self._users[username]
+            head = json.dumps({key: value for key, value in user.items()
+                               if key != 'messages'})
+            messages = user.get('messages')
+            count = len(messages) if messages is not None else 0
+        if messages is None:
+            return head
+        chunks = []
+        for start in range(0, count, SNAPSHOT_CHUNK):
+            with self.users_lock:
+                chunk = json.dumps(
+                    messages[start:min(start + SNAPSHOT_CHUNK, count)],
+                    default=_encode_store_object
+                    )
+            chunks.append(chunk[1:-1])
+        separator = ', ' if head != '{}' else ''
+        return f'{head[:-1]}{separator}"messages": [{", ".join(chunks)}]}}'
+
+    def _rotate_journal(self) -> None:
+        """
+        Move the current journal aside and start a new one. Must be called
+        with users_lock held.
+        """
+        if self._journal is None:
+            return
+        self._journal.close()
+        if self.rotated_path.exists():
+            # A previous snapshot did not finish, keep its records too.
+            with self.rotated_path.open('ab') as rotated, \
+                    self.journal_path.open('rb') as current:
+                shutil.copyfileobj(current, rotated)
+            self.journal_path.unlink()
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self._journal = self.journal_path.open('a', encoding='utf-8')
+
+    def _record(self, record: dict) -> None:
+        """
+        Append a record to the journal and apply it. Must be called with
+        users_lock held.
+
+        Args:
+            record (dict): The mutation to journal and apply.
+        """
+        if self._journal:
+            self._journal.write(json.dumps(record) + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+        self._apply(record)
+        self._dirty = True
+
+    def _apply(self, record: dict) -> None:
+        """
+        Apply a journal record to the in-memory state. Records that are
+        already reflected in the state are skipped.
+
+        Args:
+            record (dict): The mutation to apply.
+        """
+        op = record['op']
+        username = record['username']
+        if op == 'user':
+            if username not in self._users:
+                self._users[username] = {
+                    'password': record['password'],
+                    'bio': {'entry': '', 'timestamp': ''},
+                    'posts': [],
+                    'messages': []
+                }
+        elif op == 'bio':
+            self._users[username]['bio'] = {
+                'entry': record['entry'], 'timestamp': record['timestamp']
+            }
+        elif op == 'post':
+            post = {
+                'user': username,
+                'entry': record['entry'],
+                'timestamp': record['timestamp']
+            }
+            user_posts = self._users[username]['posts']
+            if len(user_posts) == record['n']:
+                user_posts.insert(0, dict(post))
+            if len(self._posts) == record['total']:
+                self._posts.insert(0, post)
+        elif op == 'message':
+            sent = self._users[username]['messages']
+            if len(sent) == record['sender_n']:
+                sent.append(MessageRecord(
+                    record['recipient'], record['entry'],
+                    record['timestamp'], 'sent'
+                    ))
+            received = self._users[record['recipient']]['messages']
+            if len(received) == record['recipient_n']:
+                self._unread.setdefault(record['recipient'], []).append(
+                    len(received)
+                    )
+                received.append(MessageRecord(
+                    username, record['entry'], record['timestamp'], 'new'
+                    ))
+        elif op == 'batch':
+            for batched in record['records']:
+                self._apply(batched)
+        elif op == 'read':
+            messages = self._users[username]['messages']
+            for index in record['indices']:
+                messages[index].status = 'read'
+            unread = self._unread.get(username)
+            if unread == record['indices']:
+                self._unread[username] = []
+            elif unread:
+                read = set(record['indices'])
+                self._unread[username] = [
+                    index for index in unread if index not in read
+                ]
+
+    def get_user(self, username: str) -> dict:
+        """
+        Get a copy of the bio and posts of a user.
+
+        Args:
+            username (str): The user to look up.
+
+        Returns:
+            dict: The user's bio and posts, or None if the user is unknown.
+        """
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return None
+            return {
+                'bio': dict(fetched_user['bio']),
+                'posts': list(fetched_user['posts'])
+            }
+
+    def get_posts(self) -> list:
+        """
+        Get the posts of all users, newest first.
+
+        Returns:
+            list: A copy of the list of all posts.
+        """
+        with self.posts_lock:
+            return list(self._posts)
+
+    def get_or_create_user(self, username: str, password: str):
+        """
+        Get the user record for username, creating the user if needed.
+
+        Args:
+            username (str): The user to look up or create.
+            password (str): The password for a newly created user.
+
+        Returns:
+            dict: The existing user record, or None if the user was created.
+        """
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if fetched_user:
+                return fetched_user
+            self._record({
+                'op': 'user', 'username': username, 'password': password
+            })
+            return None
+
+    def update_bio(self, username: str, entry: str, timestamp: str) -> bool:
+        """
+        Update the bio of a user.
+
+        Returns:
+            bool: True if the bio was updated, False if the user is unknown.
+        """
+        with self.users_lock:
+            if username not in self._users:
+                return False
+            self._record({
+                'op': 'bio', 'username': username,
+                'entry': entry, 'timestamp': timestamp
+            })
+            return True
+
+    def create_post(self, username: str, entry: str, timestamp: str) -> bool:
+        """
+        Add a post to the user's posts and to the list of all posts.
+
+        Returns:
+            bool: True if the post was created, False if the user is unknown.
+        """
+        with self.users_lock, self.posts_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return False
+            self._record({
+                'op': 'post', 'username': username,
+                'entry': entry, 'timestamp': timestamp,
+                'n': len(fetched_user['posts']), 'total': len(self._posts)
+            })
+            return True
+
+    def send_message(self,
+                     entry: str,
+                     username: str,
+                     recipient: str,
+                     timestamp: str = ''
+                     ) -> bool:
+        """
+        Store a direct message from username to recipient.
+
+        Returns:
+            bool: True if the message was stored, False if either user is
+            unknown.
+        """
+        with self.users_lock:
+            fetched_sender = self._users.get(username, None)
+            fetched_user = self._users.get(recipient, None)
+            if not fetched_sender or not fetched_user:
+                return False
+            sender_n = len(fetched_sender['messages'])
+            recipient_n = len(fetched_user['messages'])
+            if username == recipient:
+                recipient_n += 1
+            self._record({
+                'op': 'message', 'username': username,
+                'recipient': recipient, 'entry': entry,
+                'timestamp': timestamp,
+                'sender_n': sender_n, 'recipient_n': recipient_n
+            })
+            return True
+
+    def send_messages(self,
+                      username: str,
+                      messages: list,
+                      timestamp: str = ''
+                      ) -> list:
+        """
+        Store several direct messages from username as one journal record,
+        so either all of them or none of them survive a crash.
+
+        Args:
+            username (str): The sender.
+            messages (list): (entry, recipient) pairs.
+            timestamp (str): The timestamp of the messages.
+
+        Returns:
+            list: For each pair, True if it was stored, False if the
+            recipient is unknown. All False if the sender is unknown.
+        """
+        with self.users_lock:
+            if username not in self._users:
+                return [False] * len(messages)
+            lengths = {}
+            records = []
+            results = []
+            for entry, recipient in messages:
+                if recipient not in self._users:
+                    results.append(False)
+                    continue
+                for name in (username, recipient):
+                    if name not in lengths:
+                        lengths[name] = len(self._users[name]['messages'])
+                sender_n = lengths[username]
+                lengths[username] += 1
+                recipient_n = lengths[recipient]
+                lengths[recipient] += 1
+                records.append({
+                    'op': 'message', 'username': username,
+                    'recipient': recipient, 'entry': entry,
+                    'timestamp': timestamp,
+                    'sender_n': sender_n, 'recipient_n': recipient_n
+                })
+                results.append(True)
+            if records:
+                self._record({
+                    'op': 'batch', 'username': username, 'records': records
+                })
+            return results
+
+    def read_all_messages(self, username: str):
+        """
+        Get every message of a user and mark the new ones as read.
+
+        Returns:
+            list: The messages sorted by timestamp, or False if the user is
+            unknown.
+        """
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return False
+            result = [message.to_response()
+                      for message in fetched_user['messages']]
+            unread = self._unread.get(username)
+            if unread:
+                self._record({
+                    'op': 'read', 'username': username, 'indices': unread
+                })
+        return sorted(result, key=lambda x: float(x['timestamp']))
+
+    def read_messages_since(self, username: str, since: int = None,
+                            limit: int = 100):
+        """
+        Get one page of a user's message history without changing the
+        status of the messages.
+
+        Args:
+            username (str): The user whose history to read.
+            since (int): Position after which to start, None for the start.
+            limit (int): The largest number of messages to return.
+
+        Returns:
+            tuple: The messages and the cursor of the next page, or False if
+            the user is unknown.
+        """
+        start = since or 0
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return False
+            page = fetched_user['messages'][start:start + limit]
+        result = [message.to_response() for message in page]
+        return result, start + len(result)
+
+    def read_new_messages(self, username: str):
+        """
+        Get the new messages of a user and mark them as read.
+
+        Returns:
+            list: The new messages sorted by timestamp, or False if the user
+            is unknown.
+        """
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return False
+            unread = self._unread.get(username)
+            if not unread:
+                return []
+            messages = fetched_user['messages']
+            result = [messages[index].to_response() for index in unread]
+            self._record({
+                'op': 'read', 'username': username, 'indices': unread
+            })
+        return sorted(result, key=lambda x: float(x['timestamp']))
+
+    def peek_new_messages(self, username: str, after: int = None):
+        """
+        Get the new messages of a user without marking them as read, for
+        delivering them before calling mark_read.
+
+        Args:
+            username (str): The user whose messages to get.
+            after (int): Only get the messages stored after this key, as
+                returned by an earlier call. None for every new message.
+
+        Returns:
+            tuple: The new messages sorted by timestamp and their keys in
+            the order they were stored, or False if the user is unknown.
+        """
+        with self.users_lock:
+            fetched_user = self._users.get(username, None)
+            if not fetched_user:
+                return False
+            unread = self._unread.get(username) or []
+            if after is not None:
+                unread = unread[bisect_right(unread, after):]
+            else:
+                unread = list(unread)
+            messages = fetched_user['messages']
+            result = [messages[index].to_response() for index in unread]
+        return sorted(result, key=lambda x: float(x['timestamp'])), unread
+
+    def mark_read(self, username: str, keys: list) -> None:
+        """
+        Mark messages returned by peek_new_messages as read. Messages read
+        in the meantime are skipped.
+
+        Args:
+            username (str): The user the messages belong to.
+            keys (list): The keys returned by peek_new_messages.
+        """
+        with self.users_lock:
+            unread = self._unread.get(username)
+            if not unread:
+                return
+            keys = set(keys)
+            indices = [index for index in unread if index in keys]
+            if indices:
+                self._record({
+                    'op': 'read', 'username': username, 'indices': indices
+                })
+
+
+class SqliteStore:
+    """
+    Store backed by a SQLite database (store/users.db).
+
+    Messages live in their own table indexed on (username, status) and
+    (username, timestamp), so fetching new messages is an indexed query and
+    every operation is a small transaction instead of a whole-file rewrite.
+    """
+
+    def __init__(self,
+                 store_dir: str = STORE_DIR_PATH,
+                 users_lock: threading.Lock = None,
+                 posts_lock: threading.Lock = None
+                 ):
+        """
+        Initialize a SqliteStore object.
+
+        Args:
+            store_dir (str): Directory holding the database file.
+            users_lock (Lock): Lock serializing access to the connection.
+            posts_lock (Lock): Unused, accepted for parity with JsonStore.
+        """
+        self.store_dir = Path(store_dir)
+        self.db_path = self.store_dir / DB_PATH
+        self.users_lock = users_lock or threading.Lock()
+        self.posts_lock = posts_lock or threading.Lock()
+        self._conn = None
+
+    def open(self) -> None:
+        """
+        Open the database, creating the schema if needed. A new database is
+        seeded from an existing users.json/posts.json store.
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        is_new = not self.db_path.exists()
+        self._conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, isolation_level=None
+            )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SQLITE_SCHEMA)
+        if is_new:
+            self._import_json()
+
+    def load(self) -> None:
+        """
+        Open the database. Provided for parity with JsonStore.
+        """
+        if self._conn is None:
+            self.open()
+
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        with self.users_lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def _import_json(self) -> None:
+        """
+        Copy the users, messages and posts of the JSON store in the same
+        directory into the database.
+        """
+        legacy = JsonStore(self.store_dir)
+        if not legacy.users_path.exists() or not legacy.posts_path.exists():
+            return
+        legacy.load()
+        with self._conn:
+            self._conn.execute('BEGIN')
+            for username, user in legacy._users.items():
+                self._conn.execute(
+                    'INSERT INTO users VALUES (?, ?, ?, ?)',
+                    (username, user['password'],
+                     user['bio']['entry'], user['bio']['timestamp'])
+                    )
+                self._conn.executemany(
+                    'INSERT INTO messages (username, peer, sent, message, '
+                    'timestamp, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(username, msg.peer, msg.status == 'sent', msg.message,
+                      msg.timestamp, msg.status)
+                     for msg in user['messages']]
+                    )
+            self._conn.executemany(
+                'INSERT INTO posts (username, entry, timestamp) '
+                'VALUES (?, ?, ?)',
+                [(post['user'], post['entry'], post['timestamp'])
+                 for post in reversed(legacy._posts)]
+                )
+
+    def get_user(self, username: str) -> dict:
+        """
+        Get the bio and posts of a user.
+
+        Args:
+            username (str): The user to look up.
+
+        Returns:
+            dict: The user's bio and posts, or None if the user is unknown.
+        """
+        with self.users_lock:
+            row = self._conn.execute(
+                'SELECT bio_entry, bio_timestamp FROM users '
+                'WHERE username = ?', (username,)
+                ).fetchone()
+            if not row:
+                return None
+            posts = self._conn.execute(
+                'SELECT entry, timestamp FROM posts WHERE username = ? '
+                'ORDER BY id DESC', (username,)
+                ).fetchall()
+        return {
+            'bio': {'entry': row[0], 'timestamp': row[1]},
+            'posts': [{'user': username, 'entry': entry, 'timestamp': ts}
+                      for entry, ts in posts]
+        }
+
+    def get_posts(self) -> list:
+        """
+        Get the posts of all users, newest first.
+
+        Returns:
+            list: The list of all posts.
+        """
+        with self.users_lock:
+            rows = self._conn.execute(
+                'SELECT username, entry, timestamp FROM posts '
+                'ORDER BY id DESC'
+                ).fetchall()
+        return [{'user': user, 'entry': entry, 'timestamp': ts}
+                for user, entry, ts in rows]
+
+    def get_or_create_user(self, username: str, password: str):
+        """
+        Get the user record for username, creating the user if needed.
+
+        Args:
+            username (str): The user to look up or create.
+            password (str): The password for a newly created user.
+
+        Returns:
+            dict: The existing user record, or None if the user was created.
+        """
+        with self.users_lock:
+            row = self._conn.execute(
+                'SELECT password FROM users WHERE username = ?', (username,)
+                ).fetchone()
+            if row:
+                return {'password': row[0]}
+            self._conn.execute(
+                "INSERT INTO users VALUES (?, ?, '', '')",
+                (username, password)
+                )
+            return None
+
+    def update_bio(self, username: str, entry: str, timestamp: str) -> bool:
+        """
+        Update the bio of a user.
+
+        Returns:
+            bool: True if the bio was updated, False if the user is unknown.
+        """
+        with self.users_lock:
+            cursor = self._conn.execute(
+                'UPDATE users SET bio_entry = ?, bio_timestamp = ? '
+                'WHERE username = ?', (entry, timestamp, username)
+                )
+            return cursor.rowcount > 0
+
+    def create_post(self, username: str, entry: str, timestamp: str) -> bool:
+        """
+        Add a post for the user.
+
+        Returns:
+            bool: True if the post was created, False if the user is unknown.
+        """
+        with self.users_lock:
+            cursor = self._conn.execute(
+                'INSERT INTO posts (username, entry, timestamp) '
+                'SELECT username, ?, ? FROM users WHERE username = ?',
+                (entry, timestamp, username)
+                )
+            return cursor.rowcount > 0
+
+    def send_message(self,
+                     entry: str,
+                     username: str,
+                     recipient: str,
+                     timestamp: str = ''
+                     ) -> bool:
+        """
+        Store a direct message from username to recipient.
+
+        Returns:
+            bool: True if the message was stored, False if either user is
+            unknown.
+        """
+        with self.users_lock:
+            found = self._conn.execute(
+                'SELECT COUNT(*) FROM users WHERE username IN (?, ?)',
+                (username, recipient)
+                ).fetchone()[0]
+            if found != len({username, recipient}):
+                return False
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT INTO messages (username, peer, sent, message, '
+                    'timestamp, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(username, recipient, True, entry, timestamp, 'sent'),
+                     (recipient, username, False, entry, timestamp, 'new')]
+                    )
+            return True
+
+    def send_messages(self,
+                      username: str,
+                      messages: list,
+                      timestamp: str = ''
+                      ) -> list:
+        """
+        Store several direct messages from username in one transaction.
+
+        Args:
+            username (str): The sender.
+            messages (list): (entry, recipient) pairs.
+            timestamp (str): The timestamp of the messages.
+
+        Returns:
+            list: For each pair, True if it was stored, False if the
+            recipient is unknown. All False if the sender is unknown.
+        """
+        with self.users_lock:
+            if not self._user_exists(username):
+                return [False] * len(messages)
+            names = list({recipient for _, recipient in messages})
+            known = set()
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                known.update(row[0] for row in self._conn.execute(
+                    'SELECT username FROM users WHERE username IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk
+                    ))
+            rows = []
+            for entry, recipient in messages:
+                if recipient in known:
+                    rows.append(
+                        (username, recipient, True, entry, timestamp, 'sent')
+                        )
+                    rows.append(
+                        (recipient, username, False, entry, timestamp, 'new')
+                        )
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT INTO messages (username, peer, sent, message, '
+                    'timestamp, status) VALUES (?, ?, ?, ?, ?, ?)', rows
+                    )
+            return [recipient in known for _, recipient in messages]
+
+    def read_all_messages(self, username: str):
+        """
+        Get every message of a user and mark the new ones as read.
+
+        Returns:
+            list: The messages sorted by timestamp, or False if the user is
+            unknown.
+        """
+        with self.users_lock:
+            if not self._user_exists(username):
+                return False
+            with self._conn:
+                self._conn.execute('BEGIN')
+                rows = self._conn.execute(
+                    'SELECT peer, sent, message, timestamp FROM messages '
+                    'WHERE username = ? ORDER BY id', (username,)
+                    ).fetchall()
+                self._conn.execute(
+                    "UPDATE messages SET status = 'read' "
+                    "WHERE username = ? AND status = 'new'", (username,)
+                    )
+        result = [
+            {'recipient' if sent else 'from': peer,
+             'message': message, 'timestamp': timestamp}
+            for peer, sent, message, timestamp in rows
+        ]
+        return sorted(result, key=lambda x: float(x['timestamp']))
+
+    def read_new_messages(self, username: str):
+        """
+        Get the new messages of a user and mark them as read.
+
+        Returns:
+            list: The new messages sorted by timestamp, or False if the user
+            is unknown.
+        """
+        with self.users_lock:
+            if not self._user_exists(username):
+                return False
+            with self._conn:
+                self._conn.execute('BEGIN')
+                rows = self._conn.execute(
+                    'SELECT id, peer, message, timestamp FROM messages '
+                    "WHERE username = ? AND status = 'new'", (username,)
+                    ).fetchall()
+                self._conn.executemany(
+                    "UPDATE messages SET status = 'read' WHERE id = ?",
+                    [(row[0],) for row in rows]
+                    )
+        result = [
+            {'from': peer, 'message': message, 'timestamp': timestamp}
+            for _, peer, message, timestamp in rows
+        ]
+        return sorted(result, key=lambda x: float(x['timestamp']))
+
+    def peek_new_messages(self, username: str, after: int = None):
+        """
+        Get the new messages of a user without marking them as read, for
+        delivering them before calling mark_read.
+
+        Args:
+            username (str): The user whose messages to get.
+            after (int): Only get the messages stored after this key, as
+                returned by an earlier call. None for every new message.
+
+        Returns:
+            tuple: The new messages sorted by timestamp and their keys in
+            the order they were stored, or False if the user is unknown.
+        """
+        with self.users_lock:
+            if not self._user_exists(username):
+                return False
+            rows = self._conn.execute(
+                'SELECT id, peer, message, timestamp FROM messages '
+                "WHERE username = ? AND status = 'new' AND id > ? "
+                'ORDER BY id', (username, after or 0)
+                ).fetchall()
+        result = [
+            {'from': peer, 'message': message, 'timestamp': timestamp}
+            for _, peer, message, timestamp in rows
+        ]
+        return (sorted(result, key=lambda x: float(x['timestamp'])),
+                [row[0] for row in rows])
+
+    def mark_read(self, username: str, keys: list) -> None:
+        """
+        Mark messages returned by peek_new_messages as read.
+
+        Args:
+            username (str): The user the messages belong to.
+            keys (list): The keys returned by peek_new_messages.
+        """
+        with self.users_lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    "UPDATE messages SET status = 'read' "
+                    "WHERE id = ? AND username = ? AND status = 'new'",
+                    [(key, username) for key in keys]
+                    )
+
+    def read_messages_since(self, username: str, since: int = None,
+                            limit: int = 100):
+        """
+        Get one page of a user's message history without changing the
+        status of the messages.
+
+        Args:
+            username (str): The user whose history to read.
+            since (int): Message id after which to start, None for the start.
+            limit (int): The largest number of messages to return.
+
+        Returns:
+            tuple: The messages and the cursor of the next page, or False if
+            the user is unknown.
+        """
+        start = since or 0
+        with self.users_lock:
+            if not self._user_exists(username):
+                return False
+            rows = self._conn.execute(
+                'SELECT id, peer, sent, message, timestamp FROM messages '
+                'WHERE username = ? AND id > ? ORDER BY id LIMIT ?',
+                (username, start, limit)
+                ).fetchall()
+        result = [
+            {'recipient' if sent else 'from': peer,
+             'message': message, 'timestamp': timestamp}
+            for _, peer, sent, message, timestamp in rows
+        ]
+        return result, rows[-1][0] if rows else start
+
+    def _user_exists(self, username: str) -> bool:
+        """
+        Check whether a user exists. Must be called with users_lock held.
+        """
+        return self._conn.execute(
+            'SELECT 1 FROM users WHERE username = ?', (username,)
+            ).fetchone() is not None
+
+
+STORES = {
+    'json': JsonStore,
+    'sqlite': SqliteStore,
+}
+
+
+def create_store(name: str,
+                 store_dir: str = STORE_DIR_PATH,
+                 users_lock: threading.Lock = None,
+                 posts_lock: threading.Lock = None
+                 ):
+    """
+    Create a storage backend by name.
+
+    Args:
+        name (str): The backend to create ('json' or 'sqlite').
+        store_dir (str): Directory holding the store files.
+        users_lock (Lock): Lock guarding user data.
+        posts_lock (Lock): Lock guarding the list of all posts.
+
+    Returns:
+        The storage backend.
+
+    Raises:
+        ValueError: If there is no backend with that name.
+    """
+    try:
+        store_class = STORES[name]
+    except KeyError as key_error:
+        raise ValueError(f'Unknown storage backend: {name}') from key_error
+    return store_class(store_dir, users_lock, posts_lock)
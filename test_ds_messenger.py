@@ -7,8 +7,15 @@ in the ds_messenger module.
 
 """
 
+import asyncio
+import json
 import socket
-from ds_messenger import DirectMessenger, DirectMessage
+import threading
+import time
+import pytest
+from ds_messenger import DirectMessenger, DirectMessage, AsyncDirectMessenger
+from ds_messenger import DirectMessengerPool, Outbox
+from ds_protocol import FrameDecoder
 
 
 class ServerNotRunningError(Exception):
@@ -53,6 +60,10 @@ def test_direct_message_instance():
     assert msg.timestamp == 'time_stamp'
     assert msg.from_user is True
 
+    assert not hasattr(msg, '__dict__')
+    copy = DirectMessage.from_dictionary(msg.dictionary_user_info())
+    assert copy.dictionary_user_info() == msg.dictionary_user_info()
+
     assert msg.print_user_info() is True
     assert msg.dictionary_user_info() == {
         'sender': 'sender',
@@ -169,3 +180,359 @@ def test_direct_messenger_retrieve_messages_invalid_server():
     direct_msgr = DirectMessenger('local_host', 'test1', 'test1')
     messages = direct_msgr.retrieve_messages('all')
     assert not messages
+
+
+def test_direct_messenger_iter_messages_invalid_server():
+    """
+    Test the DirectMessenger iter_messages method with an invalid server.
+    """
+    direct_msgr = DirectMessenger('local_host', 'test1', 'test1')
+    assert not list(direct_msgr.iter_messages('all'))
+
+
+def test_direct_messenger_iter_history_invalid_server():
+    """
+    Test the DirectMessenger iter_history method with an invalid server.
+    """
+    direct_msgr = DirectMessenger('local_host', 'test1', 'test1')
+    assert not list(direct_msgr.iter_history())
+    assert direct_msgr.history_cursor is None
+
+
+def test_direct_messenger_send_many_invalid_server():
+    """
+    Test the DirectMessenger send_many method with an invalid server.
+    """
+    direct_msgr = DirectMessenger('local_host', 'test1', 'test1')
+    assert direct_msgr.send_many([('test2', 'a'), ('test3', 'b')]) == [
+        False, False
+    ]
+    assert not direct_msgr.send_many([])
+
+
+def test_direct_messenger_context_manager():
+    """
+    Test that DirectMessenger works as a context manager
+    and closes its connection on exit.
+    """
+    with DirectMessenger('local_host', 'test1', 'test1') as direct_msgr:
+        assert direct_msgr.send('TESTING', 'test2') is False
+    assert direct_msgr.token is None
+    direct_msgr.close()
+
+
+def test_async_direct_messenger_invalid_server():
+    """
+    Test the AsyncDirectMessenger methods with an invalid server.
+    """
+    async def run():
+        async with AsyncDirectMessenger(
+                'local_host', 'test1', 'test1') as direct_msgr:
+            assert direct_msgr.port == 3001
+            assert await direct_msgr.send('TESTING', 'test2') is False
+            assert await direct_msgr.retrieve_new() == []
+            assert await direct_msgr.retrieve_all() == []
+        assert direct_msgr.token is None
+
+    asyncio.run(run())
+
+
+def test_direct_messenger_pool_limits():
+    """
+    Test that DirectMessengerPool hands out at most max_per_user
+    messengers per user and reuses released ones.
+    """
+    with DirectMessengerPool(max_per_user=1, port=3005) as pool:
+        with pool.connection('local_host', 'test1', 'test1') as messenger:
+            assert isinstance(messenger, DirectMessenger)
+            assert messenger.port == 3005
+            assert pool.stats() == {'idle': 0, 'in_use': 1}
+            with pytest.raises(TimeoutError):
+                pool.acquire('local_host', 'test1', 'test1', timeout=0.01)
+            other = pool.acquire('local_host', 'test2', 'test2', timeout=0)
+            pool.release(other)
+        assert pool.stats() == {'idle': 0, 'in_use': 0}
+        assert pool.send('local_host', 'test1', 'test1', 'hi', 'x') is False
+    with pytest.raises(RuntimeError):
+        pool.acquire('local_host', 'test1', 'test1')
+
+
+def test_outbox_keeps_messages_until_delivered(tmp_path):
+    """
+    Test that queued messages survive a reload and are kept, with a
+    backoff delay, while the server cannot be reached.
+    """
+    outbox = Outbox.for_profile(tmp_path / 'profile.dsu', base_delay=60)
+    assert outbox.path == tmp_path / 'profile.outbox'
+    outbox.enqueue('one', 'test2')
+    outbox.enqueue('two', 'test3')
+
+    reloaded = Outbox(tmp_path / 'profile.outbox', base_delay=60)
+    assert reloaded.pending() == [('test2', 'one'), ('test3', 'two')]
+    with DirectMessenger('local_host', 'test1', 'test1') as direct_msgr:
+        assert reloaded.flush(direct_msgr) == 0
+        assert reloaded.failures == 1
+        # Still waiting for the backoff delay, so nothing is attempted.
+        assert reloaded.flush(direct_msgr) == 0
+        assert reloaded.failures == 1
+    assert len(Outbox(tmp_path / 'profile.outbox')) == 2
+
+
+def test_direct_messenger_is_connected():
+    """
+    Test that is_connected detects a connection the server closed or
+    sent something unexpected on, without blocking.
+    """
+    direct_msgr = DirectMessenger('127.0.0.1', 'test1', 'test1')
+    assert not direct_msgr.is_connected()
+    for unexpected in (b'x', b''):
+        client, server = socket.socketpair()
+        client.settimeout(30)
+        direct_msgr._client = client
+        direct_msgr._decoder = FrameDecoder()
+        assert direct_msgr.is_connected()
+        if unexpected:
+            server.sendall(unexpected)
+        else:
+            server.close()
+        assert not direct_msgr.is_connected()
+        direct_msgr.close()
+        server.close()
+
+
+class FakeServer:
+    """
+    A DSU server on a free port that accepts every join and answers the
+    other requests with respond, closing the connection when it returns
+    None.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._handle, args=(client,), daemon=True
+                ).start()
+
+    def _handle(self, client):
+        with client, client.makefile('rb') as lines:
+            for line in lines:
+                request = json.loads(line)
+                if 'join' in request:
+                    resp = {'type': 'ok', 'message': '', 'token': 'abc'}
+                else:
+                    self.requests.append(request)
+                    resp = self.respond(request)
+                    if resp is None:
+                        return
+                client.sendall(
+                    json.dumps({'response': resp}).encode() + b'\r\n'
+                    )
+
+    def close(self):
+        self.listener.close()
+
+
+def test_direct_messenger_retries_send_with_same_id():
+    """
+    Test that a send retried after the server dropped the connection
+    carries the same message id.
+    """
+    def respond(request):
+        if len(server.requests) == 1:
+            return None
+        return {'type': 'ok', 'message': 'Direct message sent'}
+
+    server = FakeServer(respond)
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        assert direct_msgr.send('TESTING', 'test2')
+    server.close()
+    ids = [request['directmessage']['id'] for request in server.requests]
+    assert len(ids) == 2 and ids[0] == ids[1]
+
+
+def test_direct_messenger_does_not_resend_new():
+    """
+    Test that a request for new messages is not sent again when the
+    connection drops, since the server may have marked them read.
+    """
+    server = FakeServer(lambda request: None)
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        assert direct_msgr.retrieve_new() == []
+    server.close()
+    assert server.requests == [{'token': 'abc', 'directmessage': 'new'}]
+
+
+def test_direct_messenger_times_out():
+    """
+    Test that a request the server never answers fails after timeout
+    without being sent again.
+    """
+    answer = threading.Event()
+
+    def respond(request):
+        answer.wait(5)
+        return {'type': 'ok', 'message': 'Direct message sent'}
+
+    server = FakeServer(respond)
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        direct_msgr.timeout = 0.2
+        start = time.monotonic()
+        assert direct_msgr.send('TESTING', 'test2') is False
+        assert time.monotonic() - start < 2
+    answer.set()
+    server.close()
+    assert len(server.requests) == 1
+
+
+def test_async_direct_messenger_does_not_resend_new():
+    """
+    Test that AsyncDirectMessenger sends a message id and does not send
+    a request for new messages again when the connection drops.
+    """
+    def respond(request):
+        if request['directmessage'] == 'new':
+            return None
+        return {'type': 'ok', 'message': 'Direct message sent'}
+
+    async def run():
+        async with AsyncDirectMessenger(
+                '127.0.0.1', 'test1', 'test1') as direct_msgr:
+            direct_msgr.port = server.port
+            assert await direct_msgr.send('TESTING', 'test2')
+            assert await direct_msgr.retrieve_new() == []
+
+    server = FakeServer(respond)
+    asyncio.run(run())
+    server.close()
+    assert server.requests[0]['directmessage']['id']
+    assert server.requests[1:] == [{'token': 'abc', 'directmessage': 'new'}]
+
+
+def test_outbox_flush_keeps_rejected_messages(tmp_path):
+    """
+    Test that messages can be queued while a flush is sending and are
+    sent by it, and that messages the server refused are kept across a
+    reload until cleared.
+    """
+    sending = threading.Event()
+    answer = threading.Event()
+
+    def respond(request):
+        sending.set()
+        answer.wait(5)
+        results = ['ok', 'error'][:len(request['directmessages'])]
+        return {'type': 'ok', 'message': '', 'results': results}
+
+    server = FakeServer(respond)
+    outbox = Outbox(tmp_path / 'profile.outbox')
+    outbox.enqueue('one', 'test2')
+    outbox.enqueue('two', 'nobody')
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        flushed = []
+        flusher = threading.Thread(
+            target=lambda: flushed.append(outbox.flush(direct_msgr)))
+        flusher.start()
+        assert sending.wait(5)
+        outbox.enqueue('three', 'test2')
+        assert outbox.flush(direct_msgr) == 0
+        answer.set()
+        flusher.join(5)
+    server.close()
+    assert flushed == [2]
+    assert outbox.pending() == []
+
+    reloaded = Outbox(tmp_path / 'profile.outbox')
+    assert reloaded.rejected() == [('nobody', 'two')]
+    assert len(reloaded) == 0
+    reloaded.clear_rejected()
+    assert not (tmp_path / 'profile.outbox').exists()
+
+
+def test_outbox_flush_keeps_messages_refused_as_a_whole(tmp_path):
+    """
+    Test that a batch the server refuses as a whole stays queued with a
+    backoff delay, and that later batches are split until the server
+    accepts them.
+    """
+    busy = [True]
+
+    def respond(request):
+        items = request['directmessages']
+        if busy[0]:
+            busy[0] = False
+            return {'type': 'error', 'message':
+                    'Messages with the same ids are being sent, '
+                    'try again later.'}
+        if len(items) > 1:
+            return {'type': 'error', 'message':
+                    'Too many direct messages in one request (at most 1).'}
+        return {'type': 'ok', 'message': '', 'results': ['ok'] * len(items)}
+
+    server = FakeServer(respond)
+    outbox = Outbox(tmp_path / 'profile.outbox', batch_size=8,
+                    base_delay=60)
+    for number in range(5):
+        outbox.enqueue(str(number), 'test2')
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        assert outbox.flush(direct_msgr) == 0
+        assert outbox.failures == 1
+        assert len(outbox) == 5
+        assert outbox.flush(direct_msgr) == 0
+        assert len(server.requests) == 1
+        assert outbox.flush(direct_msgr, force=True) == 0
+        assert outbox.failures == 2
+        assert outbox.flush(direct_msgr, force=True) == 5
+    server.close()
+    assert [len(request['directmessages'])
+            for request in server.requests] == [5, 2, 1, 1, 1, 1, 1]
+    assert outbox.failures == 0
+    assert outbox.rejected() == []
+    assert not (tmp_path / 'profile.outbox').exists()
+
+
+def test_direct_messenger_requests_while_iterating():
+    """
+    Test that other threads can make requests while messages are being
+    iterated, and after the iterator was abandoned.
+    """
+    def respond(request):
+        if request['directmessage'] == 'all':
+            return {'type': 'ok', 'messages': [
+                {'from': 'test2', 'message': str(i), 'timestamp': '1'}
+                for i in range(3)
+                ]}
+        return {'type': 'ok', 'message': 'Direct message sent'}
+
+    server = FakeServer(respond)
+    with DirectMessenger('127.0.0.1', 'test1', 'test1') as direct_msgr:
+        direct_msgr.port = server.port
+        messages = direct_msgr.iter_messages('all')
+        assert next(messages).message == '0'
+        sent = []
+        sender = threading.Thread(
+            target=lambda: sent.append(direct_msgr.send('hi', 'test2')))
+        sender.start()
+        sender.join(5)
+        assert sent == [True]
+        messages.close()
+        assert [dm.message for dm in direct_msgr.retrieve_all()] == [
+            '0', '1', '2'
+        ]
+        assert direct_msgr.is_connected()
+    server.close()
@@ -10,9 +10,16 @@ coverage report -m
 """
 
 import json
+import pytest
 from ds_protocol import extract_json, format_join_msg
 from ds_protocol import format_direct_msg, extract_direct_message
-from ds_protocol import format_msg_request
+from ds_protocol import format_msg_request, format_history_request
+from ds_protocol import extract_history_page, format_subscribe_msg
+from ds_protocol import extract_pushed_messages, format_direct_msgs
+from ds_protocol import extract_batch_results, iter_direct_messages
+from ds_protocol import DEFAULT_CODEC, JsonCodec, get_codec, select_codec
+from ds_protocol import encode_frame, extract_codec
+from ds_protocol import FrameDecoder, FrameTooLongError, BinaryCodec
 
 
 def test_extract_json():
@@ -73,6 +80,8 @@ def test_format_direct_msg():
         {"entry": "Hello", "recipient": "user2", "timestamp": "2025-03-02"}
     }
     assert json.loads(result) == expected
+    result = format_direct_msg("token123", "Hello", "user2", "1.0", "abc")
+    assert json.loads(result)["directmessage"]["id"] == "abc"
 
 
 def test_extract_direct_message():
@@ -127,6 +136,34 @@ def test_extract_direct_message():
     assert not result
 
 
+def test_iter_direct_messages():
+    """
+    Test the iter_direct_messages function
+    to ensure it parses direct messages split across chunks.
+    """
+    messages = [
+        {"from": "user1", "message": "Hello, \"you\" }]", "timestamp": "1"},
+        {"recipient": "user2", "message": "Hi", "timestamp": "2"}
+    ]
+    json_msg = json.dumps({"response": {"type": "ok", "messages": messages}})
+    for size in (1, 7, len(json_msg)):
+        chunks = [json_msg[i:i + size] for i in range(0, len(json_msg), size)]
+        assert list(iter_direct_messages(chunks + ["\r\n"])) == messages
+
+    json_msg = json.dumps({
+        "response": {"type": "ok", "messages": [], "cursor": 12}
+    })
+    assert not list(iter_direct_messages([json_msg[:-3], json_msg[-3:]]))
+
+    json_msg = json.dumps({"response": {"type": "error", "messages": messages}})
+    assert not list(iter_direct_messages([json_msg]))
+
+    json_msg = json.dumps({"response": {"type": "ok", "messages": messages}})
+    cut = json_msg.index('}, {') + 3
+    assert list(iter_direct_messages([json_msg[:cut]])) == messages[:1]
+    assert not list(iter_direct_messages(['"response": {"type": "ok"']))
+
+
 def test_format_msg_request():
     """
     Test the format_msg_request function to
@@ -135,3 +172,300 @@ def test_format_msg_request():
     result = format_msg_request("token123", "new")
     expected = {"token": "token123", "directmessage": "new"}
     assert json.loads(result) == expected
+
+
+def test_format_history_request():
+    """
+    Test the format_history_request function to
+    ensure it correctly formats history requests.
+    """
+    result = format_history_request("token123", 40, 10)
+    expected = {
+        "token": "token123",
+        "directmessage": {"since": 40, "limit": 10}
+    }
+    assert json.loads(result) == expected
+
+    result = format_history_request("token123")
+    assert json.loads(result)["directmessage"] == {
+        "since": None, "limit": 100
+    }
+
+
+def test_extract_history_page():
+    """
+    Test the extract_history_page function
+    to ensure it correctly extracts a page of messages and its cursor.
+    """
+    json_msg = json.dumps({
+        "response": {
+            "type": "ok",
+            "messages": [
+                {"from": "user1", "message": "Hello", "timestamp": "1.0"}
+            ],
+            "cursor": 41
+        }
+    })
+    messages, cursor = extract_history_page(json_msg)
+    assert messages[0]["from"] == "user1"
+    assert cursor == 41
+
+    json_msg = json.dumps({
+        "response": {"type": "error", "message": "Invalid user token."}
+    })
+    assert extract_history_page(json_msg) == ([], None)
+
+    json_msg = json.dumps({"response": {"type": "ok", "messages": []}})
+    assert extract_history_page(json_msg) == ([], None)
+
+    assert extract_history_page('{"response": ') == ([], None)
+
+
+def test_format_subscribe_msg():
+    """
+    Test the format_subscribe_msg function to
+    ensure it correctly formats subscribe requests.
+    """
+    result = format_subscribe_msg("token123")
+    assert json.loads(result) == {"token": "token123", "subscribe": True}
+    result = format_subscribe_msg("token123", False)
+    assert json.loads(result) == {"token": "token123", "subscribe": False}
+
+
+def test_extract_pushed_messages():
+    """
+    Test the extract_pushed_messages function
+    to ensure it only extracts messages from directmessage events.
+    """
+    json_msg = json.dumps({
+        "event": {
+            "type": "directmessage",
+            "messages": [
+                {"from": "user1", "message": "Hello", "timestamp": "1.0"}
+            ]
+        }
+    })
+    result = extract_pushed_messages(json_msg)
+    assert result[0]["message"] == "Hello"
+
+    json_msg = json.dumps({
+        "response": {"type": "ok", "message": "Subscribed."}
+    })
+    assert extract_pushed_messages(json_msg) is None
+    assert extract_pushed_messages('{"event": ') is None
+
+
+def test_format_direct_msgs():
+    """
+    Test the format_direct_msgs function
+    to ensure it correctly formats batch direct messages.
+    """
+    result = format_direct_msgs(
+        "token123", [("user2", "Hello"), ("user3", "Hi")], "1.0"
+        )
+    expected = {
+        "token": "token123",
+        "directmessages": [
+            {"entry": "Hello", "recipient": "user2", "timestamp": "1.0"},
+            {"entry": "Hi", "recipient": "user3", "timestamp": "1.0"}
+        ]
+    }
+    assert json.loads(result) == expected
+    result = format_direct_msgs(
+        "token123", [("user2", "Hello"), ("user3", "Hi")], "1.0", ["a", "b"]
+        )
+    assert [msg["id"] for msg in json.loads(result)["directmessages"]] == [
+        "a", "b"
+    ]
+
+
+def test_extract_batch_results():
+    """
+    Test the extract_batch_results function
+    to ensure it correctly extracts per message statuses.
+    """
+    json_msg = json.dumps({
+        "response": {
+            "type": "ok",
+            "message": "1 of 2 direct messages sent",
+            "results": ["ok", "error"]
+        }
+    })
+    assert extract_batch_results(json_msg) == ["ok", "error"]
+
+    json_msg = json.dumps({
+        "response": {"type": "error", "message": "Invalid user token."}
+    })
+    assert not extract_batch_results(json_msg)
+    assert not extract_batch_results('{"response": ')
+
+
+class FramedJsonCodec(JsonCodec):
+    """
+    JSON sent in length-prefixed frames, to test framed codecs without
+    optional dependencies.
+    """
+
+    name = 'framed-json'
+    framed = True
+
+
+def test_codec_registry():
+    """
+    Test that codecs are looked up by name and negotiated in the order
+    of preference of the client.
+    """
+    assert get_codec() is DEFAULT_CODEC
+    assert DEFAULT_CODEC.name in ('json', 'orjson')
+    assert isinstance(get_codec('json'), JsonCodec)
+    with pytest.raises(ValueError):
+        get_codec('unknown')
+    assert select_codec(['unknown', 'json']).name == 'json'
+    assert select_codec('json').name == 'json'
+    assert select_codec('unknown') is None
+    assert select_codec(5) is None
+
+
+def test_encode_frame():
+    """
+    Test that line codecs end objects with a line break and framed
+    codecs prefix them with their length.
+    """
+    assert encode_frame(b'{}') == b'{}\r\n'
+    assert encode_frame(b'{}', get_codec('json')) == b'{}\r\n'
+    assert encode_frame(b'abc', FramedJsonCodec()) == b'\x00\x00\x00\x03abc'
+
+
+def test_format_and_extract_with_codec():
+    """
+    Test that format and extract functions encode and decode with the
+    given codec.
+    """
+    codec = get_codec('json')
+    result = format_msg_request("token123", "all", codec=codec)
+    assert isinstance(result, bytes)
+    assert codec.decode(result) == {
+        "token": "token123", "directmessage": "all"
+    }
+    resp = b'{"response": {"type": "ok", "message": "", "token": "t"}}'
+    assert extract_json(resp, codec) == ("ok", "", "t")
+    assert extract_json(b'\xff', codec) is None
+
+    join = json.loads(format_join_msg("user", "pass", accept=["msgpack"]))
+    assert join["join"]["codec"] == ["msgpack"]
+    assert "codec" not in json.loads(format_join_msg("user", "pass"))["join"]
+    assert extract_codec(
+        '{"response": {"type": "ok", "message": "", "codec": "msgpack"}}'
+        ) == "msgpack"
+    assert extract_codec('{"response": {"type": "ok", "message": ""}}') is None
+    assert extract_codec('not json') is None
+
+
+def test_frame_decoder_lines():
+    """
+    Test that FrameDecoder yields every complete line as an object,
+    whether lines arrive split or several at once.
+    """
+    decoder = FrameDecoder()
+    data = b'{"a": 1}\r\n\r\n  \n{"b": 2}\n{bad}\n{"c"'
+    assert [obj for byte in data for obj in decoder.feed(bytes([byte]))] == [
+        {"a": 1}, {"b": 2}, None
+    ]
+    assert len(decoder) == 4
+    assert list(decoder.feed(b': 3}\n{"d": 4}\n')) == [{"c": 3}, {"d": 4}]
+    assert len(decoder) == 0
+
+    objects = decoder.feed(b'{"e": 5}\n{"f": 6}\n')
+    assert next(objects) == {"e": 5}
+    objects.close()
+    assert list(decoder.feed()) == [{"f": 6}]
+
+    decoder = FrameDecoder(max_size=8)
+    with pytest.raises(FrameTooLongError):
+        list(decoder.feed(b'{"a": "123456"}'))
+    decoder = FrameDecoder(max_size=8)
+    assert list(decoder.feed(b'{"a": 1}\r\n')) == [{"a": 1}]
+    with pytest.raises(FrameTooLongError):
+        list(decoder.feed(b'{"a": "123456"}\r\n'))
+
+
+@pytest.mark.parametrize('name', ['binary', 'msgpack'])
+def test_binary_codecs(name):
+    """
+    Test that the framed binary codecs round trip protocol objects
+    through FrameDecoder and refuse invalid data.
+    """
+    if name == 'msgpack':
+        pytest.importorskip('msgpack')
+    codec = get_codec(name)
+    assert codec.framed
+    resp = {"response": {"type": "ok", "messages": [
+        {"message": "h\u00e9llo\r\n\"\x00", "from": "a",
+         "timestamp": "1.5"}
+    ], "cursor": -3, "limit": 1.5, "flags": [True, False, None]}}
+    data = encode_frame(codec.encode(resp), codec)
+    decoder = FrameDecoder(codec)
+    assert [obj for byte in data for obj in decoder.feed(bytes([byte]))] == [
+        resp
+    ]
+    assert codec.decode(format_msg_request("t", "all", codec=codec)) == {
+        "token": "t", "directmessage": "all"
+    }
+    assert codec.decode(codec.encode(resp)) == resp
+
+    encoded = codec.encode({"a": [1, 2]})
+    for invalid in (encoded[:-1], encoded + encoded):
+        with pytest.raises(ValueError):
+            codec.decode(invalid)
+
+
+def test_binary_codec_invalid_data():
+    """
+    Test that BinaryCodec raises ValueError for any invalid data and
+    refuses objects it cannot encode.
+    """
+    codec = get_codec('binary')
+    assert isinstance(codec, BinaryCodec)
+    for invalid in (b'', b'x', b's\x00\x00\x00\x05ab', b'i\x00',
+                    b'l\x00\x00\x00\x02N', b's\x00\x00\x00\x01\xff',
+                    b'm\x00\x00\x00\x01l\x00\x00\x00\x00N'):
+        with pytest.raises(ValueError):
+            codec.decode(invalid)
+    with pytest.raises(ValueError):
+        codec.encode(2 ** 64)
+    with pytest.raises(TypeError):
+        codec.encode({"a": object()})
+
+
+def test_frame_decoder_switches_codec():
+    """
+    Test that FrameDecoder decodes length-prefixed frames and that
+    assigning a codec changes the framing of the data not yielded yet.
+    """
+    framed = FramedJsonCodec()
+    decoder = FrameDecoder()
+    data = b'{"join": 1}\n' + encode_frame(b'{"a": 1}', framed)
+    data += encode_frame(b'\n', framed)
+    objects = decoder.feed(data[:-3])
+    assert next(objects) == {"join": 1}
+    decoder.codec = framed
+    assert list(objects) == [{"a": 1}]
+    assert list(decoder.feed(data[-3:])) == [None]
+
+    with pytest.raises(FrameTooLongError):
+        list(FrameDecoder(framed, max_size=2).feed(b'\x00\x00\x00\x03'))
+
+
+def test_frame_decoder_line_chunks():
+    """
+    Test that line_chunks yields a line as it is received and leaves
+    the data after it buffered.
+    """
+    received = [b'23', b'4\r\n{"b"', b': 2}\n']
+    decoder = FrameDecoder()
+    assert list(decoder.feed(b'{"a": 1}\n[1')) == [{"a": 1}]
+    chunks = list(decoder.line_chunks(lambda size: received.pop(0)))
+    assert chunks == [b'[1', b'23', b'4\r\n']
+    assert list(decoder.feed(received.pop(0))) == [{"b": 2}]
+    with pytest.raises(EOFError):
+        list(decoder.line_chunks(lambda size: b''))
@@ -0,0 +1,332 @@
+"""
+test_profile_class.py
+
+This module contains unit tests for the Profile and Post classes
+in the profile_class module.
+
+"""
+
+import json
+import pytest
+import profile_class
+from profile_class import Profile, Post, DsuFileError, DsuProfileError
+from profile_class import ProfileWriter, SqliteProfile, import_dsu
+from profile_class import open_profile
+
+
+def _message(recipient: str, text: str, timestamp: float) -> dict:
+    return {'recipient': recipient, 'message': text,
+            'from_user': True, 'timestamp': timestamp}
+
+
+def test_save_appends_changes(tmp_path):
+    """
+    Test that saving again only appends the changes to the file
+    and that loading replays them.
+    """
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = Profile('localhost', 'test1', 'pw')
+    profile.add_friend('test2')
+    profile.add_message(_message('test2', 'one', 1.0))
+    profile.save_profile(path)
+    compacted = path.read_text(encoding='utf-8')
+    assert json.loads(compacted.splitlines()[0])['dsu_format'] == 2
+
+    profile.add_message(_message('test2', 'two', 2.0))
+    profile.add_friend('test3')
+    profile.add_post(Post('post', 3.0))
+    profile.bio = 'bio'
+    profile.save_profile(path)
+    profile.save_profile(path)
+    content = path.read_text(encoding='utf-8')
+    assert content.startswith(compacted)
+    assert len(content.splitlines()) == len(compacted.splitlines()) + 4
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.bio == 'bio'
+    assert loaded.friends == ['test2', 'test3']
+    assert loaded.messages == profile.messages
+    assert loaded.get_posts() == [{'entry': 'post', 'timestamp': 3.0}]
+
+    loaded.del_post(0)
+    loaded.save_profile(path)
+    # The header holds the friends, followed by one line per message.
+    assert len(path.read_text(encoding='utf-8').splitlines()) == 3
+
+    with pytest.raises(DsuFileError):
+        profile.save_profile(tmp_path / 'missing.dsu')
+
+
+def test_load_tolerates_cut_off_record(tmp_path):
+    """
+    Test that a record cut off while it was appended is ignored
+    and that the next save rewrites the file.
+    """
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = Profile('localhost', 'test1', 'pw')
+    profile.add_message(_message('test2', 'one', 1.0))
+    profile.save_profile(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"op": "message", "data": {"recip')
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert len(loaded.messages) == 1
+    loaded.add_message(_message('test2', 'two', 2.0))
+    loaded.save_profile(path)
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert [msg['message'] for msg in reloaded.messages] == ['one', 'two']
+
+    path.write_text('{"dsu_format": 2}\n', encoding='utf-8')
+    with pytest.raises(DsuProfileError):
+        Profile().load_profile(path)
+
+
+def test_load_legacy_profile(tmp_path):
+    """
+    Test that a profile saved as a single JSON object still loads
+    and is converted to the log format on the next save.
+    """
+    path = tmp_path / 'user.dsu'
+    legacy = {
+        'dsuserver': 'localhost', 'username': 'test1', 'password': 'pw',
+        'bio': '', '_posts': [{'entry': 'post', 'timestamp': 1.0}],
+        'friends': ['test2'],
+        'messages': [_message('test2', 'one', 1.0)],
+    }
+    path.write_text(json.dumps(legacy, indent=4), encoding='utf-8')
+
+    profile = Profile()
+    profile.load_profile(path)
+    assert profile.username == 'test1'
+    assert profile.friends == ['test2']
+    assert profile.get_posts()[0].get_entry() == 'post'
+
+    profile.add_message(_message('test2', 'two', 2.0))
+    profile.save_profile(path)
+    assert path.read_text(encoding='utf-8').startswith('{"dsu_format": 2')
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert len(reloaded.messages) == 2
+
+
+def test_conversation_index(tmp_path):
+    """
+    Test that messages are indexed by recipient and timestamp, both
+    when added and when loaded.
+    """
+    profile = Profile('localhost', 'test1', 'pw')
+    for timestamp in (1.0, 3.0, 5.0):
+        profile.add_message(_message('test2', f'a{timestamp:g}', timestamp))
+        profile.add_message(_message('test3', f'b{timestamp:g}', timestamp))
+    profile.add_message(_message('test2', 'late', 2.0))
+
+    texts = [msg['message']
+             for msg in profile.get_messages_for_recipient('test2')]
+    assert texts == ['a1', 'late', 'a3', 'a5']
+    assert profile.get_messages_for_recipient('nobody') == []
+    assert [msg['message'] for msg in profile.get_last_messages('test2', 2)
+            ] == ['a3', 'a5']
+    assert profile.get_last_messages('test2', 0) == []
+    assert [msg['message'] for msg in profile.get_messages_between(
+        'test3', 2.0, 5.0)] == ['b3', 'b5']
+    assert len(profile.get_messages_between('test2', end=3.0)) == 3
+
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile.save_profile(path)
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.get_messages_for_recipient('test2') == (
+        profile.get_messages_for_recipient('test2'))
+
+
+def test_profile_writer_coalesces_saves(tmp_path, monkeypatch):
+    """
+    Test that ProfileWriter saves a burst of changes in one write
+    and saves what is pending when closed.
+    """
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = Profile('localhost', 'test1', 'pw')
+    saves = []
+    save_profile = profile.save_profile
+    monkeypatch.setattr(profile, 'save_profile',
+                        lambda p: saves.append(p) or save_profile(p))
+
+    writer = ProfileWriter(profile, path, delay=0.2)
+    for i in range(50):
+        profile.add_message(_message('test2', str(i), float(i)))
+        writer.mark_dirty()
+    writer.flush()
+    assert saves == [path]
+    profile.add_message(_message('test2', 'last', 50.0))
+    writer.mark_dirty()
+    writer.close()
+    assert len(saves) == 2
+    assert writer.error is None
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert len(loaded.messages) == 51
+
+    writer = ProfileWriter(profile, tmp_path / 'missing.dsu', delay=0)
+    writer.mark_dirty()
+    writer.close()
+    assert isinstance(writer.error, DsuFileError)
+
+
+def test_lazy_load_reads_conversations_on_demand(tmp_path):
+    """
+    Test that a lazily loaded profile reads the header and the appended
+    changes first and a conversation when it is first used.
+    """
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = Profile('localhost', 'test1', 'pw')
+    profile.add_friend('test2')
+    profile.add_post(Post('post', 1.0))
+    for i in range(10):
+        profile.add_message(_message(f'test{i % 2 + 2}', str(i), float(i)))
+    profile.save_profile(path)
+    profile.add_friend('test4')
+    profile.add_message(_message('test2', 'appended', 20.0))
+    profile.save_profile(path)
+
+    loaded = Profile()
+    loaded.load_profile(path, lazy=True)
+    assert loaded.friends == ['test2', 'test4']
+    assert loaded._conversations == {}
+    loaded.add_message(_message('test3', 'new', 30.0))
+
+    texts = [msg['message']
+             for msg in loaded.get_messages_for_recipient('test2')]
+    assert texts == ['0', '2', '4', '6', '8', 'appended']
+    assert list(loaded._conversations) == ['test2']
+    assert [msg['message'] for msg in loaded.get_last_messages('test3', 2)
+            ] == ['9', 'new']
+    assert loaded.get_posts() == [{'entry': 'post', 'timestamp': 1.0}]
+
+    loaded.save_profile(path)
+    assert len(loaded.messages) == 12
+    loaded.compact(path)
+    reloaded = Profile()
+    reloaded.load_profile(path, lazy=True)
+    assert len(reloaded.messages) == 12
+    assert reloaded.get_messages_for_recipient('test3')[-1]['message'] == (
+        'new')
+
+
+def test_saves_compact_a_long_tail(tmp_path, monkeypatch):
+    """
+    Test that saving through a ProfileWriter compacts the file once
+    enough was appended, so a lazy load leaves most messages unread and
+    a lazily loaded profile unloads the messages it compacted.
+    """
+    monkeypatch.setattr(profile_class, 'COMPACT_TAIL_SIZE', 1000)
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    Profile('localhost', 'test1', 'pw').save_profile(path)
+
+    profile = Profile()
+    profile.load_profile(path, lazy=True)
+    writer = ProfileWriter(profile, path, delay=0)
+    for i in range(200):
+        profile.add_message(_message(f'test{i % 2 + 2}', str(i), float(i)))
+        writer.mark_dirty()
+        writer.flush()
+    writer.close()
+    assert profile._lazy is not None
+    assert len(profile._messages) < 40
+
+    loaded = Profile()
+    loaded.load_profile(path, lazy=True)
+    assert loaded._lazy is not None
+    assert len(loaded._messages) < 40
+    assert [msg['message']
+            for msg in loaded.get_messages_for_recipient('test3')] == [
+        str(i) for i in range(1, 200, 2)]
+    assert len(loaded.messages) == 200
+    assert profile.get_last_messages('test2', 1)[0]['message'] == '198'
+
+
+def test_sqlite_profile(tmp_path):
+    """
+    Test that SqliteProfile keeps the Profile API and only keeps the
+    changes that were saved.
+    """
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = SqliteProfile('localhost', 'test1', 'pw')
+    profile.add_friend('test2')
+    profile.add_post(Post('post', 1.0))
+    for timestamp in (1.0, 3.0, 5.0):
+        profile.add_message(_message('test2', f'a{timestamp:g}', timestamp))
+        profile.add_message(_message('test3', f'b{timestamp:g}', timestamp))
+    profile.add_message(_message('test2', 'late', 2.0))
+    profile.save_profile(path)
+    assert path.read_bytes().startswith(b'SQLite format 3')
+
+    texts = [msg['message']
+             for msg in profile.get_messages_for_recipient('test2')]
+    assert texts == ['a1', 'late', 'a3', 'a5']
+    assert [msg['message'] for msg in profile.get_last_messages('test2', 2)
+            ] == ['a3', 'a5']
+    assert [msg['message'] for msg in profile.get_messages_between(
+        'test3', 2.0, 5.0)] == ['b3', 'b5']
+    assert profile.get_posts() == [{'entry': 'post', 'timestamp': 1.0}]
+
+    profile.bio = 'bio'
+    profile.add_friend('test3')
+    profile.add_message(_message('test3', 'saved', 6.0))
+    profile.save_profile(path)
+    profile.add_message(_message('test3', 'unsaved', 7.0))
+    assert profile.del_post(-1)
+    assert not profile.del_post(0)
+    profile.close()
+
+    loaded = open_profile(path)
+    assert isinstance(loaded, SqliteProfile)
+    assert (loaded.username, loaded.bio) == ('test1', 'bio')
+    assert loaded.friends == ['test2', 'test3']
+    assert loaded.get_last_messages('test3', 1)[0]['message'] == 'saved'
+    assert len(loaded.messages) == 8
+    assert len(loaded.get_posts()) == 1
+
+    with pytest.raises(DsuFileError):
+        loaded.save_profile(tmp_path / 'missing.dsu')
+    loaded.close()
+
+
+def test_import_dsu(tmp_path):
+    """
+    Test that import_dsu copies a JSON profile into a SQLite profile
+    and that SqliteProfile refuses to load JSON profiles.
+    """
+    source = tmp_path / 'user.dsu'
+    source.touch()
+    profile = Profile('localhost', 'test1', 'pw')
+    profile.bio = 'bio'
+    profile.add_friend('test2')
+    profile.add_post(Post('post', 1.0))
+    for i in range(10):
+        profile.add_message(_message(f'test{i % 2 + 2}', str(i), float(i)))
+    profile.save_profile(source)
+
+    with pytest.raises(DsuProfileError):
+        SqliteProfile().load_profile(source)
+    assert isinstance(open_profile(source), Profile)
+
+    destination = tmp_path / 'user.sqlite.dsu'
+    import_dsu(source, destination).close()
+    imported = open_profile(destination)
+    assert isinstance(imported, SqliteProfile)
+    assert (imported.dsuserver, imported.bio) == ('localhost', 'bio')
+    assert imported.friends == ['test2']
+    assert imported.messages == profile.messages
+    assert imported.get_posts() == profile.get_posts()
+    imported.close()
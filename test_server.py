@@ -0,0 +1,694 @@
+"""
+test_server.py
+
+This module contains tests that run the DSUServer and AsyncDSUServer
+from the server module on a free port with a temporary store.
+
+"""
+
+import json
+import queue
+import socket
+import threading
+import time
+import pytest
+
+pytest.importorskip('flask')
+
+import server
+from server import DSUServer, AsyncDSUServer, ClientConnection
+from server_store import create_store
+from ds_protocol import FrameDecoder
+from ds_messenger import DirectMessenger
+
+
+def _start(server_class, tmp_path, storage='json', **kwargs):
+    """
+    Starts a server on a free port and waits until it accepts
+    connections.
+    """
+    store = create_store(storage, tmp_path)
+    dsu_server = server_class('127.0.0.1', 0, store, **kwargs)
+    thread = threading.Thread(target=dsu_server.start_server, daemon=True)
+    thread.start()
+    assert dsu_server.ready.wait(5)
+    dsu_server.thread = thread
+    return dsu_server
+
+
+def _stop(dsu_server):
+    dsu_server.shutdown()
+    dsu_server.thread.join(5)
+    assert not dsu_server.thread.is_alive()
+
+
+@pytest.fixture(autouse=True)
+def _quiet(monkeypatch):
+    monkeypatch.setattr(server, 'DEBUG', False)
+
+
+@pytest.fixture(params=[DSUServer, AsyncDSUServer])
+def dsu_server(request, tmp_path):
+    """
+    A running threaded or asyncio server with a JSON store.
+    """
+    dsu_server = _start(request.param, tmp_path)
+    yield dsu_server
+    _stop(dsu_server)
+
+
+@pytest.fixture(params=[(server_class, storage)
+                        for server_class in [DSUServer, AsyncDSUServer]
+                        for storage in ['json', 'sqlite']],
+                ids=lambda param: f'{param[0].__name__}-{param[1]}')
+def stored_server(request, tmp_path):
+    """
+    A running threaded or asyncio server with a JSON or SQLite store.
+    """
+    server_class, storage = request.param
+    dsu_server = _start(server_class, tmp_path, storage)
+    yield dsu_server
+    _stop(dsu_server)
+
+
+class Client:
+    """
+    A raw protocol connection, reading one response per command sent.
+    """
+
+    def __init__(self, port):
+        self.socket = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.decoder = FrameDecoder()
+        self.received = []
+
+    def send(self, *lines):
+        self.socket.sendall(b''.join(line.encode() + b'\r\n'
+                                     for line in lines))
+
+    def receive(self):
+        while not self.received:
+            data = self.socket.recv(65536)
+            if not data:
+                return None
+            self.received.extend(self.decoder.feed(data))
+        return self.received.pop(0)
+
+    def call(self, line):
+        self.send(line)
+        return self.receive()
+
+    def join(self, username, password='pw'):
+        resp = self.call('{"join": {"username": "%s", "password": "%s", '
+                         '"token": ""}}' % (username, password))
+        assert resp['response']['type'] == 'ok'
+        return resp['response']['token']
+
+    def close(self):
+        self.socket.close()
+
+
+def _messenger(dsu_server, username):
+    messenger = DirectMessenger('127.0.0.1', username, 'pw')
+    messenger.port = dsu_server.port
+    return messenger
+
+
+def _metrics(dsu_server):
+    """
+    Returns the lines of the flask app's /metrics for dsu_server.
+    """
+    server.app.config['DSU_SERVER'] = dsu_server
+    try:
+        resp = server.app.test_client().get('/metrics')
+    finally:
+        server.app.config.pop('DSU_SERVER')
+    return resp.get_data(as_text=True).splitlines()
+
+
+def test_persistent_clients_do_not_hold_workers(tmp_path):
+    """
+    Test that idle persistent connections leave the workers free for
+    other clients.
+    """
+    dsu_server = _start(DSUServer, tmp_path, workers=2, queue_size=4)
+    try:
+        messengers = [_messenger(dsu_server, f'user{i}') for i in range(4)]
+        for messenger in messengers[:3]:
+            assert messenger.send('hello', 'user0')
+        assert [dm.message for dm in messengers[0].retrieve_new()] == [
+            'hello'
+        ] * 3
+        assert dsu_server.pool_stats()['rejected'] == 0
+        for messenger in messengers:
+            messenger.close()
+    finally:
+        _stop(dsu_server)
+
+
+def test_busy_rejection(tmp_path):
+    """
+    Test that a client connecting while every worker is busy and the
+    queue is full is told the server is busy.
+    """
+    dsu_server = _start(DSUServer, tmp_path, workers=1, queue_size=0)
+    release = threading.Event()
+    handle_request = dsu_server._handle_request
+
+    def slow_handle_request(*args):
+        release.wait(5)
+        return handle_request(*args)
+
+    dsu_server._handle_request = slow_handle_request
+    try:
+        first = Client(dsu_server.port)
+        first.send('{"join": {"username": "a", "password": "pw", '
+                   '"token": ""}}')
+        deadline = time.monotonic() + 5
+        while dsu_server.pool_stats()['busy_workers'] < 1:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        second = Client(dsu_server.port)
+        resp = second.receive()
+        assert resp['response']['message'] == 'Server busy, try again later.'
+        assert second.receive() is None
+        release.set()
+        assert first.receive()['response']['type'] == 'ok'
+        assert dsu_server.pool_stats()['rejected'] == 1
+        lines = _metrics(dsu_server)
+        assert 'dsu_worker_pool_size 1' in lines
+        assert 'dsu_connections_accepted_total 1' in lines
+        assert 'dsu_connections_rejected_total 1' in lines
+        first.close()
+        second.close()
+    finally:
+        release.set()
+        _stop(dsu_server)
+
+
+def test_max_connections_rejection(tmp_path):
+    """
+    Test that a client connecting while max_connections connections are
+    open is told the server is busy, even though workers are free.
+    """
+    dsu_server = _start(DSUServer, tmp_path, max_connections=2)
+    try:
+        clients = [Client(dsu_server.port) for _ in range(2)]
+        for number, client in enumerate(clients):
+            client.join(f'user{number}')
+        assert dsu_server.pool_stats()['connections'] == 2
+
+        third = Client(dsu_server.port)
+        resp = third.receive()
+        assert resp['response']['message'] == 'Server busy, try again later.'
+        assert third.receive() is None
+        third.close()
+        assert dsu_server.pool_stats()['rejected'] == 1
+        assert 'dsu_connections_rejected_total 1' in _metrics(dsu_server)
+
+        clients.pop().close()
+        _wait_for(lambda: dsu_server.pool_stats()['connections'] == 1)
+        clients.append(Client(dsu_server.port))
+        clients[-1].join('user1')
+        for client in clients:
+            client.close()
+    finally:
+        _stop(dsu_server)
+
+
+class ResetSocket:
+    """
+    A client socket whose peer reset the connection after sending data.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def recv(self, size):
+        data, self.data = self.data, b''
+        return data
+
+    def sendall(self, data):
+        raise ConnectionResetError('Connection reset by peer')
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('server_class', [DSUServer, AsyncDSUServer])
+def test_pipelined_and_oversize_commands(server_class, tmp_path):
+    """
+    Test that commands sent in one write are all answered, and that a
+    command longer than max_line is refused without stopping the server.
+    """
+    dsu_server = _start(server_class, tmp_path, max_line=1024)
+    try:
+        client = Client(dsu_server.port)
+        token = client.join('alice')
+        client.send(
+            '{"token": "%s", "bio": {"entry": "hi", "timestamp": ""}}'
+            % token,
+            '{"token": "%s", "post": {"entry": "one", "timestamp": ""}}'
+            % token,
+            '{"token": "%s", "directmessage": "new"}' % token,
+            )
+        assert client.receive()['response']['message'] == (
+            'Bio for alice updated.')
+        assert client.receive()['response']['message'] == (
+            'Post created by alice')
+        assert client.receive()['response']['messages'] == []
+        client.close()
+
+        for oversize in (b'x' * 2000, b'x' * 2000 + b'\r\n'):
+            client = Client(dsu_server.port)
+            client.socket.sendall(oversize)
+            assert client.receive()['response']['message'] == (
+                'Message too long.')
+            assert client.receive() is None
+            client.close()
+
+        client = Client(dsu_server.port)
+        client.join('bob')
+        client.close()
+    finally:
+        _stop(dsu_server)
+
+
+def test_worker_survives_client_errors(tmp_path):
+    """
+    Test that a worker keeps serving after a client reset the connection
+    before the reply to an oversize command, or after an unexpected
+    error.
+    """
+    dsu_server = DSUServer('127.0.0.1', 0, create_store('json', tmp_path),
+                           workers=1, max_line=1024)
+    oversize = ResetSocket(b'x' * 2000)
+    closing = ResetSocket(b'')
+    for sock in (oversize, closing):
+        dsu_server._connections.put(ClientConnection(sock, 'test', 1024))
+    dsu_server._connections.put(None)
+    dsu_server._worker()
+    assert oversize.closed and closing.closed
+
+    def broken(conn):
+        raise RuntimeError('bug')
+
+    dsu_server._serve = broken
+    failing = ResetSocket(b'')
+    dsu_server._connections.put(ClientConnection(failing, 'test', 1024))
+    dsu_server._connections.put(None)
+    dsu_server._worker()
+    assert failing.closed
+    assert dsu_server.pool_stats()['busy_workers'] == 0
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_subscribe_pushes_messages(dsu_server):
+    """
+    Test that a subscribed connection receives the messages that arrived
+    before and after subscribing, and that they are then marked read.
+    """
+    alice = _messenger(dsu_server, 'alice')
+    bob = _messenger(dsu_server, 'bob')
+    assert alice.retrieve_new() == []
+    assert bob.send('before', 'alice')
+
+    received = queue.Queue()
+    listener = alice.start_listening(received.put)
+    assert received.get(timeout=5).message == 'before'
+    assert bob.send('after', 'alice')
+    assert received.get(timeout=5).message == 'after'
+    _wait_for(lambda: dsu_server.store.peek_new_messages('alice')[0] == [])
+    assert alice.retrieve_new() == []
+
+    alice.stop_listening()
+    listener.join(5)
+    _wait_for(lambda: not dsu_server.subscribers)
+    alice.close()
+    bob.close()
+
+
+def test_subscribers_do_not_hold_threads(tmp_path):
+    """
+    Test that the threaded server pushes to many subscribed connections
+    from its worker pool, without a thread per subscriber.
+    """
+    dsu_server = _start(DSUServer, tmp_path, backlog=256, workers=4)
+    threads = threading.active_count()
+    try:
+        subscribers = [Client(dsu_server.port) for _ in range(200)]
+        for i, client in enumerate(subscribers):
+            resp = client.call('{"token": "%s", "subscribe": true}'
+                               % client.join(f'user{i}'))
+            assert resp['response']['type'] == 'ok'
+        assert threading.active_count() == threads
+
+        sender = Client(dsu_server.port)
+        token = sender.join('sender')
+        for i in range(len(subscribers)):
+            resp = sender.call('{"token": "%s", "directmessage": {"entry": '
+                               '"hi %d", "recipient": "user%d", '
+                               '"timestamp": ""}}' % (token, i, i))
+            assert resp['response']['type'] == 'ok'
+        for i, client in enumerate(subscribers):
+            event = client.receive()['event']
+            assert [msg['message'] for msg in event['messages']] == [
+                f'hi {i}']
+        assert threading.active_count() == threads
+        for client in subscribers + [sender]:
+            client.close()
+    finally:
+        _stop(dsu_server)
+
+
+@pytest.mark.parametrize('server_class', [DSUServer, AsyncDSUServer])
+def test_slow_subscriber_is_disconnected(server_class, tmp_path,
+                                         monkeypatch):
+    """
+    Test that a subscriber that stops reading neither blocks the sender
+    nor loses the messages it was not sent.
+    """
+    monkeypatch.setattr(server, 'PUSH_QUEUE_SIZE', 2)
+    dsu_server = _start(server_class, tmp_path)
+    try:
+        subscriber = Client(dsu_server.port)
+        token = subscriber.join('alice')
+        resp = subscriber.call('{"token": "%s", "subscribe": true}' % token)
+        assert resp['response']['type'] == 'ok'
+
+        sender = Client(dsu_server.port)
+        token = sender.join('bob')
+        entry = 'x' * 262144
+        for _ in range(100):
+            resp = sender.call(
+                '{"token": "%s", "directmessage": {"entry": "%s", '
+                '"recipient": "alice", "timestamp": ""}}' % (token, entry)
+                )
+            assert resp['response']['type'] == 'ok'
+        _wait_for(lambda: not dsu_server.subscribers)
+
+        alice = _messenger(dsu_server, 'alice')
+        assert alice.retrieve_new()
+        assert len(alice.retrieve_all()) == 100
+        alice.close()
+        subscriber.close()
+        sender.close()
+    finally:
+        _stop(dsu_server)
+
+
+def test_failed_push_leaves_messages_new(tmp_path):
+    """
+    Test that messages whose event could not be sent stay new.
+    """
+    dsu_server = DSUServer('127.0.0.1', 0, create_store('json', tmp_path))
+    store = dsu_server.store
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    store.send_message('one', 'bob', 'alice', '1.0')
+
+    conn = ClientConnection(ResetSocket(b''), 'test')
+    subscription = dsu_server._subscribe('alice', conn)
+    subscription.notify()
+    assert subscription.wants_write()
+    # What a worker does once the selector saw the socket can be written.
+    subscription.start_write()
+    subscription.write()
+    assert not dsu_server.subscribers
+    assert [msg['message'] for msg in store.read_new_messages('alice')] == [
+        'one'
+    ]
+
+
+def test_duplicate_message_ids_are_stored_once(dsu_server):
+    """
+    Test that a message sent again with the same id, alone or in a
+    batch, is acknowledged but stored once.
+    """
+    client = Client(dsu_server.port)
+    token = client.join('alice')
+    bob = Client(dsu_server.port)
+    bob.join('bob')
+    bob.close()
+    single = ('{"token": "%s", "directmessage": {"entry": "one", '
+              '"recipient": "bob", "timestamp": "", "id": "m1"}}' % token)
+    for _ in range(2):
+        assert client.call(single)['response']['type'] == 'ok'
+    resp = client.call(
+        '{"token": "%s", "directmessages": ['
+        '{"entry": "one", "recipient": "bob", "timestamp": "", "id": "m1"}, '
+        '{"entry": "two", "recipient": "bob", "timestamp": "", "id": "m2"}, '
+        '{"entry": "two", "recipient": "bob", "timestamp": "", "id": "m2"}'
+        ']}' % token)
+    assert resp['response']['results'] == ['ok', 'ok', 'ok']
+    client.close()
+
+    bob = _messenger(dsu_server, 'bob')
+    assert [dm.message for dm in bob.retrieve_all()] == ['one', 'two']
+    bob.close()
+
+
+def test_concurrent_retries_are_stored_once(tmp_path, monkeypatch):
+    """
+    Test that message ids claimed by one thread are not stored again by a
+    concurrent retry, that a failed send leaves them free to retry, and
+    that only delivered ids are forgotten past MAX_DELIVERED_IDS.
+    """
+    dsu_server = DSUServer('127.0.0.1', 0, create_store('json', tmp_path))
+    dsu_server.store.get_or_create_user('alice', 'pw')
+    dsu_server.store.get_or_create_user('bob', 'pw')
+    assert dsu_server._claim_message_ids('alice', ['m1', 'm2']) == set()
+    claimed = []
+    retry = threading.Thread(
+        target=lambda: claimed.append(
+            dsu_server._claim_message_ids('alice', ['m2', 'm3'])))
+    retry.start()
+    time.sleep(0.05)
+    assert retry.is_alive()
+    dsu_server._release_message_id('alice', 'm1', True)
+    dsu_server._release_message_id('alice', 'm2', False)
+    retry.join(5)
+    assert claimed == [set()]
+
+    monkeypatch.setattr(server, 'MAX_DELIVERED_IDS', 1)
+    assert dsu_server._send_message_once('hi', 'alice', 'bob', '1.0', 'm2')
+    assert dsu_server._claim_message_ids('alice', ['m1', 'm2']) == {'m2'}
+    dsu_server._release_message_id('alice', 'm3', True)
+    assert dsu_server._claim_message_ids('alice', ['m2']) == set()
+    dsu_server._release_message_id('alice', 'm1', False)
+    dsu_server._release_message_id('alice', 'm2', False)
+    assert len(dsu_server.store.read_all_messages('bob')) == 1
+
+
+def test_crossed_batches_do_not_deadlock(tmp_path):
+    """
+    Test that two connections sending batches with the same ids in
+    opposite orders both complete and store each message once.
+    """
+    dsu_server = _start(DSUServer, tmp_path, workers=2)
+    send_messages = dsu_server._send_messages
+
+    def slow_send_messages(*args):
+        time.sleep(0.1)
+        return send_messages(*args)
+
+    dsu_server._send_messages = slow_send_messages
+    try:
+        bob = Client(dsu_server.port)
+        bob.join('bob')
+        bob.close()
+        batch = ('{"token": "%%s", "directmessages": ['
+                 '{"entry": "%s", "recipient": "bob", "timestamp": "", '
+                 '"id": "%s"}, {"entry": "%s", "recipient": "bob", '
+                 '"timestamp": "", "id": "%s"}]}')
+        clients = [Client(dsu_server.port) for _ in range(2)]
+        tokens = [client.join('alice') for client in clients]
+        clients[0].send(batch % ('a', 'a', 'b', 'b') % tokens[0])
+        clients[1].send(batch % ('b', 'b', 'a', 'a') % tokens[1])
+        for client in clients:
+            assert client.receive()['response']['results'] == ['ok', 'ok']
+            client.close()
+        assert sorted(msg['message'] for msg in
+                      dsu_server.store.read_all_messages('bob')) == ['a', 'b']
+        _wait_for(lambda: dsu_server.pool_stats()['busy_workers'] == 0)
+    finally:
+        _stop(dsu_server)
+
+
+def test_binary_codec_connection(dsu_server):
+    """
+    Test that a client negotiating the binary codec sends and receives
+    messages in binary frames.
+    """
+    alice = DirectMessenger('127.0.0.1', 'alice', 'pw', codecs=['binary'])
+    alice.port = dsu_server.port
+    bob = _messenger(dsu_server, 'bob')
+    assert bob.retrieve_all() == []
+    assert alice.send('hello', 'bob')
+    assert alice.codec.name == 'binary'
+    assert [dm.message for dm in bob.retrieve_new()] == ['hello']
+    assert [dm.message for dm in alice.retrieve_all()] == ['hello']
+    alice.close()
+    bob.close()
+
+
+def test_history_paging(stored_server):
+    """
+    Test that the history is read in pages after a cursor, resumes from
+    history_cursor with only the newer messages, and leaves the messages
+    new.
+    """
+    alice = _messenger(stored_server, 'alice')
+    bob = _messenger(stored_server, 'bob')
+    assert alice.retrieve_all() == []
+    for i in range(5):
+        assert bob.send(str(i), 'alice')
+
+    client = Client(stored_server.port)
+    token = client.join('alice')
+    resp = client.call('{"token": "%s", "directmessage": '
+                       '{"since": null, "limit": 2}}' % token)['response']
+    assert [msg['message'] for msg in resp['messages']] == ['0', '1']
+    resp = client.call('{"token": "%s", "directmessage": {"since": %d, '
+                       '"limit": 10}}' % (token, resp['cursor']))['response']
+    assert [msg['message'] for msg in resp['messages']] == ['2', '3', '4']
+    resp = client.call('{"token": "%s", "directmessage": '
+                       '{"since": -1, "limit": 2}}' % token)['response']
+    assert resp['type'] == 'error'
+    client.close()
+
+    assert [dm.message for dm in alice.iter_history(limit=2)] == [
+        '0', '1', '2', '3', '4'
+    ]
+    assert bob.send('5', 'alice')
+    assert [dm.message
+            for dm in alice.iter_history(alice.history_cursor, 2)] == ['5']
+    assert len(alice.retrieve_new()) == 6
+    alice.close()
+    bob.close()
+
+
+def test_history_pages_capped_by_server(dsu_server, monkeypatch):
+    """
+    Test that iter_history reads the whole history when the server sends
+    smaller pages than the limit asked for.
+    """
+    monkeypatch.setattr(server, 'MAX_HISTORY_PAGE_SIZE', 2)
+    alice = _messenger(dsu_server, 'alice')
+    bob = _messenger(dsu_server, 'bob')
+    assert alice.retrieve_all() == []
+    for i in range(5):
+        assert bob.send(str(i), 'alice')
+    assert [dm.message for dm in alice.iter_history(limit=10)] == [
+        '0', '1', '2', '3', '4'
+    ]
+    assert bob.send('5', 'alice')
+    assert [dm.message
+            for dm in alice.iter_history(alice.history_cursor, 10)] == ['5']
+    alice.close()
+    bob.close()
+
+
+def test_batch_send(stored_server, monkeypatch):
+    """
+    Test that a batch of direct messages is stored with a status for each
+    one, and that oversized or malformed batches are refused.
+    """
+    alice = _messenger(stored_server, 'alice')
+    bob = _messenger(stored_server, 'bob')
+    assert bob.retrieve_all() == []
+    assert alice.send_many([('bob', 'one'), ('nobody', 'lost'),
+                            ('bob', 'two')]) == [True, False, True]
+    assert [dm.message for dm in bob.retrieve_new()] == ['one', 'two']
+
+    client = Client(stored_server.port)
+    token = client.join('carol')
+    resp = client.call(
+        '{"token": "%s", "directmessages": [{"entry": "three", '
+        '"recipient": "bob", "timestamp": ""}, {"entry": "bad"}, 5]}'
+        % token)['response']
+    assert resp['results'] == ['ok', 'error', 'error']
+    monkeypatch.setattr(server, 'MAX_BATCH_SIZE', 1)
+    resp = client.call(
+        '{"token": "%s", "directmessages": [{"entry": "four", '
+        '"recipient": "bob", "timestamp": ""}, {"entry": "five", '
+        '"recipient": "bob", "timestamp": ""}]}' % token)['response']
+    assert resp['type'] == 'error'
+    client.close()
+
+    assert [dm.message for dm in bob.retrieve_new()] == ['three']
+    alice.close()
+    bob.close()
+
+
+def _responses(dsu_server, lines):
+    client = Client(dsu_server.port)
+    token = client.join('alice')
+    responses = [client.call(line.replace('TOKEN', token))
+                 for line in lines]
+    client.close()
+    # Session tokens are random, the rest must match.
+    return json.loads(json.dumps(responses).replace(token, 'TOKEN'))
+
+
+def test_async_server_speaks_the_same_protocol(tmp_path):
+    """
+    Test that AsyncDSUServer answers valid and invalid commands exactly
+    like DSUServer.
+    """
+    lines = [
+        'not json',
+        '{"unknown": 1}',
+        '{"token": "wrong", "post": {"entry": "x", "timestamp": ""}}',
+        '{"token": "TOKEN", "post": {"entry": "x", "timestamp": ""}}',
+        '{"token": "TOKEN", "bio": {"entry": "hi", "timestamp": ""}}',
+        '{"token": "TOKEN", "directmessage": {"entry": "x", '
+        '"recipient": "nobody", "timestamp": ""}}',
+        '{"token": "TOKEN", "directmessage": "all"}',
+        '{"join": {"username": "alice", "password": "bad", "token": ""}}',
+    ]
+    responses = []
+    for server_class in (DSUServer, AsyncDSUServer):
+        dsu_server = _start(server_class, tmp_path / server_class.__name__)
+        try:
+            responses.append(_responses(dsu_server, lines))
+        finally:
+            _stop(dsu_server)
+    assert responses[0] == responses[1]
+
+
+def test_async_server_holds_many_connections(tmp_path):
+    """
+    Test that AsyncDSUServer serves many concurrent connections, each
+    joined and kept open, without a thread per connection.
+    """
+    dsu_server = _start(AsyncDSUServer, tmp_path)
+    threads = threading.active_count()
+    try:
+        clients = [Client(dsu_server.port) for _ in range(500)]
+        tokens = [client.join(f'user{i}') for i, client in enumerate(clients)]
+        assert threading.active_count() == threads
+        for i, (client, token) in enumerate(zip(clients, tokens)):
+            client.send('{"token": "%s", "directmessage": {"entry": "hi", '
+                        '"recipient": "user%d", "timestamp": ""}}'
+                        % (token, (i + 1) % len(clients)))
+        for client in clients:
+            assert client.receive()['response']['type'] == 'ok'
+        for client, token in zip(clients, tokens):
+            resp = client.call('{"token": "%s", "directmessage": "new"}'
+                               % token)
+            assert [msg['message'] for msg in
+                    resp['response']['messages']] == ['hi']
+            client.close()
+    finally:
+        _stop(dsu_server)
@@ -0,0 +1,75 @@
+"""
+test_server_metrics.py
+
+This module contains unit tests for the metrics
+in the server_metrics module.
+
+"""
+
+import threading
+import time
+from server_metrics import Histogram, TimedLock, CommandMetrics
+from server_metrics import render_metrics
+
+
+def test_histogram_buckets():
+    """
+    Test that Histogram counts values in cumulative buckets.
+    """
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+    assert histogram.count == 4
+    assert histogram.total == 3.65
+
+
+def test_timed_lock_records_contention():
+    """
+    Test that TimedLock only times acquisitions that had to wait.
+    """
+    lock = TimedLock('users')
+    with lock:
+        assert lock.locked()
+        assert lock.acquire(blocking=False) is False
+        assert lock.acquire(timeout=0.01) is False
+    assert lock.acquisitions == 1
+    assert lock.wait.count == 0
+
+    lock.acquire()
+    waiter = threading.Thread(target=lambda: lock.acquire() and lock.release())
+    waiter.start()
+    time.sleep(0.05)
+    lock.release()
+    waiter.join()
+    assert lock.acquisitions == 3
+    assert lock.contended == 1
+    assert lock.wait.total > 0.01
+
+
+def test_render_metrics(tmp_path):
+    """
+    Test that render_metrics reports commands, gauges, locks and
+    store files in the Prometheus text format.
+    """
+    metrics = CommandMetrics()
+    metrics.observe('join', 0.002, True)
+    metrics.observe('directmessage_send', 0.001, True)
+    metrics.observe('directmessage_send', 0.003, False)
+    (tmp_path / 'users.json').write_text('{}')
+
+    text = render_metrics(metrics, {'dsu_sessions': ('Sessions.', 2)},
+                          [TimedLock('users')], tmp_path,
+                          {'dsu_connections_rejected_total':
+                           ('Rejected connections.', 3)})
+    lines = text.splitlines()
+    assert 'dsu_requests_total{command="directmessage_send"} 2' in lines
+    assert 'dsu_request_errors_total{command="directmessage_send"} 1' in lines
+    assert ('dsu_request_seconds_bucket{command="join",le="0.0025"} 1'
+            in lines)
+    assert 'dsu_request_seconds_count{command="join"} 1' in lines
+    assert 'dsu_sessions 2' in lines
+    assert '# TYPE dsu_connections_rejected_total counter' in lines
+    assert 'dsu_connections_rejected_total 3' in lines
+    assert 'dsu_lock_acquisitions_total{lock="users"} 0' in lines
+    assert 'dsu_store_file_bytes{file="users.json"} 2' in lines
@@ -0,0 +1,327 @@
+"""
+test_server_store.py
+
+This module contains unit tests for the storage engines
+in the server_store module.
+
+"""
+
+import json
+import pytest
+from pathlib import Path
+import server_store
+from server_store import JsonStore, SqliteStore, MessageRecord, create_store
+
+
+def test_json_store_round_trip(tmp_path):
+    """
+    Test that users, posts and messages survive a close and reload
+    and that the snapshot keeps the users.json format.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    assert store.get_or_create_user('alice', 'pw') is None
+    assert store.get_or_create_user('bob', 'pw') is None
+    assert store.get_or_create_user('alice', 'pw')['password'] == 'pw'
+    assert store.send_message('hello', 'alice', 'bob', '1.0') is True
+    assert store.send_message('hello', 'alice', 'carol', '1.0') is False
+    assert store.update_bio('bob', 'bio', '2.0') is True
+    assert store.create_post('bob', 'post', '3.0') is True
+    store.close()
+
+    users = json.loads((tmp_path / 'users.json').read_text())
+    assert users['bob']['messages'][0] == {
+        'message': 'hello', 'from': 'alice',
+        'timestamp': '1.0', 'status': 'new'
+    }
+    assert users['bob']['bio'] == {'entry': 'bio', 'timestamp': '2.0'}
+    posts = json.loads((tmp_path / 'posts.json').read_text())['posts']
+    assert posts == [{'user': 'bob', 'entry': 'post', 'timestamp': '3.0'}]
+
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    assert isinstance(reloaded._users['alice']['messages'][0], MessageRecord)
+    assert reloaded.read_all_messages('alice') == [
+        {'recipient': 'bob', 'message': 'hello', 'timestamp': '1.0'}
+    ]
+
+
+def test_json_store_replays_journal(tmp_path):
+    """
+    Test that journal records written without a snapshot are replayed,
+    and that replaying records already in the snapshot is a no-op.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    store.send_message('one', 'alice', 'bob', '1.0')
+    journal = (tmp_path / 'users.journal').read_text()
+    store.snapshot()
+    store.send_message('two', 'alice', 'bob', '2.0')
+    # Simulate a crash: the snapshot is on disk but the old journal
+    # records were not discarded yet.
+    (tmp_path / 'users.journal.1').write_text(journal)
+
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    messages = reloaded.read_new_messages('bob')
+    assert [msg['message'] for msg in messages] == ['one', 'two']
+    assert reloaded.read_new_messages('bob') == []
+    assert len(reloaded.read_all_messages('alice')) == 2
+
+
+def test_json_store_truncates_torn_record(tmp_path):
+    """
+    Test that a record torn by a crash is cut off when the store is
+    opened, so the records appended after it are replayed.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    store.send_message('one', 'alice', 'bob', '1.0')
+    store._journal.write('{"op": "message", "userna')
+    store._journal.flush()
+
+    reopened = JsonStore(tmp_path)
+    reopened.open()
+    reopened.send_message('two', 'alice', 'bob', '2.0')
+
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    messages = reloaded.read_new_messages('bob')
+    assert [msg['message'] for msg in messages] == ['one', 'two']
+
+
+def test_json_store_snapshot_in_chunks(tmp_path, monkeypatch):
+    """
+    Test that a snapshot serialized a few messages at a time writes the
+    same users.json as serializing the whole store at once.
+    """
+    monkeypatch.setattr(server_store, 'SNAPSHOT_CHUNK', 2)
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    for i in range(5):
+        store.send_message(str(i), 'alice', 'bob', f'{i}.0')
+    store.read_new_messages('bob')
+    store.snapshot()
+
+    users = json.loads((tmp_path / 'users.json').read_text())
+    assert users == json.loads(json.dumps(
+        store._users, default=server_store._encode_store_object
+        ))
+    assert [msg['status'] for msg in users['bob']['messages']] == [
+        'read'
+    ] * 5
+
+
+def test_json_store_failed_snapshot_stays_dirty(tmp_path, monkeypatch):
+    """
+    Test that a snapshot that fails to write its files leaves the store
+    dirty, so the next snapshot writes them and drops the journal.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    write_atomic = server_store._write_atomic
+
+    def full_disk(path, data):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(server_store, '_write_atomic', full_disk)
+    with pytest.raises(OSError):
+        store.snapshot()
+    assert store._dirty
+    assert store.rotated_path.exists()
+
+    monkeypatch.setattr(server_store, '_write_atomic', write_atomic)
+    store.snapshot()
+    assert not store._dirty
+    assert not store.rotated_path.exists()
+    assert 'alice' in json.loads((tmp_path / 'users.json').read_text())
+    store.close()
+
+
+def test_json_store_unread_index(tmp_path):
+    """
+    Test that new messages are tracked per user across reads, self
+    messages and reloads.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    store.send_message('one', 'alice', 'bob', '1.0')
+    store.send_message('self', 'bob', 'bob', '2.0')
+    assert [msg['message'] for msg in store.read_new_messages('bob')] == [
+        'one', 'self'
+    ]
+    store.send_message('two', 'alice', 'bob', '3.0')
+    store.send_message('three', 'alice', 'bob', '4.0')
+    store.close()
+
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    assert [msg['message'] for msg in reloaded.read_new_messages('bob')] == [
+        'two', 'three'
+    ]
+    reloaded.send_message('four', 'alice', 'bob', '5.0')
+    assert len(reloaded.read_all_messages('bob')) == 6
+    assert reloaded.read_new_messages('bob') == []
+
+
+def test_json_store_send_messages(tmp_path):
+    """
+    Test that a batch of messages is stored as one journal record and
+    reports a status for every recipient.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    for username in ('alice', 'bob', 'carol'):
+        store.get_or_create_user(username, 'pw')
+    results = store.send_messages(
+        'alice',
+        [('one', 'bob'), ('two', 'dave'), ('three', 'carol'),
+         ('four', 'bob'), ('self', 'alice')],
+        '1.0'
+        )
+    assert results == [True, False, True, True, True]
+    assert store.send_messages('dave', [('x', 'bob')]) == [False]
+    journal = (tmp_path / 'users.journal').read_text().splitlines()
+    assert json.loads(journal[-1])['op'] == 'batch'
+
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    assert [msg['message'] for msg in reloaded.read_new_messages('bob')] == [
+        'one', 'four'
+    ]
+    assert len(reloaded.read_all_messages('alice')) == 5
+    assert len(reloaded.read_new_messages('alice')) == 0
+    store.close()
+
+
+def test_sqlite_store_messages(tmp_path):
+    """
+    Test that the SQLite backend stores messages and marks them read.
+    """
+    store = create_store('sqlite', tmp_path)
+    assert isinstance(store, SqliteStore)
+    store.open()
+    assert store.get_or_create_user('alice', 'pw') is None
+    assert store.get_or_create_user('bob', 'pw') is None
+    assert store.get_or_create_user('bob', 'x')['password'] == 'pw'
+    assert store.send_message('one', 'alice', 'bob', '1.0') is True
+    assert store.send_message('two', 'alice', 'bob', '2.0') is True
+    assert store.send_message('lost', 'alice', 'carol', '3.0') is False
+    assert store.create_post('alice', 'post', '4.0') is True
+    assert store.read_new_messages('bob') == [
+        {'from': 'alice', 'message': 'one', 'timestamp': '1.0'},
+        {'from': 'alice', 'message': 'two', 'timestamp': '2.0'},
+    ]
+    assert store.read_new_messages('bob') == []
+    assert store.read_all_messages('alice')[0] == {
+        'recipient': 'bob', 'message': 'one', 'timestamp': '1.0'
+    }
+    assert store.read_new_messages('carol') is False
+    assert store.send_messages(
+        'alice', [('hi', 'bob'), ('hi', 'carol'), ('me', 'alice')], '5.0'
+        ) == [True, False, True]
+    assert len(store.read_new_messages('bob')) == 1
+    assert len(store.read_new_messages('alice')) == 1
+    assert store.get_posts() == [
+        {'user': 'alice', 'entry': 'post', 'timestamp': '4.0'}
+    ]
+    store.close()
+
+
+def test_sqlite_store_imports_json_store(tmp_path):
+    """
+    Test that a new SQLite database is seeded from an existing JSON store.
+    """
+    store = JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pw')
+    store.get_or_create_user('bob', 'pw')
+    store.send_message('hello', 'alice', 'bob', '1.0')
+    store.close()
+
+    sqlite_store = SqliteStore(tmp_path)
+    sqlite_store.open()
+    assert sqlite_store.get_or_create_user('alice', 'x') == {'password': 'pw'}
+    assert sqlite_store.read_new_messages('bob') == [
+        {'from': 'alice', 'message': 'hello', 'timestamp': '1.0'}
+    ]
+    sqlite_store.close()
+
+
+def test_peek_new_messages_and_mark_read(tmp_path):
+    """
+    Test that both backends return new messages without marking them
+    read until mark_read, and only the ones after a key.
+    """
+    for name in ('json', 'sqlite'):
+        store = create_store(name, tmp_path / name)
+        store.open()
+        store.get_or_create_user('alice', 'pw')
+        store.get_or_create_user('bob', 'pw')
+        store.send_message('one', 'alice', 'bob', '1.0')
+        store.send_message('two', 'alice', 'bob', '2.0')
+        messages, keys = store.peek_new_messages('bob')
+        assert [msg['message'] for msg in messages] == ['one', 'two']
+        assert store.peek_new_messages('bob') == (messages, keys)
+        assert store.peek_new_messages('bob', keys[0])[0] == messages[1:]
+        assert store.peek_new_messages('carol') is False
+
+        store.mark_read('bob', keys[:1])
+        store.send_message('three', 'alice', 'bob', '3.0')
+        assert [msg['message'] for msg in store.read_new_messages('bob')] == [
+            'two', 'three'
+        ]
+        store.mark_read('bob', keys)
+        assert store.peek_new_messages('bob') == ([], [])
+        store.close()
+
+
+def test_json_store_keeps_legacy_messages(tmp_path):
+    """
+    Test that the shipped store, whose older messages keep their text
+    under 'entry', keeps every message body through a snapshot and a
+    reload, and that numeric timestamps are loaded as strings.
+    """
+    shipped = Path(__file__).parent / 'store'
+    for name in ('users.json', 'posts.json'):
+        (tmp_path / name).write_bytes((shipped / name).read_bytes())
+    original = json.loads((tmp_path / 'users.json').read_text())
+    expected = {
+        username: [(msg.get('message', msg.get('entry')),
+                    str(msg['timestamp']))
+                   for msg in user['messages']]
+        for username, user in original.items()
+    }
+    assert any('entry' in msg for user in original.values()
+               for msg in user['messages'])
+
+    store = JsonStore(tmp_path)
+    store.open()
+    store.snapshot()
+    store.close()
+    reloaded = JsonStore(tmp_path)
+    reloaded.load()
+    for username, messages in expected.items():
+        assert [(msg.message, msg.timestamp)
+                for msg in reloaded._users[username]['messages']] == messages
+
+    users = json.loads((tmp_path / 'users.json').read_text())
+    users['testuser']['messages'].append(
+        {'message': 'late', 'from': 'testuser', 'timestamp': 1741063100.5,
+         'status': 'new'})
+    (tmp_path / 'users.json').write_text(json.dumps(users))
+    (tmp_path / 'users.journal').unlink(missing_ok=True)
+    numeric = JsonStore(tmp_path)
+    numeric.load()
+    assert numeric.read_new_messages('testuser')[-1] == {
+        'from': 'testuser', 'message': 'late', 'timestamp': '1741063100.5'
+    }